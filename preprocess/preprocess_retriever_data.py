@@ -1,10 +1,10 @@
-
 import json
 import argparse
+import csv
+import hashlib
 import os
+import numpy as np
 from tqdm import tqdm
-import pandas as pd
-from sklearn.utils import shuffle
 
 
 # 创建参数解析器并添加参数
@@ -60,51 +60,61 @@ with open(test_file, 'w') as f:
 
 ### For dataset preprocess ###
 
-doc_id_map = {}  # Create a mapping from doc to doc_id
+doc_id_map = {}  # Create a mapping from the hash of a canonicalized doc to doc_id
 query_id_map = {}  # Create a mapping from query to query_id
 
-documents = []
+documents = []  # Every distinct document once, in order of first appearance
 train_pairs = []
 test_pairs = []
 
+def get_doc_id(api):
+    # The same API shows up in many queries, possibly with its keys in another order
+    doc_hash = hashlib.sha1(json.dumps(api, sort_keys=True).encode("utf-8")).hexdigest()
+    doc_id = doc_id_map.get(doc_hash)
+    if doc_id is None:
+        doc_id = len(doc_id_map) + 1
+        doc_id_map[doc_hash] = doc_id
+        documents.append((doc_id, json.dumps(api)))
+    return doc_id
+
 def process_data(data, pairs):
     for doc in tqdm(data):
+        relevant_apis = {tuple(api_identity) for api_identity in doc['relevant APIs']}
+        query = doc['query']
+        if isinstance(query, list):
+            query = query[0] # a few instances is store in list
         for api in doc['api_list']:
-            document_content = api
-            api_identity = [api['tool_name'], api['api_name']]
-            doc_id = doc_id_map.setdefault(json.dumps(document_content), len(doc_id_map) + 1)
-            documents.append([doc_id, json.dumps(document_content)])
+            doc_id = get_doc_id(api)
 
             # Check if the current API is in the relevant APIs
-            if api_identity in doc['relevant APIs']:
-                query = doc['query']
-                if isinstance(query, list):
-                    query = query[0] # a few instances is store in list
+            if (api['tool_name'], api['api_name']) in relevant_apis:
                 query_id = query_id_map.setdefault(query, len(query_id_map) + 1)
-                pairs.append(([query_id, query], [query_id, 0, doc_id, 1]))
+                pairs.append((query_id, query, doc_id))
 
 process_data(query_train, train_pairs)
 process_data(query_test, test_pairs)
-            
-# Shuffle the data using the shuffle function
-train_pairs = shuffle(train_pairs, random_state=42)
-test_pairs = shuffle(test_pairs, random_state=42)
-
-# Split the shuffled data into queries and labels
-train_queries, train_labels = zip(*train_pairs)
-test_queries, test_labels = zip(*test_pairs)
-
-documents_df = pd.DataFrame(documents, columns=['docid', 'document_content'])
-train_queries_df = pd.DataFrame(train_queries, columns=['qid', 'query_text'])
-train_labels_df = pd.DataFrame(train_labels, columns=['qid', 'useless', 'docid', 'label'])
-test_queries_df = pd.DataFrame(test_queries, columns=['qid', 'query_text'])
-test_labels_df = pd.DataFrame(test_labels, columns=['qid', 'useless', 'docid', 'label'])
-
 
+def write_tsv(path, rows, header=None):
+    # Same quoting as pandas.DataFrame.to_csv(sep='\t'), which the readers rely on
+    with open(path, 'w', newline='') as f:
+        writer = csv.writer(f, delimiter='\t', lineterminator='\n')
+        if header is not None:
+            writer.writerow(header)
+        writer.writerows(rows)
+
+def write_split(pairs, query_path, qrels_path):
+    # Shuffle the data
+    order = np.random.RandomState(42).permutation(len(pairs))
+    pairs = [pairs[i] for i in order]
+    # Every query is written once, the labels keep one row per relevant document
+    queries = {}
+    for query_id, query, _ in pairs:
+        queries.setdefault(query_id, query)
+    write_tsv(query_path, queries.items())
+    write_tsv(qrels_path, ((query_id, 0, doc_id, 1) for query_id, _, doc_id in pairs))
 
 # Save as .tsv and .txt files
-documents_df.to_csv(args.output_dir + '/corpus.tsv', sep='\t', index=False)
-train_queries_df.to_csv(args.output_dir + '/train.query.txt', sep='\t', index=False, header=False)
-test_queries_df.to_csv(args.output_dir + '/test.query.txt', sep='\t', index=False, header=False)
-train_labels_df.to_csv(args.output_dir + '/qrels.train.tsv', sep='\t', index=False, header=False)
-test_labels_df.to_csv(args.output_dir + '/qrels.test.tsv', sep='\t', index=False, header=False)
\ No newline at end of file
+write_tsv(args.output_dir + '/corpus.tsv', documents, header=['docid', 'document_content'])
+write_split(train_pairs, args.output_dir + '/train.query.txt', args.output_dir + '/qrels.train.tsv')
+write_split(test_pairs, args.output_dir + '/test.query.txt', args.output_dir + '/qrels.test.tsv')
+print(f"{len(documents)} distinct documents, {len(train_pairs)} train pairs, {len(test_pairs)} test pairs")
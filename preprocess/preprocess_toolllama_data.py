@@ -2,116 +2,293 @@
 Data preprocessing
 """
 import argparse
+import glob
+import hashlib
 import json
 import os
 import random
+from multiprocessing import Pool
+from tqdm import tqdm
 from toolbench.utils import process_system_message
+from toolbench.train.tokenized_data import INPUT_IDS_SUFFIX, LABELS_SUFFIX, OFFSETS_SUFFIX, write_meta
 random.seed(0)
 parser = argparse.ArgumentParser()
 parser.add_argument('--tool_data_dir', type=str, default="", required=True, help='Original tool data path.')
-parser.add_argument('--output_file', type=str, default="", required=True, help='Preprocessed tool data output path.')
+parser.add_argument('--output_file', type=str, default="", required=False, help='Preprocessed tool data output path, as a single json file.')
+parser.add_argument('--output_dir', type=str, default="", required=False, help='Write jsonl shards and a manifest into this directory instead of --output_file. Re-runs only convert new or changed answer files.')
 parser.add_argument('--method', type=str, default="DFS_woFilter_w2", choices=["CoT@1", "DFS_woFilter_w2"], required=False, help='The method of data.')
+parser.add_argument('--num_workers', type=int, default=8, required=False, help='Number of converting processes.')
+parser.add_argument('--files_per_shard', type=int, default=1000, required=False, help='Number of answer files converted into one shard.')
+parser.add_argument('--tokenize', action="store_true", help='Also write pre-tokenized shards into <output_dir>/tokenized, for train.py --tokenized_data_path.')
+parser.add_argument('--model_name_or_path', type=str, default="huggyllama/llama-7b", required=False, help='Model whose tokenizer is used with --tokenize.')
+parser.add_argument('--conv_template', type=str, default="tool-llama-single-round", required=False, help='Template used with --tokenize.')
+parser.add_argument('--model_max_length', type=int, default=8192, required=False, help='Sequences are truncated to this length with --tokenize.')
 
+MANIFEST_FILE = "manifest.json"
+TOKENIZED_DIR = "tokenized"
 
-def preprocess_rapidapi(tool_data_dir, method, output_file):
-    def process_assistant_reply(message_dict: dict) -> str:
-        content = message_dict["content"]
-        if "function_call" in message_dict:
-            function_call = message_dict["function_call"]
-            reply = function_call # the whole dict containing action name and action input as target.
-        elif content is not None:
-            reply = content
-        else:
-            print(f"Wrong assistant reply: {message_dict}")
-            return ""
-        return reply
 
-    def append_list(instances_list: list) -> list:
-        return_list = []
-        for instances in instances_list:
-            return_list.extend(instances)
-        return return_list
+def process_assistant_reply(message_dict: dict) -> str:
+    content = message_dict["content"]
+    if "function_call" in message_dict:
+        function_call = message_dict["function_call"]
+        reply = function_call # the whole dict containing action name and action input as target.
+    elif content is not None:
+        reply = content
+    else:
+        print(f"Wrong assistant reply: {message_dict}")
+        return ""
+    return reply
 
-    print(f"Preprocessing data from {tool_data_dir} into {output_file}")
-    out_list = []
-    for data_file in os.listdir(os.path.join(tool_data_dir)):
-        tmp_instances = []
-        if method not in data_file:
-            continue
-        data_dict = json.load(open(os.path.join(tool_data_dir, data_file), "r"))
-        answer_generation = data_dict["answer_generation"]
-        is_valid = answer_generation["valid_data"]
-        if not is_valid:
-            continue
-        train_messages = answer_generation["train_messages"]
-        query = answer_generation["query"]
-        functions = answer_generation["function"]
-        for train_message in train_messages:
-            conversations = []
-            cur_react = ""
-            for message_id, message_dict in enumerate(train_message):
-                role = message_dict["role"]
-                content = message_dict["content"]
-                if role == "assistant":
-                    inputs = process_assistant_reply(message_dict) 
-                    
-                    # process the last assistant message as target
-                    if message_id + 1 == len(train_message):
-                        if "function_call" not in message_dict:
-                            cur_react = ""
-                            break
-                        else:
-                            if cur_react == "":
-                                cur_react += "\nThought: "
-                            action = inputs["name"]
-                            action_input = inputs["arguments"]
-                            cur_react += f"\nAction: {action}"
-                            cur_react += f"\nAction Input: {action_input}"
-                            conversations.append({
-                                "from": role,
-                                "value": cur_react
-                            })
-                            cur_react = ""
-                        tmp_dict = {
-                            "id": f"Step {str(message_id)}: {query}",
-                            "conversations":conversations
-                        }
-                        tmp_instances.append(tmp_dict)      
-                        break
 
-                    # process the former assistant messages into history conversations
+def convert_answer_data(data_dict: dict) -> list:
+    """Turn one answer file into training instances, one per assistant step."""
+    tmp_instances = []
+    answer_generation = data_dict["answer_generation"]
+    is_valid = answer_generation["valid_data"]
+    if not is_valid:
+        return tmp_instances
+    train_messages = answer_generation["train_messages"]
+    query = answer_generation["query"]
+    functions = answer_generation["function"]
+    # every step repeats the same system message, render the function list into it only once
+    system_messages = {}
+    for train_message in train_messages:
+        conversations = []
+        cur_react = ""
+        for message_id, message_dict in enumerate(train_message):
+            role = message_dict["role"]
+            content = message_dict["content"]
+            if role == "assistant":
+                inputs = process_assistant_reply(message_dict)
+
+                # process the last assistant message as target
+                if message_id + 1 == len(train_message):
+                    if "function_call" not in message_dict:
+                        cur_react = ""
+                        break
                     else:
-                        if "function_call" not in message_dict:
-                            cur_react += f"\nThought: {inputs}"
-                            continue
-                        else:
-                            if cur_react == "":
-                                cur_react += "\nThought: "
-                            action = inputs["name"]
-                            action_input = inputs["arguments"]
-                            cur_react += f"\nAction: {action}"
-                            cur_react += f"\nAction Input: {action_input}"
-                            conversations.append({
-                                "from": role,
-                                "value": cur_react
-                            })
-                            cur_react = ""
+                        if cur_react == "":
+                            cur_react += "\nThought: "
+                        action = inputs["name"]
+                        action_input = inputs["arguments"]
+                        cur_react += f"\nAction: {action}"
+                        cur_react += f"\nAction Input: {action_input}"
+                        conversations.append({
+                            "from": role,
+                            "value": cur_react
+                        })
+                        cur_react = ""
+                    tmp_dict = {
+                        "id": f"Step {str(message_id)}: {query}",
+                        "conversations":conversations
+                    }
+                    tmp_instances.append(tmp_dict)
+                    break
+
+                # process the former assistant messages into history conversations
                 else:
-                    if role == "system":
-                        inputs = process_system_message(content, functions)
+                    if "function_call" not in message_dict:
+                        cur_react += f"\nThought: {inputs}"
+                        continue
                     else:
-                        inputs = content
-                    conversations.append({
-                        "from": role,
-                        "value": inputs
-                    })
-                    cur_react = ""
-        out_list.append(tmp_instances)
-    out_list = append_list(out_list)
-    json.dump(out_list, open(output_file,"w"), indent=4, ensure_ascii=False)  
+                        if cur_react == "":
+                            cur_react += "\nThought: "
+                        action = inputs["name"]
+                        action_input = inputs["arguments"]
+                        cur_react += f"\nAction: {action}"
+                        cur_react += f"\nAction Input: {action_input}"
+                        conversations.append({
+                            "from": role,
+                            "value": cur_react
+                        })
+                        cur_react = ""
+            else:
+                if role == "system":
+                    if content not in system_messages:
+                        system_messages[content] = process_system_message(content, functions)
+                    inputs = system_messages[content]
+                else:
+                    inputs = content
+                conversations.append({
+                    "from": role,
+                    "value": inputs
+                })
+                cur_react = ""
+    return tmp_instances
+
+
+def convert_answer_file(data_path: str) -> list:
+    with open(data_path, "r") as f:
+        data_dict = json.load(f)
+    return convert_answer_data(data_dict)
+
+
+def list_answer_files(tool_data_dir, method):
+    return sorted(data_file for data_file in os.listdir(tool_data_dir) if method in data_file)
+
+
+def file_fingerprint(data_path, with_hash=True):
+    stat = os.stat(data_path)
+    fingerprint = {"mtime": stat.st_mtime, "size": stat.st_size}
+    if with_hash:
+        with open(data_path, "rb") as f:
+            fingerprint["sha1"] = hashlib.sha1(f.read()).hexdigest()
+    return fingerprint
+
+
+def is_unchanged(data_path, recorded):
+    """Cheap mtime/size check first, the content hash only when those differ."""
+    if not os.path.exists(data_path):
+        return False
+    current = file_fingerprint(data_path, with_hash=False)
+    if current["mtime"] == recorded["mtime"] and current["size"] == recorded["size"]:
+        return True
+    if current["size"] != recorded["size"]:
+        return False
+    if file_fingerprint(data_path)["sha1"] != recorded["sha1"]:
+        return False
+    recorded["mtime"] = current["mtime"]
+    return True
+
+
+# Per-process tokenizer, loaded once by the pool initializer when --tokenize is set
+worker_tokenizer = None
+worker_template = None
+
+
+def init_worker(tokenize_args):
+    global worker_tokenizer, worker_template
+    if tokenize_args is None:
+        return
+    # pulls in the training stack, so only imported when tokenizing
+    from pretokenize_toolllama_data import load_tokenizer
+    worker_tokenizer = load_tokenizer(tokenize_args["model_name_or_path"], tokenize_args["model_max_length"])
+    worker_template = tokenize_args["conv_template"]
+
+
+def convert_shard(job):
+    """Convert a chunk of answer files into one jsonl shard (and its tokenized twin)."""
+    tool_data_dir, data_files, output_dir, shard_name = job
+    shard_path = os.path.join(output_dir, shard_name + ".jsonl")
+    instances = []
+    files = {}
+    num_instances = 0
+    with open(shard_path + ".tmp", "w") as writer:
+        for data_file in data_files:
+            data_path = os.path.join(tool_data_dir, data_file)
+            files[data_file] = file_fingerprint(data_path)
+            for instance in convert_answer_file(data_path):
+                writer.write(json.dumps(instance, ensure_ascii=False) + "\n")
+                num_instances += 1
+                if worker_tokenizer is not None:
+                    instances.append(instance)
+    if worker_tokenizer is not None:
+        from pretokenize_toolllama_data import write_tokenized_shard
+        write_tokenized_shard(instances, worker_tokenizer, worker_template, os.path.join(output_dir, TOKENIZED_DIR), shard_name, disable_tqdm=True)
+    os.replace(shard_path + ".tmp", shard_path)
+    return shard_name, files, num_instances
+
+
+def remove_shard(output_dir, shard_name):
+    paths = [os.path.join(output_dir, shard_name + ".jsonl")]
+    paths += [os.path.join(output_dir, TOKENIZED_DIR, shard_name + suffix) for suffix in (OFFSETS_SUFFIX, INPUT_IDS_SUFFIX, LABELS_SUFFIX)]
+    for path in paths:
+        if os.path.exists(path):
+            os.remove(path)
+
+
+def remove_uncommitted_shards(output_dir, manifest):
+    """Remove the files of shards a crashed run wrote but never added to the manifest, their sources are converted again."""
+    paths = glob.glob(os.path.join(output_dir, "shard-*")) + glob.glob(os.path.join(output_dir, TOKENIZED_DIR, "shard-*"))
+    for path in paths:
+        if os.path.basename(path).split(".")[0] not in manifest["shards"]:
+            os.remove(path)
+
+
+def load_manifest(output_dir, settings):
+    manifest_path = os.path.join(output_dir, MANIFEST_FILE)
+    if os.path.exists(manifest_path):
+        with open(manifest_path, "r") as f:
+            manifest = json.load(f)
+        if manifest["settings"] == settings:
+            return manifest
+        print("Preprocessing settings changed, rebuilding all shards.")
+        for shard_name in manifest["shards"]:
+            remove_shard(output_dir, shard_name)
+    return {"settings": settings, "next_shard_id": 0, "shards": {}}
+
+
+def save_manifest(output_dir, manifest):
+    """The manifest is the commit point of the shards: readers only use the shards it lists, the tokenized ones through meta.json."""
+    manifest_path = os.path.join(output_dir, MANIFEST_FILE)
+    with open(manifest_path + ".tmp", "w") as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(manifest_path + ".tmp", manifest_path)
+    if manifest["settings"]["tokenize"] is not None:
+        os.makedirs(os.path.join(output_dir, TOKENIZED_DIR), exist_ok=True)
+        write_meta(os.path.join(output_dir, TOKENIZED_DIR), **manifest["settings"]["tokenize"], shards=sorted(manifest["shards"]))
+
+
+def preprocess_rapidapi_shards(tool_data_dir, method, output_dir, num_workers=8, files_per_shard=1000, tokenize_args=None):
+    print(f"Preprocessing data from {tool_data_dir} into shards under {output_dir}")
+    os.makedirs(output_dir, exist_ok=True)
+    manifest = load_manifest(output_dir, {"method": method, "tokenize": tokenize_args})
+
+    # A shard is kept only if all of its source files are still there and unchanged,
+    # otherwise it is dropped and its remaining sources are converted again.
+    data_files = list_answer_files(tool_data_dir, method)
+    done_files = set()
+    for shard_name, shard in list(manifest["shards"].items()):
+        if all(is_unchanged(os.path.join(tool_data_dir, data_file), recorded) for data_file, recorded in shard["files"].items()):
+            done_files.update(shard["files"])
+        else:
+            remove_shard(output_dir, shard_name)
+            del manifest["shards"][shard_name]
+    save_manifest(output_dir, manifest)
+    remove_uncommitted_shards(output_dir, manifest)
+    todo_files = [data_file for data_file in data_files if data_file not in done_files]
+    print(f"{len(data_files)} answer files, {len(todo_files)} new or changed")
+
+    jobs = []
+    for start in range(0, len(todo_files), files_per_shard):
+        shard_name = f"shard-{manifest['next_shard_id']:05d}"
+        manifest["next_shard_id"] += 1
+        jobs.append((tool_data_dir, todo_files[start:start + files_per_shard], output_dir, shard_name))
+
+    with Pool(num_workers, initializer=init_worker, initargs=(tokenize_args,)) as pool:
+        for shard_name, files, num_instances in tqdm(pool.imap_unordered(convert_shard, jobs), total=len(jobs)):
+            manifest["shards"][shard_name] = {"files": files, "num_instances": num_instances}
+            save_manifest(output_dir, manifest)
+    save_manifest(output_dir, manifest)
+
+    total = sum(shard["num_instances"] for shard in manifest["shards"].values())
+    print(f"Preprocessing done: {total} instances in {len(manifest['shards'])} shards.")
+
+
+def preprocess_rapidapi(tool_data_dir, method, output_file, num_workers=8):
+    print(f"Preprocessing data from {tool_data_dir} into {output_file}")
+    data_paths = [os.path.join(tool_data_dir, data_file) for data_file in list_answer_files(tool_data_dir, method)]
+    out_list = []
+    with Pool(num_workers) as pool:
+        for tmp_instances in tqdm(pool.imap(convert_answer_file, data_paths, chunksize=64), total=len(data_paths)):
+            out_list.extend(tmp_instances)
+    json.dump(out_list, open(output_file,"w"), indent=4, ensure_ascii=False)
     print("Preprocessing done.")
-        
+
 if __name__=='__main__':
     args = parser.parse_args()
-    preprocess_rapidapi(args.tool_data_dir, args.method, args.output_file)
-    
+    if args.output_dir:
+        tokenize_args = None
+        if args.tokenize:
+            tokenize_args = {
+                "model_name_or_path": args.model_name_or_path,
+                "conv_template": args.conv_template,
+                "model_max_length": args.model_max_length,
+            }
+        preprocess_rapidapi_shards(args.tool_data_dir, args.method, args.output_dir, args.num_workers, args.files_per_shard, tokenize_args)
+    elif args.output_file:
+        preprocess_rapidapi(args.tool_data_dir, args.method, args.output_file, args.num_workers)
+    else:
+        parser.error("one of --output_file or --output_dir is required")
+
@@ -0,0 +1,82 @@
+"""
+Pre-tokenize ToolLLaMA training data into memory-mapped shards,
+consumed by toolbench/train/train.py through --tokenized_data_path.
+"""
+import argparse
+import glob
+import json
+import os
+from tqdm import tqdm
+import transformers
+from toolbench.train.train import tokenize_sources, IGNORE_TOKEN_ID
+from toolbench.train.tokenized_data import TokenizedShardWriter, write_meta
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--model_name_or_path', type=str, default="huggyllama/llama-7b", required=False, help='Model whose tokenizer is used.')
+parser.add_argument('--data_path', type=str, default="", required=True, help='Preprocessed tool data path: a json list, a jsonl file or a directory of jsonl shards.')
+parser.add_argument('--output_dir', type=str, default="", required=True, help='Directory to write the tokenized shards into.')
+parser.add_argument('--conv_template', type=str, default="tool-llama-single-round", required=False, help='Template used to format the training data.')
+parser.add_argument('--model_max_length', type=int, default=8192, required=False, help='Sequences are truncated to this length.')
+parser.add_argument('--batch_size', type=int, default=256, required=False, help='Number of conversations tokenized at once.')
+
+
+def load_tokenizer(model_name_or_path, model_max_length):
+    tokenizer = transformers.AutoTokenizer.from_pretrained(
+        model_name_or_path,
+        model_max_length=model_max_length,
+        padding_side="right",
+        use_fast=False,
+    )
+    tokenizer.pad_token = tokenizer.unk_token
+    return tokenizer
+
+
+def load_raw_data(data_path):
+    if os.path.isdir(data_path):
+        # jsonl shards written by preprocess_toolllama_data.py --output_dir, those its manifest lists if there is one
+        shards = sorted(glob.glob(os.path.join(data_path, "*.jsonl")))
+        manifest_path = os.path.join(data_path, "manifest.json")
+        if os.path.exists(manifest_path):
+            with open(manifest_path, "r") as f:
+                shards = [os.path.join(data_path, shard_name + ".jsonl") for shard_name in sorted(json.load(f)["shards"])]
+        raw_data = []
+        for shard in shards:
+            raw_data.extend(load_raw_data(shard))
+        return raw_data
+    with open(data_path, "r") as f:
+        if data_path.endswith(".jsonl"):
+            return [json.loads(line) for line in f if line.strip()]
+        return json.load(f)
+
+
+def write_tokenized_shard(raw_data, tokenizer, template, output_dir, shard_name="shard-00000", batch_size=256, disable_tqdm=False):
+    """Tokenize `raw_data` into one shard. Returns (#examples, #examples fully masked by a tokenization mismatch)."""
+    num_masked = 0
+    with TokenizedShardWriter(output_dir, shard_name) as writer:
+        for start in tqdm(range(0, len(raw_data), batch_size), disable=disable_tqdm):
+            sources = [example["conversations"] for example in raw_data[start:start + batch_size]]
+            for input_ids, labels in tokenize_sources(sources, tokenizer, template):
+                if (labels == IGNORE_TOKEN_ID).all():
+                    num_masked += 1
+                writer.add(input_ids, labels)
+        num_examples = len(writer)
+    return num_examples, num_masked
+
+
+def pretokenize(model_name_or_path, data_path, output_dir, template, model_max_length, batch_size):
+    print(f"Pre-tokenizing {data_path} into {output_dir}")
+    tokenizer = load_tokenizer(model_name_or_path, model_max_length)
+    raw_data = load_raw_data(data_path)
+    num_examples, num_masked = write_tokenized_shard(raw_data, tokenizer, template, output_dir, batch_size=batch_size)
+    write_meta(
+        output_dir,
+        model_name_or_path=model_name_or_path,
+        conv_template=template,
+        model_max_length=model_max_length,
+    )
+    print(f"Pre-tokenizing done: {num_examples} examples, {num_masked} fully masked by tokenization mismatch.")
+
+
+if __name__=='__main__':
+    args = parser.parse_args()
+    pretokenize(args.model_name_or_path, args.data_path, args.output_dir, args.conv_template, args.model_max_length, args.batch_size)
@@ -0,0 +1,10 @@
+export PYTHONPATH=./
+export DATA_PATH="data/toolllama_G123_dfs_train.json"
+export OUTPUT_DIR="data/toolllama_G123_dfs_train_tokenized/"
+
+python preprocess/pretokenize_toolllama_data.py \
+    --model_name_or_path huggyllama/llama-7b \
+    --data_path $DATA_PATH \
+    --output_dir $OUTPUT_DIR \
+    --conv_template tool-llama-single-round \
+    --model_max_length 8192
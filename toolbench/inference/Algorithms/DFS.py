@@ -3,24 +3,33 @@ from Tree.Tree import my_tree, tree_node
 from Prompts.ReAct_prompts import FORMAT_INSTRUCTIONS_SYSTEM_FUNCTION, FORMAT_INSTRUCTIONS_USER_FUNCTION
 from Prompts.Tree_search_prompts import DIVERSITY_PROMPT
 from Algorithms.base_search import base_search_method
+from Algorithms.scheduler import SearchTask, LLMCall, ToolCall
 from copy import deepcopy
-from LLM_rank.rank_candidate import sum_based_rankn, rank2_subfix
+from LLM_rank.rank_candidate import sum_based_rankn_steps, rank2_subfix_steps
+from Downstream_tasks.api_records import canonical_arguments
 import json
 import random
 
+# Status codes of rapidapi_wrapper.step that an identical call would get again: 0 normal response,
+# 1 no such api, 2 input error, 6 404, 7 not subscribed, 8 unauthorized, 11 error message.
+# Timeouts and rate limits may pass on a retry, and Finish (3, 4) changes the state of io_state.
+TRANSPOSITION_STATUS_CODES = (0, 1, 2, 6, 7, 8, 11)
+
 
 class DFS_tree_search(base_search_method):
 
-    def __init__(self, llm, io_func, process_id=0, callbacks=None):
+    def __init__(self, llm, io_func, process_id=0, callbacks=None, context=None):
         super(DFS_tree_search, self).__init__(
             llm, io_func, process_id, callbacks)
         """Depth-first search. 
         with_filter=True: Every time a child node is generated, choose the best multiple iterations to go.
         with_filter=False: Do as Preorder traversal.
+        context: ExecutionContext of the query, the search exits as on max_query_count once it says to stop
         """
         self.io_func = io_func
         self.llm = llm
         self.process_id = process_id
+        self.context = context
         self.restart()
 
         self.callbacks = callbacks if callbacks is not None else []
@@ -32,6 +41,11 @@ class DFS_tree_search(base_search_method):
         self.now_expand_num = 0
         self.query_count = 0
         self.total_tokens = 0
+        # (state, action, canonical arguments) -> (observation, status) of the tool calls made for this query
+        self.transposition_table = {}
+        self.expanded_actions = set() # (expanded node, transposition key) of the actions generated under each node
+        self.tool_calls_saved = 0
+        self.llm_calls_saved = 0
 
     def send_agent_chain_end(self, depth, agent_block_ids, chain_block_ids):
         for i in range(len(self.callbacks)):
@@ -67,6 +81,8 @@ class DFS_tree_search(base_search_method):
                 "valid_data": False,
                 "query_count": self.query_count,
                 "total_tokens": self.total_tokens,
+                "tool_calls_saved": self.tool_calls_saved,
+                "llm_calls_saved": self.llm_calls_saved,
                 "final_answer": "",
                 "finish_type": "give_answer",
                 "function": self.io_func.functions,
@@ -89,18 +105,29 @@ class DFS_tree_search(base_search_method):
                     json_obj["answer_generation"]["finish_type"] = "give_up"
                     json_obj["answer_generation"]["final_answer"] = choose_give_up_node.description
                     json_obj["answer_generation"]["train_messages"] = choose_give_up_node.get_train_messages_from_this_node()
+            if self.context is not None and self.context.stop_reason is not None:
+                json_obj["answer_generation"]["stop_reason"] = self.context.stop_reason
         return json_obj
 
-    def start(self, single_chain_max_step, tree_beam_size, max_query_count, answer=1, with_filter=True):
+    def start(self, single_chain_max_step, tree_beam_size, max_query_count, answer=1, with_filter=True, reuse_duplicate_actions=True, prune_duplicate_actions=False):
         """ single_chain_max_step: The maximum depth of the tree
             tree_beam_size: How many children nodes for one node are generated per layer
             answer = n means the Algo exits when find n "give_answer" nodes
             max_query_count: the Algo exits when OpenAI-query exists this value
             with_filter: This is the difference between normal DFS(with_filter=True) and DFSDT(with_filter=False). 
+            reuse_duplicate_actions: An action already called with the same arguments in this query reuses the former observation instead of calling the tool again
+            prune_duplicate_actions: Prune a branch that repeats an action its siblings already took with the same arguments
+        """
+        return SearchTask(self.start_steps(single_chain_max_step, tree_beam_size, max_query_count, answer, with_filter, reuse_duplicate_actions, prune_duplicate_actions)).run()
+
+    def start_steps(self, single_chain_max_step, tree_beam_size, max_query_count, answer=1, with_filter=True, reuse_duplicate_actions=True, prune_duplicate_actions=False):
+        """Same as start, as a generator of LLM and tool requests (see Algorithms/scheduler.py), so that a SearchScheduler can run many searches at once
         """
         self.forward_args = locals()
         if "self" in self.forward_args.keys():
             self.forward_args.pop("self")
+        self.reuse_duplicate_actions = reuse_duplicate_actions
+        self.prune_duplicate_actions = prune_duplicate_actions
         self.tree = my_tree()
         self.tree.root.node_type = "Action Input"
         self.tree.root.io_state = deepcopy(self.io_func)
@@ -115,11 +142,17 @@ class DFS_tree_search(base_search_method):
                             self.io_func.input_description)
         self.tree.root.messages.append({"role": "user", "content": user})
 
-        return self.DFS(self.tree.root, single_chain_max_step, tree_beam_size, max_query_count, answer, with_filter)
+        result = yield self.DFS(self.tree.root, single_chain_max_step, tree_beam_size, max_query_count, answer, with_filter)
+        return result
+
+    def transposition_key(self, io_state, action_name, action_input):
+        """Calls with the same action and the same arguments, up to json formatting, from the same env state are the same call"""
+        return (io_state.check_success(), action_name, canonical_arguments(action_input))
 
     def DFS(self, now_node, single_chain_max_step, tree_beam_size, max_query_count, answer, with_filter=True):
         """Returns the number of grids to go back. When a child node of a node generates a final answer or give up, it should go back a few more grids
         In a sense, the larger this value is, the more diverse it is, and it is GreedySearch@n when it is enlarged to infinity.
+        One level of the search: a generator that yields its LLM and tool requests, and its child levels instead of recursing.
         """
 
         # this two value declares the rate to go back, Algo degrades to CoT when the value=Inf
@@ -143,6 +176,8 @@ class DFS_tree_search(base_search_method):
 
         next_tree_split_nodes = []
         for i in range(tree_beam_size):
+            if self.should_stop():
+                return 100000
             temp_now_node = now_node
 
             """If a node have children now, We will prompt the model to generate different nodes than all the existing nodes"""
@@ -186,14 +221,13 @@ class DFS_tree_search(base_search_method):
                 inputs=temp_now_node.messages
             ) for callback in self.callbacks]
             agent_block_ids = []
-            self.llm.change_messages(temp_now_node.messages)
             # on_llm_start
             [callback.on_llm_start(
                 depth=now_depth,
                 messages=temp_now_node.messages
             ) for callback in self.callbacks]
-            new_message, error_code, total_tokens = self.llm.parse(
-                self.io_func.functions, process_id=self.process_id)
+            new_message, error_code, total_tokens = yield LLMCall(
+                self.llm, temp_now_node.messages, self.io_func.functions, process_id=self.process_id, context=self.context)
             # on_llm_end
             [callback.on_llm_end(
                 depth=now_depth,
@@ -201,7 +235,8 @@ class DFS_tree_search(base_search_method):
             ) for callback in self.callbacks]
             self.query_count += 1
             self.total_tokens += total_tokens
-            if self.query_count >= max_query_count:  # a big return value will cause the Algo to exit
+            self.spend_tokens(total_tokens)
+            if self.query_count >= max_query_count or self.should_stop():  # a big return value will cause the Algo to exit
                 return 100000
 
             # We need to exclude the diversity_message, because it will influence child nodes
@@ -265,8 +300,17 @@ class DFS_tree_search(base_search_method):
                     tool_name=temp_now_node.description,
                     tool_input=function_input
                 ) for callback in self.callbacks]
-                observation, status = child_io_state.step(
-                    action_name=temp_now_node.description, action_input=function_input)
+                transposition_key = self.transposition_key(child_io_state, temp_now_node.description, function_input)
+                duplicate_action = (now_node, transposition_key) in self.expanded_actions
+                self.expanded_actions.add((now_node, transposition_key))
+                if transposition_key in self.transposition_table and self.reuse_duplicate_actions:
+                    observation, status = self.transposition_table[transposition_key]
+                    self.tool_calls_saved += 1
+                else:
+                    observation, status = yield ToolCall(
+                        child_io_state, action_name=temp_now_node.description, action_input=function_input)
+                    if status in TRANSPOSITION_STATUS_CODES:
+                        self.transposition_table[transposition_key] = (observation, status)
                 temp_node.observation = observation
                 temp_node.observation_code = status
 
@@ -293,6 +337,10 @@ class DFS_tree_search(base_search_method):
                     elif status == 3:  # final answer
                         temp_now_node.is_terminal = True
                         temp_now_node.make_finish(final_answer_back_length)
+                if duplicate_action and self.prune_duplicate_actions and not temp_now_node.pruned:
+                    # a sibling branch already took this action, not expanding it again saves at least the LLM call of its next step
+                    temp_now_node.pruned = True
+                    self.llm_calls_saved += 1
 
             temp_now_node.messages.append(new_message)
             if temp_now_node.node_type == "Action Input":
@@ -303,7 +351,7 @@ class DFS_tree_search(base_search_method):
                 })
             return_value = None
             if not with_filter:  # DFSDT
-                result = self.DFS(temp_now_node, single_chain_max_step,
+                result = yield self.DFS(temp_now_node, single_chain_max_step,
                                   tree_beam_size, max_query_count, answer, with_filter)
                 if len(self.terminal_node) >= answer:
                     return_value = 10000
@@ -326,12 +374,16 @@ class DFS_tree_search(base_search_method):
                 "functions": self.io_func.functions,
                 "process_id": self.process_id,
                 "task_description": self.io_func.task_description,
-                "rank_func": rank2_subfix,
+                "rank_func": rank2_subfix_steps,
+                "context": self.context,
             }
-            scores, rank_query_count, total_tokens = sum_based_rankn(
+            scores, rank_query_count, total_tokens = yield sum_based_rankn_steps(
                 self.llm, LLM_rank_args=LLM_rank_args, candidates=next_tree_split_nodes)
             self.query_count += rank_query_count
             self.total_tokens += total_tokens
+            self.spend_tokens(total_tokens)
+            if self.should_stop():
+                return 100000
             for score, node in zip(scores, next_tree_split_nodes):
                 node.prior_score = score
             zip_value = list(
@@ -346,7 +398,7 @@ class DFS_tree_search(base_search_method):
         Choose one to expand
         '''
         for i in range(len(next_tree_split_nodes)):
-            result = self.DFS(
+            result = yield self.DFS(
                 next_tree_split_nodes[i], single_chain_max_step, tree_beam_size, max_query_count, answer)
             if len(self.terminal_node) >= answer:
                 return 10000
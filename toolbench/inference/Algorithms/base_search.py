@@ -27,6 +27,17 @@ class base_search_method:
         '''
         raise NotImplementedError
 
+    def spend_tokens(self, total_tokens):
+        """Count tokens against the execution context of the query, if the search has one (self.context)"""
+        context = getattr(self, "context", None)
+        if context is not None:
+            context.add_tokens(total_tokens)
+
+    def should_stop(self):
+        """Whether the execution context of the query says to stop: deadline passed, token budget spent or cancelled"""
+        context = getattr(self, "context", None)
+        return context is not None and context.should_stop()
+
     def start(self, **args):
         """This is the entry point of the searching process"""
         raise NotImplementedError
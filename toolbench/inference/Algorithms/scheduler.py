@@ -0,0 +1,344 @@
+'''
+Step-wise execution of search algorithms.
+
+A search (DFS_tree_search.start_steps, single_chain.start_steps, ...) is a generator. Instead of
+calling the LLM or the environment itself, it yields a request (LLMCall, ToolCall, FunctionCall)
+and is resumed with the request's result. It yields another generator to run a sub-search, e.g.
+one DFS level, whose return value it gets back. SearchTask keeps these frames on an explicit
+stack, so a search can be suspended between any two requests and resumed later. It yields
+Parallel to run several sub-searches at once, e.g. the tries of CoT@n, and cancel the rest early.
+
+SearchTask.run() executes the requests of one search in order, which is what start() does.
+SearchScheduler interleaves many searches in one thread: while some wait for the model, others
+run their tool calls in a thread pool, and LLM calls waiting at the same time for a model that
+supports parse_batch are sent to it as one batch.
+'''
+import inspect
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+
+class LLMCall:
+    """llm.parse on the given conversation, resumes the search with (message, error_code, total_tokens)
+
+    context is the ExecutionContext of the query, if any, passed to parse as `context` (to parse_batch as `contexts`,
+    one per conversation). It is kept apart from parse_args, so calls of different queries still go in one batch.
+    """
+    batchable = True
+
+    def __init__(self, llm, messages, functions, process_id=0, context=None, **parse_args):
+        self.llm = llm
+        self.messages = messages
+        self.functions = functions
+        self.process_id = process_id
+        self.context = context
+        self.parse_args = parse_args
+
+    def run(self):
+        self.llm.change_messages(self.messages)
+        if self.context is not None:
+            return self.llm.parse(functions=self.functions, process_id=self.process_id, context=self.context, **self.parse_args)
+        return self.llm.parse(functions=self.functions, process_id=self.process_id, **self.parse_args)
+
+
+class ToolCall:
+    """io_state.step, resumes the search with (observation, status)"""
+    batchable = False
+    llm = None
+
+    def __init__(self, io_state, action_name, action_input):
+        self.io_state = io_state
+        self.action_name = action_name
+        self.action_input = action_input
+
+    def run(self):
+        return self.io_state.step(action_name=self.action_name, action_input=self.action_input)
+
+
+class FunctionCall:
+    """Any other blocking call. If it uses an llm, pass it as `llm` so that it never runs concurrently with the llm's other calls"""
+    batchable = False
+
+    def __init__(self, func, args=(), kwargs=None, llm=None):
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs if kwargs is not None else {}
+        self.llm = llm
+
+    def run(self):
+        return self.func(*self.args, **self.kwargs)
+
+
+class Parallel:
+    """Run sub-searches concurrently, resumes the search with their SearchTasks, in the given order.
+
+    until(finished) is called with the sub-searches finished so far, in the order they finished. Once it
+    returns True, or a sub-search raised, the others are cancelled: they are never resumed again, their
+    waiting requests are dropped and the results of their calls in flight are thrown away. A sub-search
+    that raised makes the Parallel raise the same exception.
+
+    contexts: an ExecutionContext per sub-search, or None. A cancelled sub-search has its context cancelled too,
+    so that its calls in flight, which were made with it, stop as well instead of running to the end.
+    """
+    batchable = False
+    llm = None
+
+    def __init__(self, steps_list, until=None, contexts=None):
+        self.steps_list = steps_list
+        self.until = until
+        self.contexts = contexts if contexts is not None else [None] * len(steps_list)
+
+    def run(self):
+        # outside of a SearchScheduler, the sub-searches get one of their own
+        scheduler = SearchScheduler(max_workers=max(len(self.steps_list), 1) * 4)
+        group = scheduler.spawn(None, self)
+        scheduler.run()
+        if group.error is not None:
+            raise group.error
+        return group.children
+
+
+class ParallelGroup:
+    """The sub-searches of one Parallel request"""
+
+    def __init__(self, parent, request):
+        self.parent = parent
+        self.request = request
+        self.children = []
+        self.finished = []
+        self.closed = False
+        self.error = None
+
+
+class SearchTask:
+    """One search, advanced request by request over an explicit stack of suspended frames"""
+
+    def __init__(self, steps, callback=None, context=None):
+        self.stack = [steps]
+        self.callback = callback
+        self.context = context # cancelled along with the search
+        self.done = False
+        self.cancelled = False
+        self.result = None
+        self.error = None
+        self.group = None # the Parallel it waits for, if any
+
+    def advance(self, value=None, error=None):
+        '''
+        Resume the search with the result (or the exception) of its last request.
+        Returns its next request, or None once the search returned; exceptions the search does not handle are raised
+        '''
+        while len(self.stack) > 0:
+            frame = self.stack[-1]
+            try:
+                if error is not None:
+                    request = frame.throw(error)
+                else:
+                    request = frame.send(value)
+            except StopIteration as e:
+                self.stack.pop()
+                value, error = e.value, None
+                continue
+            except Exception as e:
+                self.stack.pop()
+                if len(self.stack) == 0:
+                    self.done = True
+                    self.error = e
+                    raise
+                value, error = None, e
+                continue
+            if inspect.isgenerator(request):
+                # a sub-search, its return value is sent back to this frame
+                self.stack.append(request)
+                value, error = None, None
+                continue
+            return request
+        self.done = True
+        self.result = value
+        return None
+
+    def run(self):
+        '''
+        Run the whole search in this thread, executing its requests one after another
+        '''
+        request = self.advance()
+        while request is not None:
+            try:
+                value = request.run()
+            except Exception as e:
+                request = self.advance(error=e)
+                continue
+            request = self.advance(value)
+        return self.result
+
+
+class SearchScheduler:
+    """Interleave many searches in one thread.
+
+    Tool calls and other calls that do not use an llm run in a thread pool as soon as they are requested.
+    An llm object holds the conversation it is asked about, so its calls never overlap: while one call or
+    batch is in flight for an llm, the calls that arrive for it wait, and if it has
+    parse_batch(messages_list, functions_list, process_id, **parse_args) up to max_batch_size of them, with the
+    same parse_args, are sent together, along with `contexts` if any of them has an execution context.
+    """
+
+    def __init__(self, max_workers=16, max_batch_size=16):
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+        self.max_batch_size = max_batch_size
+        self.ready = deque() # (task, value, error) to resume
+        self.waiting = {} # id(llm) -> deque of (task, request) waiting for the llm
+        self.llms = {} # id(llm) -> llm
+        self.busy = set() # id(llm) with a call in flight
+        self.in_flight = {} # future -> (llm key or None, [(task, request)], whether it is a parse_batch call)
+        self.tasks = []
+
+    def submit(self, steps, callback=None):
+        '''
+        Add a search. callback(task) is called in the scheduler's thread when it finished, task.error is set if it raised
+        '''
+        task = SearchTask(steps, callback=callback)
+        self.tasks.append(task)
+        self.ready.append((task, None, None))
+        return task
+
+    def run(self):
+        '''
+        Run until all submitted searches finished, returns their tasks
+        '''
+        try:
+            while len(self.ready) > 0 or self.has_live_calls():
+                while len(self.ready) > 0:
+                    task, value, error = self.ready.popleft()
+                    if task.cancelled:
+                        continue
+                    try:
+                        request = task.advance(value, error)
+                    except Exception:
+                        request = None
+                    if request is None:
+                        if task.callback is not None:
+                            task.callback(task)
+                    else:
+                        self.dispatch(task, request)
+                self.flush()
+                if len(self.in_flight) > 0:
+                    done, _ = wait(list(self.in_flight), return_when=FIRST_COMPLETED)
+                    for future in done:
+                        self.collect(future)
+        finally:
+            self.executor.shutdown(wait=False)
+        return self.tasks
+
+    def has_live_calls(self):
+        # calls of cancelled searches are abandoned, they may finish in the background
+        return any(not task.cancelled for _, batch, _ in self.in_flight.values() for task, _ in batch)
+
+    def dispatch(self, task, request):
+        if isinstance(getattr(request, "steps_list", None), list):
+            self.spawn(task, request)
+            return
+        if request.llm is None:
+            future = self.executor.submit(request.run)
+            self.in_flight[future] = (None, [(task, request)], False)
+            return
+        key = id(request.llm)
+        self.llms[key] = request.llm
+        self.waiting.setdefault(key, deque()).append((task, request))
+
+    def flush(self):
+        '''
+        Start the waiting calls of every idle llm, batched where the llm supports it
+        '''
+        for key, queue in self.waiting.items():
+            if key in self.busy or len(queue) == 0:
+                continue
+            llm = self.llms[key]
+            if queue[0][1].batchable and hasattr(llm, "parse_batch"):
+                parse_args = queue[0][1].parse_args
+                batch = []
+                while len(queue) > 0 and queue[0][1].batchable and queue[0][1].parse_args == parse_args and len(batch) < self.max_batch_size:
+                    batch.append(queue.popleft())
+                batched = True
+                batch_args = dict(parse_args)
+                contexts = [request.context for _, request in batch]
+                if any(context is not None for context in contexts):
+                    batch_args["contexts"] = contexts
+                future = self.executor.submit(
+                    llm.parse_batch,
+                    [request.messages for _, request in batch],
+                    [request.functions for _, request in batch],
+                    batch[0][1].process_id,
+                    **batch_args,
+                )
+            else:
+                batch = [queue.popleft()]
+                batched = False
+                future = self.executor.submit(batch[0][1].run)
+            self.busy.add(key)
+            self.in_flight[future] = (key, batch, batched)
+
+    def spawn(self, parent, request):
+        '''
+        Start the sub-searches of a Parallel request, parent is resumed once they are done
+        '''
+        group = ParallelGroup(parent, request)
+        if parent is not None:
+            parent.group = group
+        for steps, context in zip(request.steps_list, request.contexts):
+            child = SearchTask(steps, callback=lambda child, group=group: self.child_finished(group, child), context=context)
+            group.children.append(child)
+            self.ready.append((child, None, None))
+        if len(group.children) == 0:
+            self.close_group(group)
+        return group
+
+    def child_finished(self, group, child):
+        if group.closed:
+            return
+        group.finished.append(child)
+        if child.error is not None:
+            group.error = child.error
+        if group.error is not None or len(group.finished) == len(group.children) or (group.request.until is not None and group.request.until(group.finished)):
+            self.close_group(group)
+
+    def close_group(self, group):
+        group.closed = True
+        for child in group.children:
+            if not child.done:
+                self.cancel(child)
+        if group.parent is not None:
+            group.parent.group = None
+            self.ready.append((group.parent, group.children, group.error))
+
+    def cancel(self, task):
+        '''
+        Stop a search for good, along with the sub-searches it waits for
+        '''
+        task.cancelled = True
+        task.done = True
+        if task.context is not None:
+            task.context.cancel("cancelled")
+        if task.group is not None and not task.group.closed:
+            task.group.closed = True
+            for child in task.group.children:
+                if not child.done:
+                    self.cancel(child)
+        for frame in reversed(task.stack):
+            frame.close()
+        task.stack = []
+        for key, queue in self.waiting.items():
+            self.waiting[key] = deque(item for item in queue if item[0] is not task)
+
+    def collect(self, future):
+        key, batch, batched = self.in_flight.pop(future)
+        self.busy.discard(key)
+        try:
+            results = future.result()
+        except Exception as e:
+            for task, _ in batch:
+                self.ready.append((task, None, e))
+            return
+        if not batched:
+            results = [results]
+        for (task, _), result in zip(batch, results):
+            self.ready.append((task, result, None))
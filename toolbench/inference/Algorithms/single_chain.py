@@ -3,19 +3,25 @@ import json
 from Tree.Tree import my_tree, tree_node
 from Prompts.ReAct_prompts import FORMAT_INSTRUCTIONS_SYSTEM_FUNCTION, FORMAT_INSTRUCTIONS_USER_FUNCTION
 from Algorithms.base_search import base_search_method
+from Algorithms.scheduler import SearchTask, LLMCall, ToolCall, FunctionCall, Parallel
 from toolbench.inference.LLM.chat_completion_model import ChatCompletion
-from repl import PythonREPL
-from copy import deepcopy
+from repl import get_repl_pool
+from toolbench.inference.execution_context import ExecutionContext
+from copy import copy, deepcopy
 from termcolor import colored
 
 class single_chain(base_search_method):
     """Implement of CoT method
     """
-    def __init__(self,llm,io_func,extra_prefix="",process_id=0,start_message_list=None):
-        """extra_prefix and start_message_list is used in Reflection Algo"""
+    def __init__(self,llm,io_func,extra_prefix="",process_id=0,start_message_list=None,context=None,repl_pool=None):
+        """extra_prefix and start_message_list is used in Reflection Algo
+        context: ExecutionContext of the query, once it says to stop every try ends as pruned
+        repl_pool: REPLWorkerPool running the code actions, the default one of repl.py if None"""
         super(single_chain, self).__init__(llm,io_func, process_id, callbacks=None)
         self.io_func = io_func
         self.llm = llm
+        self.context = context
+        self.repl_pool = repl_pool
         self.extra_prefix = extra_prefix
         self.start_message_list = start_message_list
         self.process_id = process_id
@@ -61,6 +67,8 @@ class single_chain(base_search_method):
                     json_obj["answer_generation"]["final_answer"] = node.description
                     json_obj["answer_generation"]["train_messages"] = node.get_train_messages_from_this_node()
                     break
+            if self.context is not None and self.context.stop_reason is not None:
+                json_obj["answer_generation"]["stop_reason"] = self.context.stop_reason
         
         # Save raw messages for root
         json_obj["root_messages"] = self.tree.root.messages
@@ -77,24 +85,53 @@ class single_chain(base_search_method):
         return json_obj
 
     def start(self,single_chain_max_step,pass_at=1,answer=1):
+        return SearchTask(self.start_steps(single_chain_max_step,pass_at,answer)).run()
+
+    def start_steps(self,single_chain_max_step,pass_at=1,answer=1):
+        """Same as start, as a generator of LLM and tool requests (see Algorithms/scheduler.py)
+        The pass_at tries run concurrently, once `answer` of them succeeded the unfinished ones are cancelled.
+        Only finished tries are recorded, in the order they were started.
+        """
         self.forward_args = locals()
         if "self" in self.forward_args.keys():
             self.forward_args.pop("self")
 
+        trees = []
+        tries = []
+        contexts = []
         for i in range(pass_at):
             if self.process_id == 0:
                 print(f"[single_chain]try for the {i+1} time")
-            self.tree = my_tree()
-            self.tree.root.node_type = "Action Input"
-            self.tree.root.io_state = deepcopy(self.io_func)
-            out_node = self.do_chain(self.tree.root, single_chain_max_step)
+            tree = my_tree()
+            tree.root.node_type = "Action Input"
+            tree.root.io_state = deepcopy(self.io_func)
+            # every try can be stopped on its own: once it is cancelled its llm and api calls in flight stop too
+            context = self.context.child() if self.context is not None else ExecutionContext()
+            if hasattr(tree.root.io_state, "context"):
+                tree.root.io_state.context = context
+            # an llm object holds the conversation it is asked about, so every try gets its own,
+            # unless the llm decodes concurrent calls as one batch
+            llm = self.llm if hasattr(self.llm, "parse_batch") else copy(self.llm)
+            trees.append(tree)
+            contexts.append(context)
+            tries.append(self.do_chain(tree.root, single_chain_max_step, llm=llm, context=context))
+
+        def enough_success(finished):
+            return sum(task.result.io_state.check_success() == 1 for task in finished) >= answer
+
+        tasks = yield Parallel(tries, until=enough_success, contexts=contexts)
+        for tree, task in zip(trees, tasks):
+            if task.cancelled:
+                continue
+            self.tree = tree
+            out_node = task.result
             self.terminal_node.append(out_node)
             self.try_list.append(self.to_json_single())
             if out_node.io_state.check_success() == 1:
                 self.status = 1
                 self.success_count += 1
-                if self.success_count >= answer:
-                    return 1
+        if self.success_count >= answer:
+            return 1
         return 0
 
     def construct_func_name_to_args(self, functions):
@@ -126,12 +163,19 @@ class single_chain(base_search_method):
             func_name_to_args[name] = args
         return func_name_to_args
 
-    def do_chain(self,now_node,single_chain_max_step):
+    def do_chain(self,now_node,single_chain_max_step,llm=None,context=None):
+        """One try, starting from the root node now_node
+        context: ExecutionContext of the try, a child of the query's, its llm calls are made with it"""
+        if llm is None:
+            llm = self.llm
+        if context is None:
+            context = self.context
+        root = now_node
         func_name_to_args = self.construct_func_name_to_args(self.io_func.functions)
 
-        if isinstance(self.llm, ChatCompletion):
+        if isinstance(llm, ChatCompletion):
             # special case for chat completion (with json/code as input)
-            initial_message = self.llm.build_initial_messages(
+            initial_message = llm.build_initial_messages(
                 self.io_func.functions,
                 self.io_func.input_description
             )
@@ -147,28 +191,34 @@ class single_chain(base_search_method):
                     colored(f"{message['role']}: {message['content']}",
                               color = color_converter[message['role']])
                 )
-                self.tree.root.messages.append(message)
+                root.messages.append(message)
         elif self.start_message_list == None:
             system = FORMAT_INSTRUCTIONS_SYSTEM_FUNCTION
             system = system.replace("{task_description}",self.io_func.task_description)
-            self.tree.root.messages.append({"role":"system","content":system})
+            root.messages.append({"role":"system","content":system})
 
             user = FORMAT_INSTRUCTIONS_USER_FUNCTION
             user = user.replace("{input_description}",self.io_func.input_description)
-            self.tree.root.messages.append({"role":"user","content":user})
+            root.messages.append({"role":"user","content":user})
         else:
             """In Reflection Algo, we startswith former trials and reflections, so the caller will give the start messages"""
-            self.tree.root.messages = self.start_message_list
+            root.messages = self.start_message_list
 
-        now_node = self.tree.root
+        now_node = root
         while True:
+            if context is not None and context.should_stop():
+                now_node.pruned = True
+                return now_node
             # recursively parse message into nodes
-            self.llm.change_messages(now_node.messages)
-            new_message,error_code,total_tokens = self.llm.parse(
+            new_message,error_code,total_tokens = yield LLMCall(
+                llm,
+                now_node.messages,
                 functions=self.io_func.functions,
-                process_id=self.process_id
+                process_id=self.process_id,
+                context=context
             )
             self.total_tokens += total_tokens
+            self.spend_tokens(total_tokens)
             self.query_count += 1
             assert new_message["role"] == "assistant"
             if "content" in new_message.keys() and new_message["content"] != None:
@@ -213,7 +263,7 @@ class single_chain(base_search_method):
                     temp_node.node_type = "Action Input"
                     temp_node.description = function_input
                     child_io_state = deepcopy(now_node.io_state)
-                    observation, status = child_io_state.step(action_name=now_node.description, action_input=function_input)
+                    observation, status = yield ToolCall(child_io_state, action_name=now_node.description, action_input=function_input)
                 
                 # Handle code as action
                 elif new_message["function_call"]["type"] == "code_as_action":
@@ -258,11 +308,19 @@ class single_chain(base_search_method):
                             return wrapper
                         user_ns[function_name] = wrap_func(function_name, cur_args)
 
-                    # execute the code
-                    repl = PythonREPL(
-                        user_ns=user_ns,
-                    )
-                    observation = repl(code)
+                    def call_parallel(calls):
+                        # [(function_name, kwargs dict)] -> their results in order, the calls running concurrently
+                        results = child_io_state.step_many([(function_name, json.dumps(kwargs)) for function_name, kwargs in calls])
+                        for (function_name, _), (observation, status) in zip(calls, results):
+                            if status != 0:
+                                raise ValueError(f"Function call {function_name} failed with status {status}: {observation}")
+                        return [observation for observation, _ in results]
+                    if hasattr(child_io_state, "step_many"):
+                        user_ns["call_parallel"] = call_parallel
+
+                    # execute the code in a pre-started worker, the functions are called back in this process
+                    repl_pool = self.repl_pool if self.repl_pool is not None else get_repl_pool()
+                    observation = yield FunctionCall(repl_pool.run, (code, user_ns))
                     status = 0
 
                     # use regex to extract the observation for status if any
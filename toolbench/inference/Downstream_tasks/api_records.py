@@ -0,0 +1,112 @@
+'''
+Record and replay of rapidapi tool calls.
+
+In record mode every api call rapidapi_wrapper makes is stored, keyed by (category, tool, api, canonical
+tool_input), along with its observation and status code. In replay mode the calls are answered from the store,
+with no network and no rate-limit sleep, so a benchmark can be rerun offline and gives the same observations
+every time. A call missing from the store is answered according to the miss policy:
+    error: an error observation with status 12 (error sending request)
+    live: the real call, not stored
+    record: the real call, stored for the next replay
+
+The store is an sqlite file, several processes can record into the same one.
+'''
+import json
+import sqlite3
+import threading
+
+# status codes of calls that may well succeed when made again: timeout, too many requests, rate limit, error sending request.
+# They are not stored, a replay treats them as missing instead of serving bad luck forever.
+TRANSIENT_STATUS_CODES = (5, 9, 10, 12)
+
+
+def canonical_arguments(action_input):
+    """Arguments of a call up to json formatting, the raw string if it is not json"""
+    try:
+        return json.dumps(json.loads(action_input, strict=False), sort_keys=True)
+    except:
+        return action_input.strip()
+
+
+class ApiRecords:
+    """An sqlite store of (category, tool, api, canonical tool_input) -> (observation, status)"""
+
+    def __init__(self, path, mode="record", miss_policy="error"):
+        assert mode in ["record", "replay"]
+        assert miss_policy in ["error", "live", "record"]
+        self.path = path
+        self.mode = mode
+        self.miss_policy = miss_policy
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, timeout=60, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS api_records ("
+            "category TEXT, tool_name TEXT, api_name TEXT, tool_input TEXT, observation TEXT, status INTEGER, "
+            "PRIMARY KEY (category, tool_name, api_name, tool_input))"
+        )
+        self.connection.commit()
+        self.hits = 0
+        self.misses = 0
+        self.recorded = 0
+
+    def __deepcopy__(self, memo):
+        # shared by every copy of the environment
+        return self
+
+    def key(self, payload):
+        return (payload["category"], payload["tool_name"], payload["api_name"], canonical_arguments(payload["tool_input"]))
+
+    def lookup(self, key):
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT observation, status FROM api_records WHERE category=? AND tool_name=? AND api_name=? AND tool_input=?", key
+            ).fetchone()
+        return tuple(row) if row is not None else None
+
+    def save(self, key, observation, status):
+        if status in TRANSIENT_STATUS_CODES:
+            return
+        with self.lock:
+            self.connection.execute("INSERT OR REPLACE INTO api_records VALUES (?, ?, ?, ?, ?, ?)", key + (observation, status))
+            self.connection.commit()
+            self.recorded += 1
+
+    def call(self, payload, live_call, refuse=None):
+        '''
+        (observation, status) of the api call described by payload, live_call() makes the real call.
+        refuse(): (observation, status) answering the call instead of the api, or None to make it, e.g. ToolHealth.check
+        for an open circuit. Checked once the call is not replayed, its answers are never saved
+        '''
+        key = self.key(payload)
+        if self.mode == "replay":
+            record = self.lookup(key)
+            if record is not None:
+                self.hits += 1
+                return record
+            self.misses += 1
+            if self.miss_policy == "error":
+                return json.dumps({"error": f"No recorded response for {payload['api_name']} with this input", "response": ""}), 12
+        if refuse is not None:
+            refusal = refuse()
+            if refusal is not None:
+                return refusal
+        observation, status = live_call()
+        if self.mode == "record" or self.miss_policy == "record":
+            self.save(key, observation, status)
+        return observation, status
+
+    def report(self):
+        if self.mode == "replay":
+            return f"api records ({self.path}): {self.hits} replayed, {self.misses} missing, {self.recorded} recorded"
+        return f"api records ({self.path}): {self.recorded} recorded"
+
+
+def open_api_records(args):
+    '''
+    The ApiRecords store args asks for with --api_record_mode, None if off
+    '''
+    mode = getattr(args, "api_record_mode", "off")
+    if mode == "off":
+        return None
+    return ApiRecords(args.api_record_path, mode=mode, miss_policy=getattr(args, "replay_miss", "error"))
@@ -2,7 +2,9 @@ import re
 import os
 import json
 import time
+import threading
 import requests
+from concurrent.futures import ThreadPoolExecutor
 from tqdm import tqdm
 from termcolor import colored
 import random
@@ -14,12 +16,20 @@ from toolbench.inference.LLM.tool_llama_model import ToolLLaMA
 from toolbench.inference.LLM.retriever import ToolRetriever
 from toolbench.inference.Algorithms.single_chain import single_chain
 from toolbench.inference.Algorithms.DFS import DFS_tree_search
+from toolbench.inference.Algorithms.scheduler import SearchTask, SearchScheduler
 from toolbench.inference.server import get_rapidapi_response
+from toolbench.inference.execution_context import ExecutionContext, context_sleep
+from toolbench.inference.latency import hedged_call, latency_histograms
+from toolbench.inference.http_session import get_session, configure_tool_session, report as http_report
+from toolbench.inference.Downstream_tasks.api_records import open_api_records
+from toolbench.inference.Downstream_tasks.tool_health import open_tool_health
+from toolbench.inference.repl import REPLWorkerPool
 from toolbench.utils import (
     standardize,
     change_name,
     replace_llama_with_condense
 )
+from toolbench.train.llama_flash_attn_monkey_patch import replace_llama_attn_with_flash_attn
 
 from toolbench.inference.Downstream_tasks.base_env import base_env
 
@@ -52,9 +62,54 @@ def contain(candidate_list, white_list):
     return output
 
 
+class CallPacer:
+    """Makes every call wait interval seconds, after the call before it if that one is still waiting: calls are at least
+    interval seconds apart, whatever the number of threads making them"""
+
+    def __init__(self, interval):
+        self.interval = interval
+        self.last_call = 0.0
+        self.lock = threading.Lock()
+
+    def __deepcopy__(self, memo):
+        # shared by every query of the process, see get_service_pacer
+        return self
+
+    def wait(self, context=None):
+        '''
+        Wait for the turn of one call, bounded by context. Returns whether the query should stop
+        '''
+        if self.interval <= 0:
+            return False
+        with self.lock:
+            # each caller takes the next slot and sleeps until it outside of the lock
+            now = time.monotonic()
+            call_at = max(now, self.last_call) + self.interval
+            self.last_call = call_at
+        return context_sleep(context, call_at - now)
+
+
+_service_pacers = {}
+_service_pacers_lock = threading.Lock()
+
+
+def get_service_pacer(service_url, interval):
+    '''
+    The CallPacer of the service at service_url, shared by every query of this process, concurrent ones included.
+    It waits the interval of its first caller
+    '''
+    with _service_pacers_lock:
+        if service_url not in _service_pacers:
+            _service_pacers[service_url] = CallPacer(interval)
+        return _service_pacers[service_url]
+
+
 # rapidapi env wrapper
 class rapidapi_wrapper(base_env):
-    def __init__(self, query_json, tool_descriptions, retriever, args, process_id=0):
+    def __init__(self, query_json, tool_descriptions, retriever, args, process_id=0, context=None, api_records=None, tool_health=None):
+        """context: ExecutionContext of the query, api calls are cut short at its deadline and refused once it says to stop
+        api_records: ApiRecords store the api calls are recorded into or replayed from, see Downstream_tasks/api_records.py
+        tool_health: ToolHealth store refusing the calls of dead endpoints, see Downstream_tasks/tool_health.py"""
         super(rapidapi_wrapper).__init__()
 
         self.tool_root_dir = args.tool_root_dir
@@ -62,11 +117,23 @@ class rapidapi_wrapper(base_env):
         self.rapidapi_key = args.rapidapi_key
         self.use_rapidapi_key = args.use_rapidapi_key
         self.api_customization = args.api_customization
-        self.service_url = "http://8.218.239.54:8080/rapidapi"
+        self.service_url = getattr(args, "service_url", "http://8.218.239.54:8080/rapidapi")
+        self.service_call_interval = getattr(args, "service_call_interval", 2)
+        # the service calls of all the queries of the process, concurrent ones from step_many included, are paced together
+        self.service_pacer = get_service_pacer(self.service_url, self.service_call_interval)
+        # server.py serving the apis for --use_rapidapi_key / --api_customization, None to run them in this process
+        self.local_service_url = getattr(args, "local_service_url", None)
         self.max_observation_length = args.max_observation_length
         self.observ_compress_method = args.observ_compress_method
+        # seconds one api call may take, None for no limit; hedge: duplicate calls slower than the tool's p95 latency
+        self.tool_call_timeout = getattr(args, "tool_call_timeout", 15)
+        self.hedge_tool_calls = getattr(args, "hedge_tool_calls", False)
+        self.api_records = api_records
+        self.tool_health = tool_health
+        self.exclude_dead_apis = getattr(args, "exclude_dead_apis", False) and tool_health is not None
         self.retriever = retriever
         self.process_id = process_id
+        self.context = context
 
         self.tool_names = []
         self.cate_names = []
@@ -111,6 +178,8 @@ class rapidapi_wrapper(base_env):
         }
 
         self.functions.append(finish_func)
+        # function name -> index in self.functions
+        self.function_index = {function["name"]: k for k, function in enumerate(self.functions)}
         self.CALL_MAX_TIME = 3
         self.task_description = f'''You should use functions to help handle the real time user querys. Remember:
 1.ALWAYS call \"Finish\" function at the end of the task. And the final answer should contain enough information to show to the user,If you can't handle the task, or you find that function calls always fail(the function is not valid now), use function Finish->give_up_and_restart.
@@ -139,7 +208,8 @@ You have access of the following tools:\n'''
         return tool_descriptions
     
     def retrieve_rapidapi_tools(self, query, top_k, jsons_path):
-        retrieved_tools = self.retriever.retrieving(query, top_k=top_k)
+        # dead endpoints are skipped, retrieve more to still get top_k
+        retrieved_tools = self.retriever.retrieving(query, top_k=top_k * 2 if self.exclude_dead_apis else top_k)
         query_json = {"api_list":[]}
         for tool_dict in retrieved_tools:
             if len(query_json["api_list"]) == top_k:
@@ -147,6 +217,8 @@ You have access of the following tools:\n'''
             category = tool_dict["category"]
             tool_name = tool_dict["tool_name"]
             api_name = tool_dict["api_name"]
+            if self.exclude_dead_apis and self.tool_health.is_open(category, tool_name, api_name):
+                continue
             if os.path.exists(jsons_path):
                 if os.path.exists(os.path.join(jsons_path, category)):
                     if os.path.exists(os.path.join(jsons_path, category, tool_name+".json")):
@@ -286,6 +358,29 @@ You have access of the following tools:\n'''
             obs = obs[:self.max_observation_length] + "[... truncated due to length ...]"
         return obs, code
 
+    def step_many(self, calls, max_workers=8):
+        '''
+        step for each (action_name, action_input) of calls, the api calls running concurrently. Returns their
+        (observation, status) in order. The calls must not depend on each other
+        '''
+        if len(calls) <= 1:
+            return [self.step(action_name=action_name, action_input=action_input) for action_name, action_input in calls]
+        with ThreadPoolExecutor(max_workers=min(len(calls), max_workers)) as executor:
+            futures = [executor.submit(self.step, action_name=action_name, action_input=action_input) for action_name, action_input in calls]
+            return [future.result() for future in futures]
+
+    def find_function(self, action_name):
+        '''
+        Index in self.functions of the function called action_name, or whose name ends with it; None if there is none
+        '''
+        k = self.function_index.get(action_name)
+        if k is not None:
+            return k
+        for k, function in enumerate(self.functions):
+            if function["name"].endswith(action_name):
+                return k
+        return None
+
     def _step(self, action_name="", action_input=""):
         """Need to return an observation string and status code:
             0 means normal response
@@ -332,63 +427,115 @@ You have access of the following tools:\n'''
                 return "{error:\"\"return_type\" is not a valid choice\"}", 2
         else:
 
-            for k, function in enumerate(self.functions):
-                if function["name"].endswith(action_name):
-                    pure_api_name = self.api_name_reflect[function["name"]]
-                    payload = {
-                        "category": self.cate_names[k],
-                        "tool_name": self.tool_names[k],
-                        "api_name": pure_api_name,
-                        "tool_input": action_input,
-                        "strip": self.observ_compress_method,
-                        "toolbench_key": self.toolbench_key
-                    }
-                    if self.process_id == 0:
-                        print(colored(f"query to {self.cate_names[k]}-->{self.tool_names[k]}-->{action_name}",color="yellow"))
-                    if self.use_rapidapi_key or self.api_customization:
-                        payload["rapidapi_key"] = self.rapidapi_key
-                        response = get_rapidapi_response(payload, api_customization=self.api_customization)
-                    else:
-                        time.sleep(2) # rate limit: 30 per minute
-                        headers = {"toolbench_key": self.toolbench_key}
-                        response = requests.post(self.service_url, json=payload, headers=headers, timeout=15)
-                        if response.status_code != 200:
-                            return json.dumps({"error": f"request invalid, data error. status_code={response.status_code}", "response": ""}), 12
-                        try:
-                            response = response.json()
-                        except:
-                            print(response)
-                            return json.dumps({"error": f"request invalid, data error", "response": ""}), 12
-                    # 1 Hallucinating function names
-                    # 4 means that the model decides to pruning by itself
-                    # 5 represents api call timeout
-                    # 6 for 404
-                    # 7 means not subscribed
-                    # 8 represents unauthorized
-                    # 9 represents too many requests
-                    # 10 stands for rate limit
-                    # 11 message contains "error" field
-                    # 12 error sending request
-                    if response["error"] == "API not working error...":
-                        status_code = 6
-                    elif response["error"] == "Unauthorized error...":
-                        status_code = 7
-                    elif response["error"] == "Unsubscribed error...":
-                        status_code = 8
-                    elif response["error"] == "Too many requests error...":
-                        status_code = 9
-                    elif response["error"] == "Rate limit per minute error...":
-                        print("Reach api calling limit per minute, sleeping...")
-                        time.sleep(10)
-                        status_code = 10
-                    elif response["error"] == "Message error...":
-                        status_code = 11
-                    else:
-                        status_code = 0
-                    return json.dumps(response), status_code
-                    # except Exception as e:
-                    #     return json.dumps({"error": f"Timeout error...{e}", "response": ""}), 5
-            return json.dumps({"error": f"No such function name: {action_name}", "response": ""}), 1
+            k = self.find_function(action_name)
+            if k is None:
+                return json.dumps({"error": f"No such function name: {action_name}", "response": ""}), 1
+            pure_api_name = self.api_name_reflect[self.functions[k]["name"]]
+            payload = {
+                "category": self.cate_names[k],
+                "tool_name": self.tool_names[k],
+                "api_name": pure_api_name,
+                "tool_input": action_input,
+                "strip": self.observ_compress_method,
+                "toolbench_key": self.toolbench_key
+            }
+            if self.context is not None and self.context.should_stop():
+                return self.stopped_observation(), 5
+            live_call = lambda: self.call_api(k, payload, action_name)
+            if self.tool_health is None:
+                return self.api_records.call(payload, live_call) if self.api_records is not None else live_call()
+            if self.api_records is None:
+                return self.tool_health.call(payload, live_call)
+            # the circuit is checked apart from the api call: the answer of an open circuit must not be saved as the api's
+            health_key = self.tool_health.key(payload["category"], payload["tool_name"], payload["api_name"])
+            def health_call():
+                observation, status = live_call()
+                self.tool_health.record(health_key, observation, status)
+                return observation, status
+            return self.api_records.call(payload, health_call, refuse=lambda: self.tool_health.check(health_key))
+
+    def post_service(self, url, payload, headers, timeout, latency_key):
+        '''
+        POST payload to a rapidapi service over the pooled session of this process.
+        Returns (response dict, None), or (None, (observation, status)) if the request failed
+        '''
+        try:
+            response = hedged_call(get_session().post, (url,), {"json": payload, "headers": headers, "timeout": timeout},
+                                   key=latency_key, timeout=timeout, hedge=self.hedge_tool_calls,
+                                   should_stop=self.context.should_stop if self.context is not None else None)
+        except (TimeoutError, requests.exceptions.Timeout) as e:
+            return None, (json.dumps({"error": f"Timeout error...{e}", "response": ""}), 5)
+        if response.status_code != 200:
+            return None, (json.dumps({"error": f"request invalid, data error. status_code={response.status_code}", "response": ""}), 12)
+        try:
+            return response.json(), None
+        except:
+            print(response)
+            return None, (json.dumps({"error": f"request invalid, data error", "response": ""}), 12)
+
+    def call_api(self, k, payload, action_name):
+        """Make the api call of payload to the k-th function, with the service or locally"""
+        if self.process_id == 0:
+            print(colored(f"query to {self.cate_names[k]}-->{self.tool_names[k]}-->{action_name}",color="yellow"))
+        timeout = self.tool_call_timeout
+        if self.context is not None:
+            timeout = self.context.timeout(timeout)
+        latency_key = f"tool/{self.tool_names[k]}"
+        if self.use_rapidapi_key or self.api_customization:
+            payload["rapidapi_key"] = self.rapidapi_key
+            if self.local_service_url is not None:
+                payload["api_customization"] = self.api_customization
+                response, failure = self.post_service(self.local_service_url, payload, {}, timeout, latency_key)
+                if failure is not None:
+                    return failure
+            else:
+                try:
+                    response = hedged_call(get_rapidapi_response, (payload,), {"api_customization": self.api_customization},
+                                           key=latency_key, timeout=timeout, hedge=self.hedge_tool_calls,
+                                           should_stop=self.context.should_stop if self.context is not None else None)
+                except TimeoutError as e:
+                    return json.dumps({"error": f"Timeout error...{e}", "response": ""}), 5
+        else:
+            if self.service_pacer.wait(self.context): # rate limit: 30 per minute
+                return self.stopped_observation(), 5
+            headers = {"toolbench_key": self.toolbench_key}
+            response, failure = self.post_service(self.service_url, payload, headers, timeout, latency_key)
+            if failure is not None:
+                return failure
+        # 1 Hallucinating function names
+        # 4 means that the model decides to pruning by itself
+        # 5 represents api call timeout
+        # 6 for 404
+        # 7 means not subscribed
+        # 8 represents unauthorized
+        # 9 represents too many requests
+        # 10 stands for rate limit
+        # 11 message contains "error" field
+        # 12 error sending request
+        if response["error"].startswith("Timeout error..."):
+            status_code = 5
+        elif response["error"] == "API not working error...":
+            status_code = 6
+        elif response["error"] == "Unauthorized error...":
+            status_code = 7
+        elif response["error"] == "Unsubscribed error...":
+            status_code = 8
+        elif response["error"] == "Too many requests error...":
+            status_code = 9
+        elif response["error"] == "Rate limit per minute error...":
+            print("Reach api calling limit per minute, sleeping...")
+            context_sleep(self.context, 10)
+            status_code = 10
+        elif response["error"] == "Message error...":
+            status_code = 11
+        else:
+            status_code = 0
+        return json.dumps(response), status_code
+        # except Exception as e:
+        #     return json.dumps({"error": f"Timeout error...{e}", "response": ""}), 5
+
+    def stopped_observation(self):
+        return json.dumps({"error": f"Timeout error...query stopped: {self.context.stop_reason}", "response": ""})
 
 
 class pipeline_runner:
@@ -397,6 +544,14 @@ class pipeline_runner:
         self.add_retrieval = add_retrieval
         self.process_id = process_id
         self.server = server
+        self.api_records = open_api_records(args)
+        self.tool_health = open_tool_health(args)
+        # code actions run in worker processes started now, while the tasks and the model load
+        self.repl_pool = None
+        if getattr(args, "action_mode", "json_as_action") == "code_as_action":
+            self.repl_pool = REPLWorkerPool(size=getattr(args, "repl_workers", 4), timeout=getattr(args, "repl_timeout", 30))
+        # the session the api.py modules run in this process send their requests with
+        configure_tool_session(pool_size=getattr(args, "tool_http_pool_size", 64), timeout=getattr(args, "tool_http_timeout", 30), retries=getattr(args, "tool_http_retries", 2))
         if not self.server: self.task_list = self.generate_task_list()
         else: self.task_list = []
 
@@ -405,11 +560,13 @@ class pipeline_runner:
         if args.backbone_model == "toolllama":
             # ratio = 4 means the sequence length is expanded by 4, remember to change the model_max_length to 8192 (2048 * ratio) for ratio = 4
             ratio = int(args.max_sequence_length/args.max_source_sequence_length)
-            replace_llama_with_condense(ratio=ratio)
+            replace_llama_with_condense(ratio=ratio, scaling=getattr(args, "rope_scaling", "linear"))
+            # SDPA attention with kv cache and padding masks
+            replace_llama_attn_with_flash_attn(kv_cache_int8=args.kv_cache_int8)
             if args.lora:
                 backbone_model = ToolLLaMALoRA(base_name_or_path=args.model_path, model_name_or_path=args.lora_path, max_sequence_length=args.max_sequence_length)
             else:
-                backbone_model = ToolLLaMA(model_name_or_path=args.model_path, max_sequence_length=args.max_sequence_length)
+                backbone_model = ToolLLaMA(model_name_or_path=args.model_path, device=args.device, max_sequence_length=args.max_sequence_length, load_8bit=args.load_8bit, load_4bit=args.load_4bit, draft_model_path=args.draft_model_path)
         else:
             backbone_model = args.backbone_model
         return backbone_model
@@ -434,6 +591,12 @@ class pipeline_runner:
         for query_id, data_dict in enumerate(querys):
             if "query_id" in data_dict:
                 query_id = data_dict["query_id"]
+            if "api_list" in data_dict and self.tool_health is not None and getattr(args, "exclude_dead_apis", False):
+                api_list = self.tool_health.filter_api_list(data_dict["api_list"])
+                if len(api_list) == 0:
+                    print(f"query {query_id}: all its apis are dead, skipped")
+                    continue
+                data_dict = dict(data_dict, api_list=api_list)
             if "api_list" in data_dict:
                 origin_tool_names = [standardize(cont["tool_name"]) for cont in data_dict["api_list"]]
                 tool_des = contain(origin_tool_names,white_list)
@@ -445,14 +608,23 @@ class pipeline_runner:
             task_list.append((method, backbone_model, query_id, data_dict, args, answer_dir, tool_des))
         return task_list
     
-    def method_converter(self, backbone_model, openai_key, method, env, process_id, single_chain_max_step=12, max_query_count=60, callbacks=None):
+    def method_converter(self, backbone_model, openai_key, method, env, process_id, single_chain_max_step=12, max_query_count=60, callbacks=None, context=None):
+        chain, steps = self.method_steps(backbone_model, openai_key, method, env, process_id, single_chain_max_step, max_query_count, callbacks, context)
+        result = SearchTask(steps).run()
+        return chain, result
+
+    def method_steps(self, backbone_model, openai_key, method, env, process_id, single_chain_max_step=12, max_query_count=60, callbacks=None, context=None):
+        """Build the search for method, return it and the generator that runs it (see Algorithms/scheduler.py)
+        context: ExecutionContext bounding the search, None for no bound but max_query_count"""
         if callbacks is None: callbacks = []
         if backbone_model.startswith("chat_completion"):
             model = backbone_model.split(":")[-1]
-            llm_forward = ChatCompletion(model=model, openai_key=openai_key, action_mode=self.args.action_mode)
+            llm_forward = ChatCompletion(model=model, openai_key=openai_key, action_mode=self.args.action_mode,
+                                         call_timeout=getattr(self.args, "llm_call_timeout", None), hedge=getattr(self.args, "hedge_llm_calls", False))
         elif backbone_model == "chatgpt_function":
             model = "gpt-3.5-turbo-16k-0613"
-            llm_forward = ChatGPTFunction(model=model, openai_key=openai_key)
+            llm_forward = ChatGPTFunction(model=model, openai_key=openai_key,
+                                          call_timeout=getattr(self.args, "llm_call_timeout", None), hedge=getattr(self.args, "hedge_llm_calls", False))
         elif backbone_model == "davinci":
             model = "text-davinci-003"
             llm_forward = Davinci(model=model, openai_key=openai_key)
@@ -462,8 +634,8 @@ class pipeline_runner:
         
         if method.startswith("CoT"):
             passat = int(method.split("@")[-1])
-            chain = single_chain(llm=llm_forward, io_func=env,process_id=process_id)
-            result = chain.start(
+            chain = single_chain(llm=llm_forward, io_func=env,process_id=process_id, context=context, repl_pool=self.repl_pool)
+            steps = chain.start_steps(
                                 pass_at=passat,
                                 single_chain_max_step=single_chain_max_step,
                                 answer=1)
@@ -475,19 +647,25 @@ class pipeline_runner:
             with_filter = True
             if "woFilter" in method:
                 with_filter = False
-            chain = DFS_tree_search(llm=llm_forward, io_func=env,process_id=process_id, callbacks=callbacks)
-            result = chain.start(
+            chain = DFS_tree_search(llm=llm_forward, io_func=env,process_id=process_id, callbacks=callbacks, context=context)
+            steps = chain.start_steps(
                                 single_chain_max_step=single_chain_max_step,
                                 tree_beam_size = width,
                                 max_query_count = max_query_count,
                                 answer=1,
-                                with_filter=with_filter)
+                                with_filter=with_filter,
+                                prune_duplicate_actions=getattr(self.args, "prune_duplicate_actions", False))
         else:
             print("invalid method")
             raise NotImplementedError
-        return chain, result
+        return chain, steps
     
-    def run_single_task(self, method, backbone_model, query_id, data_dict, args, output_dir_path, tool_des, retriever=None, process_id=0, callbacks=None, server= None):
+    def run_single_task(self, method, backbone_model, query_id, data_dict, args, output_dir_path, tool_des, retriever=None, process_id=0, callbacks=None, server= None, context=None):
+        return SearchTask(self.run_single_task_steps(method, backbone_model, query_id, data_dict, args, output_dir_path, tool_des, retriever, process_id, callbacks, server, context)).run()
+
+    def run_single_task_steps(self, method, backbone_model, query_id, data_dict, args, output_dir_path, tool_des, retriever=None, process_id=0, callbacks=None, server= None, context=None):
+        """context: ExecutionContext of the query, made from args.query_timeout and args.max_query_tokens if not given.
+        Keep a reference to cancel() the query from another thread"""
         if server is None:
             server = self.server
         if callbacks is None:
@@ -499,8 +677,10 @@ class pipeline_runner:
         output_file_path = os.path.join(output_dir_path,f"{query_id}_{method}.json")
         if (not server) and os.path.exists(output_file_path):
             return
+        if context is None:
+            context = ExecutionContext(timeout=getattr(args, "query_timeout", None), max_tokens=getattr(args, "max_query_tokens", None))
         [callback.on_tool_retrieval_start() for callback in callbacks]
-        env = rapidapi_wrapper(data_dict, tool_des, retriever, args, process_id=process_id)
+        env = rapidapi_wrapper(data_dict, tool_des, retriever, args, process_id=process_id, context=context, api_records=self.api_records, tool_health=self.tool_health)
         [callback.on_tool_retrieval_end(
             tools=env.functions
         ) for callback in callbacks]
@@ -511,7 +691,7 @@ class pipeline_runner:
             user_input=query,
             method=method,
         ) for callback in callbacks]
-        chain,result = self.method_converter(
+        chain,steps = self.method_steps(
             backbone_model=backbone_model,
             openai_key=args.openai_key,
             method=method,
@@ -519,8 +699,10 @@ class pipeline_runner:
             process_id=process_id,
             single_chain_max_step=12,
             max_query_count=200,
-            callbacks=callbacks
+            callbacks=callbacks,
+            context=context
         )
+        result = yield steps
         [callback.on_request_end(
             chain=chain.terminal_node[0].messages,
             outputs=chain.terminal_node[0].description,
@@ -552,7 +734,36 @@ class pipeline_runner:
             retriever = self.get_retriever()
         else:
             retriever = None
-        for k, task in enumerate(task_list):
-            print(f"process[{self.process_id}] doing task {k}/{len(task_list)}: real_task_id_{task[2]}")
-            result = self.run_single_task(*task, retriever=retriever, process_id=self.process_id)
+        num_concurrent_queries = getattr(self.args, "num_concurrent_queries", 1)
+        if num_concurrent_queries > 1:
+            self.run_concurrently(task_list, retriever, num_concurrent_queries)
+        else:
+            for k, task in enumerate(task_list):
+                print(f"process[{self.process_id}] doing task {k}/{len(task_list)}: real_task_id_{task[2]}")
+                result = self.run_single_task(*task, retriever=retriever, process_id=self.process_id)
+        print(latency_histograms.report())
+        if self.api_records is not None:
+            print(self.api_records.report())
+        if self.tool_health is not None:
+            print(self.tool_health.report())
+        connection_report = http_report()
+        if connection_report:
+            print(connection_report)
+
+    def run_concurrently(self, task_list, retriever, num_concurrent_queries):
+        """Keep num_concurrent_queries tasks in flight in this process, their LLM calls are batched and their tool calls overlap"""
+        scheduler = SearchScheduler(max_workers=num_concurrent_queries, max_batch_size=getattr(self.args, "max_batch_size", 16))
+        pending = list(enumerate(task_list))[::-1]
+
+        def submit_next(finished_task=None):
+            if finished_task is not None and finished_task.error is not None:
+                print(colored(f"process[{self.process_id}] task failed: {finished_task.error!r}", "red"))
+            if len(pending) > 0:
+                k, task = pending.pop()
+                print(f"process[{self.process_id}] doing task {k}/{len(task_list)}: real_task_id_{task[2]}")
+                scheduler.submit(self.run_single_task_steps(*task, retriever=retriever, process_id=self.process_id), callback=submit_next)
+
+        for _ in range(num_concurrent_queries):
+            submit_next()
+        scheduler.run()
 
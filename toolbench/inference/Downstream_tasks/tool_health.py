@@ -0,0 +1,184 @@
+'''
+Health of the rapidapi endpoints, kept across runs, with a circuit breaker per (tool, api).
+
+Many tools of the benchmark are dead: every call comes back "API not working", unauthorized, unsubscribed or
+fails to be sent (status 6, 7, 8, 12), and they are called again by thousands of queries. The outcome of every
+live call rapidapi_wrapper makes is recorded per (category, tool, api). Once at least min_calls of the last
+window calls were made and error_rate of them failed, the circuit of the endpoint opens: for cooldown seconds its
+calls are answered at once with the last error it returned, without the network. After the cooldown one call is
+let through; if it succeeds the circuit closes and the record starts over, if not it stays open for another
+cooldown. Endpoints with an open circuit can also be left out of the tasks and of the retrieved apis.
+
+Timeouts, too many requests and rate limits (5, 9, 10) say nothing about the endpoint and are not counted.
+The store is an sqlite file, several processes can share the same one.
+'''
+import json
+import sqlite3
+import threading
+import time
+
+from toolbench.utils import standardize, change_name
+
+FAILURE_STATUS_CODES = (6, 7, 8, 12)
+# the api answered, even if its answer holds an error message
+SUCCESS_STATUS_CODES = (0, 11)
+
+
+class ToolHealth:
+    """An sqlite store of (category, tool, api) -> outcomes of its last calls and the state of its circuit"""
+
+    def __init__(self, path, error_rate=0.8, min_calls=3, window=10, cooldown=3600):
+        self.path = path
+        self.error_rate = error_rate
+        self.min_calls = min_calls
+        self.window = window
+        self.cooldown = cooldown
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, timeout=60, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS tool_health ("
+            "category TEXT, tool_name TEXT, api_name TEXT, recent TEXT, calls INTEGER, failures INTEGER, avoided INTEGER, "
+            "last_status INTEGER, last_error TEXT, opened_until REAL, "
+            "PRIMARY KEY (category, tool_name, api_name))"
+        )
+        self.connection.commit()
+        self.avoided = 0
+        self.opened = 0
+
+    def __deepcopy__(self, memo):
+        # shared by every copy of the environment
+        return self
+
+    def key(self, category, tool_name, api_name):
+        return (category, standardize(tool_name), change_name(standardize(api_name)))
+
+    def row(self, key):
+        row = self.connection.execute(
+            "SELECT recent, calls, failures, avoided, last_status, last_error, opened_until FROM tool_health "
+            "WHERE category=? AND tool_name=? AND api_name=?", key
+        ).fetchone()
+        if row is None:
+            return {"recent": "", "calls": 0, "failures": 0, "avoided": 0, "last_status": 0, "last_error": "", "opened_until": 0.0}
+        return dict(zip(["recent", "calls", "failures", "avoided", "last_status", "last_error", "opened_until"], row))
+
+    def write(self, key, row):
+        self.connection.execute(
+            "INSERT OR REPLACE INTO tool_health VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            key + (row["recent"], row["calls"], row["failures"], row["avoided"], row["last_status"], row["last_error"], row["opened_until"])
+        )
+
+    def is_open(self, category, tool_name, api_name):
+        '''
+        Whether the circuit of the endpoint is open, i.e. its calls are refused for now
+        '''
+        with self.lock:
+            return self.row(self.key(category, tool_name, api_name))["opened_until"] > time.time()
+
+    def check(self, key):
+        '''
+        The (observation, status) to answer a call with if its circuit is open, None to make the call
+        '''
+        now = time.time()
+        with self.lock:
+            self.connection.execute("BEGIN IMMEDIATE")
+            row = self.row(key)
+            if row["opened_until"] == 0:
+                self.connection.commit()
+                return None
+            if row["opened_until"] <= now:
+                # cooldown over: this call probes the endpoint, the others wait for its outcome another cooldown
+                row["opened_until"] = now + self.cooldown
+                self.write(key, row)
+                self.connection.commit()
+                return None
+            row["avoided"] += 1
+            self.write(key, row)
+            self.connection.commit()
+            self.avoided += 1
+        failed = row["recent"].count("1")
+        observation = {
+            "error": row["last_error"],
+            "response": f"{key[1]}.{key[2]} is not working now, {failed} of its last {len(row['recent'])} calls failed",
+        }
+        return json.dumps(observation), row["last_status"]
+
+    def record(self, key, observation, status):
+        if status in FAILURE_STATUS_CODES:
+            failed = True
+        elif status in SUCCESS_STATUS_CODES:
+            failed = False
+        else:
+            return
+        with self.lock:
+            self.connection.execute("BEGIN IMMEDIATE")
+            row = self.row(key)
+            row["calls"] += 1
+            if failed:
+                row["failures"] += 1
+                row["last_status"] = status
+                try:
+                    row["last_error"] = json.loads(observation)["error"]
+                except:
+                    row["last_error"] = str(observation)[:256]
+                row["recent"] = (row["recent"] + "1")[-self.window:]
+                failures = row["recent"].count("1")
+                if len(row["recent"]) >= self.min_calls and failures >= self.error_rate * len(row["recent"]):
+                    if row["opened_until"] == 0:
+                        self.opened += 1
+                    row["opened_until"] = time.time() + self.cooldown
+            elif row["opened_until"] > 0:
+                # a probe went through, the endpoint works again
+                row["recent"] = "0"
+                row["opened_until"] = 0.0
+            else:
+                row["recent"] = (row["recent"] + "0")[-self.window:]
+            self.write(key, row)
+            self.connection.commit()
+
+    def call(self, payload, live_call):
+        '''
+        (observation, status) of the api call described by payload, live_call() makes the real call unless the circuit is open
+        '''
+        key = self.key(payload["category"], payload["tool_name"], payload["api_name"])
+        refused = self.check(key)
+        if refused is not None:
+            return refused
+        observation, status = live_call()
+        self.record(key, observation, status)
+        return observation, status
+
+    def filter_api_list(self, api_list):
+        '''
+        The items of a task's api_list ({"category_name", "tool_name", "api_name"}) whose circuit is not open
+        '''
+        return [item for item in api_list if not self.is_open(item["category_name"], item["tool_name"], item["api_name"])]
+
+    def report(self, top_k=10):
+        with self.lock:
+            open_count = self.connection.execute("SELECT COUNT(*) FROM tool_health WHERE opened_until > ?", (time.time(),)).fetchone()[0]
+            total_avoided = self.connection.execute("SELECT COALESCE(SUM(avoided), 0) FROM tool_health").fetchone()[0]
+            rows = self.connection.execute(
+                "SELECT tool_name, api_name, avoided, failures, calls, last_error FROM tool_health WHERE avoided > 0 ORDER BY avoided DESC LIMIT ?", (top_k,)
+            ).fetchall()
+        lines = [f"tool health ({self.path}): {self.avoided} calls avoided in this run, {self.opened} circuits opened, "
+                 f"{open_count} open now, {total_avoided} calls avoided in all runs"]
+        for tool_name, api_name, avoided, failures, calls, last_error in rows:
+            lines.append(f"  {tool_name}.{api_name}: {avoided} avoided, {failures}/{calls} calls failed, {last_error}")
+        return "\n".join(lines)
+
+
+def open_tool_health(args):
+    '''
+    The ToolHealth store args asks for with --tool_health_path, None if not set
+    '''
+    path = getattr(args, "tool_health_path", None)
+    if not path:
+        return None
+    return ToolHealth(
+        path,
+        error_rate=getattr(args, "circuit_error_rate", 0.8),
+        min_calls=getattr(args, "circuit_min_calls", 3),
+        window=getattr(args, "circuit_window", 10),
+        cooldown=getattr(args, "circuit_cooldown", 3600),
+    )
@@ -7,6 +7,7 @@ import backoff
 from typing import Optional
 from toolbench.model.model_adapter import get_conversation_template
 from toolbench.inference.utils import SimpleChatIO, react_parser
+from toolbench.inference.latency import hedged_call
 
 BASE_SYSTEM_MESSAGE = """Answer the following questions as best you can. Specifically, you have access to the following APIs:
 
@@ -65,7 +66,9 @@ CODE_AS_ACTION_SYSTEM_MESSAGE = BASE_SYSTEM_MESSAGE.replace(
     )
 ).replace(
     "{{ACTION_DESC}}",
-    "Code: MUST be executable Python code, you can print out the result of the function call to see the result."
+    "Code: MUST be executable Python code, you can print out the result of the function call to see the result. "
+    "To make several function calls that do not depend on each other, call_parallel([(function_name, {arguments}), ...]) "
+    "makes them at once and returns their results in order."
 ).replace(
     "{{FINISH}}",
     (
@@ -113,7 +116,15 @@ def chat_completion_request(
     messages,
     model="gpt-3.5-turbo-16k-0613",
     stop=None,
+    context=None,
+    call_timeout=None,
+    hedge=False,
     **args):
+    # checked on every retry, TimeoutError is not retried
+    if context is not None and context.should_stop():
+        raise TimeoutError(f"Query stopped: {context.stop_reason}.")
+    if context is not None:
+        call_timeout = context.timeout(call_timeout)
 
     json_data = {
         "model": model,
@@ -126,10 +137,16 @@ def chat_completion_request(
     if stop is not None:
         json_data.update({"stop": stop})
 
-    response = openai.ChatCompletion.create(
-        api_key=key,
-        **json_data,
-    )
+    if call_timeout is not None:
+        json_data["request_timeout"] = max(call_timeout, 1.0)
+
+    try:
+        response = hedged_call(openai.ChatCompletion.create, kwargs=dict(api_key=key, **json_data),
+                               key=f"llm/{model}", timeout=call_timeout, hedge=hedge,
+                               should_stop=context.should_stop if context is not None else None)
+    except TimeoutError as e:
+        # a slow call is retried like one openai gave up on
+        raise openai.error.Timeout(str(e))
     return response["choices"][0]["message"], response["usage"]
 
 FINISH_FUNC_DESC = """If you believe that you have obtained a result that can answer the task, please call this function to provide the final answer (set return_type to \"give_answer\"). Alternatively, if you recognize that you are unable to proceed with the task in the current state, call this function to restart (set return_type to \"give_up_and_restart\"). Remember: you must ALWAYS call this function at the end of your attempt, and the only part that will be shown to the user is the final answer, so it should contain sufficient information"""
@@ -140,11 +157,16 @@ class ChatCompletion:
         model,
         openai_key,
         action_mode = "json_as_action",
+        call_timeout = None,
+        hedge = False,
     ) -> None:
         super().__init__()
         self.model = model
         self.openai_key = openai_key
         self.action_mode = action_mode
+        # seconds one request may take, None for no limit; hedge: duplicate requests slower than the model's p95 latency
+        self.call_timeout = call_timeout
+        self.hedge = hedge
         assert self.action_mode in ["json_as_action", "code_as_action"]
     
     def convert_function_call_message(self, message):
@@ -263,9 +285,13 @@ class ChatCompletion:
         ]
         return messages
 
-    def parse(self,functions,process_id,**args):
+    def parse(self,functions,process_id,context=None,**args):
         messages = self.conversation_history
-        resp, usage = chat_completion_request(self.openai_key, messages, model=self.model)
+        try:
+            resp, usage = chat_completion_request(self.openai_key, messages, model=self.model, context=context,
+                                                  call_timeout=self.call_timeout, hedge=self.hedge)
+        except TimeoutError as e:
+            return {"role": "assistant", "content": str(e)}, -1, 0
         content = resp["content"]
         print(f"RAW Response:\n{content}")
         
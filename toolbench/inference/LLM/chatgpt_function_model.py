@@ -4,10 +4,12 @@ from tenacity import retry, wait_random_exponential, stop_after_attempt
 from termcolor import colored
 import time
 import random
+from toolbench.inference.execution_context import context_sleep
+from toolbench.inference.latency import hedged_call
 
 
 @retry(wait=wait_random_exponential(min=1, max=40), stop=stop_after_attempt(3))
-def chat_completion_request(key, messages, functions=None,function_call=None,key_pos=None, model="gpt-3.5-turbo-16k-0613",stop=None,process_id=0, **args):
+def chat_completion_request(key, messages, functions=None,function_call=None,key_pos=None, model="gpt-3.5-turbo-16k-0613",stop=None,process_id=0, call_timeout=None, hedge=False, should_stop=None, **args):
     use_messages = []
     for message in messages:
         if not("valid" in message.keys() and message["valid"] == False):
@@ -27,15 +29,16 @@ def chat_completion_request(key, messages, functions=None,function_call=None,key
         json_data.update({"functions": functions})
     if function_call is not None:
         json_data.update({"function_call": function_call})
+    if call_timeout is not None:
+        json_data.update({"request_timeout": max(call_timeout, 1.0)})
     
     try:
         if model == "gpt-3.5-turbo-16k-0613":
             openai.api_key = key
         else:
             raise NotImplementedError
-        openai_response = openai.ChatCompletion.create(
-            **json_data,
-        )
+        openai_response = hedged_call(openai.ChatCompletion.create, kwargs=json_data,
+                                      key=f"llm/{model}", timeout=call_timeout, hedge=hedge, should_stop=should_stop)
         json_data = json.loads(str(openai_response))
         return json_data 
 
@@ -45,12 +48,15 @@ def chat_completion_request(key, messages, functions=None,function_call=None,key
         return e
 
 class ChatGPTFunction:
-    def __init__(self, model="gpt-3.5-turbo-16k-0613", openai_key=""):
+    def __init__(self, model="gpt-3.5-turbo-16k-0613", openai_key="", call_timeout=None, hedge=False):
         self.model = model
         self.conversation_history = []
         self.openai_key = openai_key
         self.time = time.time()
         self.TRY_TIME = 6
+        # seconds one request may take, None for no limit; hedge: duplicate requests slower than the model's p95 latency
+        self.call_timeout = call_timeout
+        self.hedge = hedge
 
     def add_message(self, message):
         self.conversation_history.append(message)
@@ -79,19 +85,26 @@ class ChatGPTFunction:
             )
         print("end_print"+"*"*50)
 
-    def parse(self,functions,process_id,key_pos=None,**args):
+    def parse(self,functions,process_id,key_pos=None,context=None,**args):
         self.time = time.time()
         conversation_history = self.conversation_history
+        json_data = None
         for _ in range(self.TRY_TIME):
-            if _ != 0:
-                time.sleep(15)
+            # no more tries, or waiting for them, once the execution context of the query says to stop
+            if (_ != 0 and context_sleep(context, 15)) or (context is not None and context.should_stop()):
+                json_data = f"Query stopped: {context.stop_reason}."
+                break
+            call_timeout = context.timeout(self.call_timeout) if context is not None else self.call_timeout
+            should_stop = context.should_stop if context is not None else None
             if functions != []:
                 json_data = chat_completion_request(
-                    self.openai_key, conversation_history, functions=functions,process_id=process_id, key_pos=key_pos,**args
+                    self.openai_key, conversation_history, functions=functions,process_id=process_id, key_pos=key_pos,
+                    call_timeout=call_timeout, hedge=self.hedge, should_stop=should_stop, **args
                 )
             else:
                 json_data = chat_completion_request(
-                    self.openai_key, conversation_history,process_id=process_id,key_pos=key_pos, **args
+                    self.openai_key, conversation_history,process_id=process_id,key_pos=key_pos,
+                    call_timeout=call_timeout, hedge=self.hedge, should_stop=should_stop, **args
                 )
             try:
                 total_tokens = json_data['usage']['total_tokens']
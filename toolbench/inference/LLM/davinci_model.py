@@ -8,6 +8,7 @@ import openai
 from typing import Optional
 from toolbench.model.model_adapter import get_conversation_template
 from toolbench.inference.utils import SimpleChatIO, react_parser
+from toolbench.inference.execution_context import openai_timeout_args
 from toolbench.inference.Prompts.ReAct_prompts import FORMAT_INSTRUCTIONS_SYSTEM_FUNCTION_ZEROSHOT
 
 
@@ -18,12 +19,17 @@ class Davinci:
         self.openai_key = openai_key
         self.chatio = SimpleChatIO()
 
-    def prediction(self, prompt: str, stop: Optional[List[str]] = None) -> str:
+    def prediction(self, prompt: str, stop: Optional[List[str]] = None, context=None) -> str:
         max_try = 10
         while True:
             openai.api_key = self.openai_key
+            if context is not None and context.should_stop():
+                result = f"Query stopped: {context.stop_reason}."
+                response = {"usage": {"total_tokens": 0}}
+                break
             try:
                 response = openai.Completion.create(
+                    **openai_timeout_args(context),
                     engine=self.model,
                     prompt=prompt,
                     temperature=0.5,
@@ -70,7 +76,7 @@ class Davinci:
             )
         print("end_print"+"*"*50)
 
-    def parse(self,functions,process_id,**args):
+    def parse(self,functions,process_id,context=None,**args):
         conv = get_conversation_template("tool-llama-single-round")
         roles = {"system": conv.roles[0], "user": conv.roles[1], "function": conv.roles[2], "assistant": conv.roles[3]}
         conversation_history = self.conversation_history
@@ -109,9 +115,9 @@ class Davinci:
             elif role == "Function":
                 prompt += f"Observation: {content}\n"
         if functions != []:
-            predictions, usage = self.prediction(prompt)
+            predictions, usage = self.prediction(prompt, context=context)
         else:
-            predictions, usage = self.prediction(prompt)
+            predictions, usage = self.prediction(prompt, context=context)
         
         # react format prediction
         thought, action, action_input = react_parser(predictions)
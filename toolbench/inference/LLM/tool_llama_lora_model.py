@@ -50,7 +50,7 @@ class ToolLLaMALoRA:
             self.model.to(device)
         self.chatio = SimpleChatIO()
 
-    def prediction(self, prompt: str, stop: Optional[List[str]] = None) -> str:
+    def prediction(self, prompt: str, stop: Optional[List[str]] = None, context=None) -> str:
         gen_params = {
             "model": "",
             "prompt": prompt,
@@ -61,7 +61,8 @@ class ToolLLaMALoRA:
             "echo": False
         }
         generate_stream_func = generate_stream
-        output_stream = generate_stream_func(self.model, self.tokenizer, gen_params, "cuda", self.max_sequence_length, force_generate=True)
+        should_stop = context.should_stop if context is not None else None
+        output_stream = generate_stream_func(self.model, self.tokenizer, gen_params, "cuda", self.max_sequence_length, force_generate=True, should_stop=should_stop)
         outputs = self.chatio.return_output(output_stream)
         prediction = outputs.strip()
         return prediction
@@ -93,7 +94,7 @@ class ToolLLaMALoRA:
             )
         print("end_print"+"*"*50)
 
-    def parse(self,functions,process_id,**args):
+    def parse(self,functions,process_id,context=None,**args):
         conv = get_conversation_template(self.template)
         if self.template == "tool-llama":
             roles = {"human": conv.roles[0], "gpt": conv.roles[1]}
@@ -111,9 +112,9 @@ class ToolLLaMALoRA:
             prompt += f"{role}: {content}\n"
         prompt += "Assistant:\n"
         if functions != []:
-            predictions = self.prediction(prompt)
+            predictions = self.prediction(prompt, context=context)
         else:
-            predictions = self.prediction(prompt)
+            predictions = self.prediction(prompt, context=context)
 
         decoded_token_len = len(self.tokenizer(predictions))
         if process_id == 0:
@@ -12,7 +12,8 @@ from transformers import (
 )
 from toolbench.utils import process_system_message
 from toolbench.model.model_adapter import get_conversation_template
-from toolbench.inference.utils import SimpleChatIO, generate_stream, react_parser
+from toolbench.model.compression import load_compress_model, default_compression_config, int4_compression_config
+from toolbench.inference.utils import SimpleChatIO, generate_stream, generate_stream_speculative, generate_batch, SpeculativeStats, react_parser
 
 
 class ToolLLaMA:
@@ -22,40 +23,86 @@ class ToolLLaMA:
             template:str="tool-llama-single-round", 
             device: str="cuda", 
             cpu_offloading: bool=False, 
-            max_sequence_length: int=8192
+            max_sequence_length: int=8192,
+            load_8bit: bool=False,
+            load_4bit: bool=False,
+            draft_model_path: Optional[str]=None,
+            num_draft_tokens: int=5
         ) -> None:
         super().__init__()
         self.model_name = model_name_or_path
         self.template = template
         self.max_sequence_length = max_sequence_length
+        self.device = device
         self.tokenizer = AutoTokenizer.from_pretrained(model_name_or_path, use_fast=False, model_max_length=self.max_sequence_length)
-        self.model = AutoModelForCausalLM.from_pretrained(
-            model_name_or_path, low_cpu_mem_usage=True
-        )
+        if load_8bit or load_4bit:
+            # weight-only quantization, linear weights are quantized while the shards are read
+            compression_config = int4_compression_config if load_4bit else default_compression_config
+            self.model, _ = load_compress_model(
+                model_name_or_path,
+                device="cpu" if cpu_offloading else device,
+                torch_dtype=torch.float16 if device == "cuda" else torch.float32,
+                compression_config=compression_config,
+            )
+        else:
+            self.model = AutoModelForCausalLM.from_pretrained(
+                model_name_or_path, low_cpu_mem_usage=True
+            )
         if self.tokenizer.pad_token_id == None:
             self.tokenizer.add_special_tokens({"bos_token": "<s>", "eos_token": "</s>", "pad_token": "<pad>"})
             self.model.resize_token_embeddings(len(self.tokenizer))
         self.use_gpu = (True if device == "cuda" else False)
         if (device == "cuda" and not cpu_offloading) or device == "mps":
             self.model.to(device)
+        # speculative decoding: "prompt_lookup" drafts by copying spans of the prompt, any other path is a small draft model
+        self.speculative = draft_model_path is not None
+        self.draft_model = None
+        self.num_draft_tokens = num_draft_tokens
+        self.speculative_stats = SpeculativeStats()
+        if self.speculative and draft_model_path != "prompt_lookup":
+            self.draft_model = AutoModelForCausalLM.from_pretrained(
+                draft_model_path, low_cpu_mem_usage=True, torch_dtype=self.model.dtype
+            ).to(self.model.device)
         self.chatio = SimpleChatIO()
 
-    def prediction(self, prompt: str, stop: Optional[List[str]] = None) -> str:
+    gen_params = {
+        "model": "",
+        "temperature": 0.5,
+        "max_new_tokens": 512,
+        "stop": "</s>",
+        "stop_token_ids": None,
+        "echo": False
+    }
+
+    def prediction(self, prompt: str, stop: Optional[List[str]] = None, context=None) -> str:
+        # decoding ends early once the execution context of the query says to stop
+        should_stop = context.should_stop if context is not None else None
         with torch.no_grad():
-            gen_params = {
-                "model": "",
-                "prompt": prompt,
-                "temperature": 0.5,
-                "max_new_tokens": 512,
-                "stop": "</s>",
-                "stop_token_ids": None,
-                "echo": False
-            }
-            generate_stream_func = generate_stream
-            output_stream = generate_stream_func(self.model, self.tokenizer, gen_params, "cuda", self.max_sequence_length, force_generate=True)
+            gen_params = dict(self.gen_params, prompt=prompt)
+            if self.speculative:
+                output_stream = generate_stream_speculative(
+                    self.model, self.tokenizer, gen_params, self.device, self.max_sequence_length,
+                    draft_model=self.draft_model, num_draft_tokens=self.num_draft_tokens,
+                    stats=self.speculative_stats, force_generate=True, should_stop=should_stop
+                )
+            else:
+                generate_stream_func = generate_stream
+                output_stream = generate_stream_func(self.model, self.tokenizer, gen_params, self.device, self.max_sequence_length, force_generate=True, should_stop=should_stop)
             outputs = self.chatio.return_output(output_stream)
             prediction = outputs.strip()
         return prediction
+
+    def prediction_batch(self, prompts: List[str], contexts=None) -> List[str]:
+        if contexts is None:
+            contexts = [None] * len(prompts)
+        if self.speculative or len(prompts) == 1:
+            # speculative decoding verifies one sequence at a time
+            return [self.prediction(prompt, context=context) for prompt, context in zip(prompts, contexts)]
+        should_stop = None
+        if any(context is not None for context in contexts):
+            should_stop = lambda: [context is not None and context.should_stop() for context in contexts]
+        outputs = generate_batch(self.model, self.tokenizer, self.gen_params, prompts, self.device, self.max_sequence_length, force_generate=True, should_stop=should_stop)
+        return [output.strip() for output, _ in outputs]
         
     def add_message(self, message):
         self.conversation_history.append(message)
@@ -84,15 +131,13 @@ class ToolLLaMA:
             )
         print("end_print"+"*"*50)
 
-    def parse(self, functions, process_id, **args):
+    def build_prompt(self, conversation_history, functions):
         conv = get_conversation_template(self.template)
         if self.template == "tool-llama":
             roles = {"human": conv.roles[0], "gpt": conv.roles[1]}
         elif self.template == "tool-llama-single-round" or self.template == "tool-llama-multi-rounds":
             roles = {"system": conv.roles[0], "user": conv.roles[1], "function": conv.roles[2], "assistant": conv.roles[3]}
 
-        self.time = time.time()
-        conversation_history = self.conversation_history
         prompt = ''
         for message in conversation_history:
             role = roles[message['role']]
@@ -101,15 +146,28 @@ class ToolLLaMA:
                 content = process_system_message(content, functions)
             prompt += f"{role}: {content}\n"
         prompt += "Assistant:\n"
-        
-        if functions != []:
-            predictions = self.prediction(prompt)
-        else:
-            predictions = self.prediction(prompt)
+        return prompt
+
+    def parse(self, functions, process_id, context=None, **args):
+        self.time = time.time()
+        prompt = self.build_prompt(self.conversation_history, functions)
+        predictions = self.prediction(prompt, context=context)
+        return self.parse_prediction(predictions, process_id)
+
+    def parse_batch(self, conversations, functions_list, process_id, contexts=None, **args):
+        """parse for several conversations at once, they are decoded as one batch. contexts: execution context of each, or None"""
+        self.time = time.time()
+        prompts = [self.build_prompt(conversation_history, functions) for conversation_history, functions in zip(conversations, functions_list)]
+        if process_id == 0:
+            print(f"[process({process_id})]decoding a batch of {len(prompts)}")
+        return [self.parse_prediction(predictions, process_id) for predictions in self.prediction_batch(prompts, contexts)]
 
+    def parse_prediction(self, predictions, process_id):
         decoded_token_len = len(self.tokenizer(predictions))
         if process_id == 0:
             print(f"[process({process_id})]total tokens: {decoded_token_len}")
+            if self.speculative:
+                print(f"[process({process_id})]speculative decoding: {self.speculative_stats}")
 
         # react format prediction
         thought, action, action_input = react_parser(predictions)
@@ -4,18 +4,32 @@ Evaluate the score of a query corresponding to different candidates
 
 from Prompts.rank_prompts import LLM_PAIRWISE_RANK_SUBFIX_SYSTEM_PROMPT, LLM_PAIRWISE_RANK_USER_PROMPT
 import random
+import inspect
 from Tree.Tree import tree_node
+from Algorithms.scheduler import SearchTask, LLMCall
 
 
 def rank2symmetry(llm_interface, LLM_rank_args, cand1,cand2):
     '''
     Use llm to compare the height, due to the sequence, you need to compare each of the two in the front
     '''
+    return SearchTask(rank2symmetry_steps(llm_interface, LLM_rank_args, cand1, cand2)).run()
+
+def rank2symmetry_steps(llm_interface, LLM_rank_args, cand1,cand2):
+    '''
+    rank2symmetry as a generator of LLM requests (see Algorithms/scheduler.py), rank_func may be either form
+    '''
     single_rank_func = LLM_rank_args["rank_func"]
     score = [0,0]
-    bigger1,query_count1, total_tokens1 = single_rank_func(llm_interface, LLM_rank_args, cand1,cand2)
+    outcome = single_rank_func(llm_interface, LLM_rank_args, cand1,cand2)
+    if inspect.isgenerator(outcome):
+        outcome = yield outcome
+    bigger1,query_count1, total_tokens1 = outcome
     score[1 - bigger1] += 1
-    bigger2,query_count2, total_tokens2 = single_rank_func(llm_interface, LLM_rank_args, cand2,cand1)
+    outcome = single_rank_func(llm_interface, LLM_rank_args, cand2,cand1)
+    if inspect.isgenerator(outcome):
+        outcome = yield outcome
+    bigger2,query_count2, total_tokens2 = outcome
     score[bigger2] += 1
     if score[0] > score[1]:
         return 1 , query_count1 + query_count2, total_tokens1 + total_tokens2
@@ -30,6 +44,12 @@ def rank2_subfix(llm_interface,LLM_rank_args, cand1,cand2):
     '''
     Assumed that the two candidates have a long common prefix
     '''
+    return SearchTask(rank2_subfix_steps(llm_interface, LLM_rank_args, cand1, cand2)).run()
+
+def rank2_subfix_steps(llm_interface,LLM_rank_args, cand1,cand2):
+    '''
+    rank2_subfix as a generator of LLM requests
+    '''
     anscestor_interesction = tree_node.find_ancestor_intersection(cand1,cand2)
     assert anscestor_interesction != None
     intersect_trice = anscestor_interesction.get_former_trice_from_this_node(end_node=None)
@@ -41,10 +61,12 @@ def rank2_subfix(llm_interface,LLM_rank_args, cand1,cand2):
     system_message = system_message.replace("{intersect_trice}", intersect_trice)
     system_message = system_message.replace("{candidate_A}",trice_1)
     system_message = system_message.replace("{candidate_B}",trice_2)
-    llm_interface.change_messages([{"role":"system","content":system_message},
-                                   {"role":"user","content":LLM_PAIRWISE_RANK_USER_PROMPT},
-                                   ])
-    output,error_code, total_tokens = llm_interface.parse(functions=LLM_rank_args["functions"],function_call="none",process_id=LLM_rank_args["process_id"])
+    output,error_code, total_tokens = yield LLMCall(llm_interface,
+                                                    [{"role":"system","content":system_message},
+                                                     {"role":"user","content":LLM_PAIRWISE_RANK_USER_PROMPT},
+                                                     ],
+                                                    functions=LLM_rank_args["functions"],process_id=LLM_rank_args["process_id"],
+                                                    context=LLM_rank_args.get("context"),function_call="none")
     if output["content"].strip().lower()[-1] == "a":
         return 1, 1, total_tokens
     else:
@@ -54,12 +76,22 @@ def sum_based_rankn(llm_interface,LLM_rank_args, candidates):
     '''
     All pairs are sorted pairwise, sum the total points, and choose the best
     '''
+    return SearchTask(sum_based_rankn_steps(llm_interface, LLM_rank_args, candidates)).run()
+
+def sum_based_rankn_steps(llm_interface,LLM_rank_args, candidates):
+    '''
+    sum_based_rankn as a generator of LLM requests.
+    Once the execution context in LLM_rank_args, if any, says to stop, the remaining pairs are not compared
+    '''
+    context = LLM_rank_args.get("context")
     total_querys = 0
     total_tokens = 0
     scores = [0]*len(candidates)
     for i in range(len(candidates)-1):
         for j in range(i+1,len(candidates)):
-            pairwise_rank,query_count,rank2_tokens = rank2symmetry(llm_interface,LLM_rank_args, candidates[i],candidates[j])
+            if context is not None and context.should_stop():
+                return scores, total_querys, total_tokens
+            pairwise_rank,query_count,rank2_tokens = yield rank2symmetry_steps(llm_interface,LLM_rank_args, candidates[i],candidates[j])
             total_querys += query_count
             total_tokens += rank2_tokens
             if pairwise_rank > 0:
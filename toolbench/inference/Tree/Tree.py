@@ -1,6 +1,5 @@
 from termcolor import colored
 import numpy as np
-from copy import deepcopy
 from utils import softmax_bias
 import math
 
@@ -33,7 +32,15 @@ class tree_node:
         self.observation_code = None
         self.children = []
 
-        self.father = None
+        # tree bookkeeping, kept up to date when `father` is assigned
+        self._father = None
+        self.depth = 0
+        self.ancestors = [] # ancestors[i] is the 2**i-th ancestor, for O(log d) ancestor queries
+        self.size = 1 # nodes in the subtree, including itself
+        self.height = 1 # depth of the subtree, including itself
+        self.stats_dirty = False # size/height are stale; a dirty node always has dirty ancestors
+        self.trace_fragments = None # cached get_trace_fragments result
+        self.trace_cache = None # last get_former_trice_from_this_node result, with the fragments it was built from
 
 
         self.io_state = None
@@ -54,36 +61,93 @@ class tree_node:
         '''
         return 0.0
 
+    @property
+    def father(self):
+        return self._father
+
+    @father.setter
+    def father(self, father):
+        '''
+        Attach to `father`: index depth and ancestors of the subtree, mark the sizes and heights above as stale
+        '''
+        old_father = self._father
+        self._father = father
+        # a freshly created node is a leaf, larger subtrees are re-indexed top down
+        stack = [self]
+        while len(stack) > 0:
+            node = stack.pop()
+            node.depth = 0 if node._father is None else node._father.depth + 1
+            node.ancestors = []
+            ancestor = node._father
+            while ancestor is not None:
+                node.ancestors.append(ancestor)
+                i = len(node.ancestors) - 1
+                ancestor = ancestor.ancestors[i] if i < len(ancestor.ancestors) else None
+            stack.extend(node.children)
+        for node in (old_father, father):
+            # stop at the first dirty ancestor, everything above it is dirty already
+            while node is not None and not node.stats_dirty:
+                node.stats_dirty = True
+                node = node._father
+
+    def update_stats(self):
+        '''
+        Recompute size/height of the dirty part of this subtree, bottom up
+        '''
+        order = []
+        stack = [self]
+        while len(stack) > 0:
+            node = stack.pop()
+            if node.stats_dirty:
+                order.append(node)
+                stack.extend(node.children)
+        for node in reversed(order):
+            node.size = 1 + sum(child.size for child in node.children)
+            node.height = 1 + max((child.height for child in node.children), default=0)
+            node.stats_dirty = False
+
     def get_max_depth(self):
         '''
         maximum depth of subtrees including self
         '''
-        max_depth = 0
-        for child in self.children:
-            max_depth = max(max_depth,child.get_max_depth())
-        return max_depth + 1
+        if self.stats_dirty:
+            self.update_stats()
+        return self.height
 
     def get_depth(self):
-        if self.father == None:
-            return 0
-        return self.father.get_depth() + 1
+        return self.depth
+
+    def get_ancestor(self, depth):
+        '''
+        the ancestor at `depth` (self if it is that deep), by jumping powers of two
+        '''
+        node = self
+        distance = node.depth - depth
+        i = 0
+        while distance > 0:
+            if distance & 1:
+                node = node.ancestors[i]
+            distance >>= 1
+            i += 1
+        return node
 
     def get_size(self):
         '''
         subtree, including itself
         '''
-        size = 1
-        for child in self.children:
-            size += child.get_size()
-        return size
+        if self.stats_dirty:
+            self.update_stats()
+        return self.size
     
     def prune(self):
         '''
         pruning off the subtree
         '''
-        self.pruned = True
-        for child in self.children:
-            child.prune()
+        stack = [self]
+        while len(stack) > 0:
+            node = stack.pop()
+            node.pruned = True
+            stack.extend(node.children)
 
     def print(self,process_id = 0):
         if process_id != 0:
@@ -111,22 +175,36 @@ class tree_node:
         '''
         if node1 == None or node2 == None:
             return None
+        depth = min(node1.depth, node2.depth)
+        node1 = node1.get_ancestor(depth)
+        node2 = node2.get_ancestor(depth)
         if node1 == node2:
             return node1
-        length1 = node1.get_depth()
-        length2 = node2.get_depth()
-        if length1 > length2:
-            return tree_node.find_ancestor_intersection(node1.father,node2)
-        else:
-            return tree_node.find_ancestor_intersection(node1, node2.father)
+        for i in range(len(node1.ancestors) - 1, -1, -1):
+            if i < len(node1.ancestors) and node1.ancestors[i] is not node2.ancestors[i]:
+                node1 = node1.ancestors[i]
+                node2 = node2.ancestors[i]
+        if node1.father is None or node1.father is not node2.father:
+            # different trees
+            return None
+        return node1.father
 
     
 
     def to_json_recursive(self,use_messages=False):
+        '''
+        only self carries messages, like the nested calls always did
+        '''
         js_obj = self.to_json(use_messages=use_messages)
         js_obj["children"] = []
-        for child in self.children:
-            js_obj["children"].append(child.to_json_recursive())
+        stack = [(self, js_obj)]
+        while len(stack) > 0:
+            node, node_obj = stack.pop()
+            for child in node.children:
+                child_obj = child.to_json()
+                child_obj["children"] = []
+                node_obj["children"].append(child_obj)
+                stack.append((child, child_obj))
         return js_obj
 
 
@@ -141,39 +219,52 @@ class tree_node:
             self.father.make_finish(inter_val)
 
 
-    def get_train_messages_from_this_node(self):
+    def get_train_messages(self):
         '''
-        Returns chained results, starting from this node up to the root node
+        Returns the training conversation ending at this node, or None if this node does not end one.
+        Trailing messages that the model did not produce are dropped, and of the invalid messages only the last one is kept.
+        The message dicts are shared with self.messages, not copied
         '''
-        def sift_first_invalid_message(messages):
-            use_messages = []
-            flag = True
-            for message_id in range(len(messages))[::-1]:
-                if not ("valid" in messages[message_id].keys() and messages[message_id]["valid"] == False):
-                    use_messages = [messages[message_id]] + use_messages
-                elif flag:
-                    flag = False
-                    use_messages = [messages[message_id]] + use_messages
-            return use_messages
+        messages = self.messages
+        end = len(messages)
+        if self.node_type == "Action Input" or self.node_type == "Code Action":
+            while end > 0 and messages[end-1]["role"] != "assistant":
+                end -= 1
+        elif self.node_type == "Thought":
+            while end > 0 and messages[end-1]["role"] == "user":
+                end -= 1
+            if end > 0 and messages[end-1]["role"] != "assistant":
+                return None
+        else:
+            return None
+        if end == 0:
+            return None
+
+        last_invalid = end - 1
+        while last_invalid >= 0 and messages[last_invalid].get("valid", True) != False:
+            last_invalid -= 1
+        return [message for message_id, message in enumerate(messages[:end])
+                if message.get("valid", True) != False or message_id == last_invalid]
 
+    def iter_train_messages_from_this_node(self):
+        '''
+        Yields the training conversations from the root node down to this node, one per step, computing each only when asked for
+        '''
+        path = []
         now_node = self
-        result = []
         while now_node.father != None:
-            if now_node.node_type == "Action Input" or now_node.node_type == "Code Action":
-                use_messages = deepcopy(now_node.messages)
-                while use_messages[-1]["role"] != "assistant":
-                    use_messages = use_messages[:-1]
-                use_messages = sift_first_invalid_message(use_messages)
-                result = [use_messages] + result
-            elif now_node.node_type == "Thought":
-                use_messages = deepcopy(now_node.messages)
-                while use_messages[-1]["role"] == "user":
-                    use_messages = use_messages[:-1]
-                use_messages = sift_first_invalid_message(use_messages)
-                if use_messages[-1]["role"] == "assistant":
-                    result = [use_messages] + result
+            path.append(now_node)
             now_node = now_node.father
-        return result
+        for now_node in reversed(path):
+            use_messages = now_node.get_train_messages()
+            if use_messages is not None:
+                yield use_messages
+
+    def get_train_messages_from_this_node(self):
+        '''
+        Returns chained results, starting from this node up to the root node
+        '''
+        return list(self.iter_train_messages_from_this_node())
 
     def get_chain_result_from_this_node(self,use_messages=False):
         '''
@@ -192,28 +283,50 @@ class tree_node:
         Does not contain end_node, never contains root node
         '''
         node = self
-        output_str_list = []
+        path_fragments = []
 
         while node != end_node and node.father != None:
-            now_node_des_list = []
-            if node.node_type in valid_types:
-                now_node_des_list.append(f"{node.node_type}: {node.description}\n")
-            if node.observation != "" and "Observation" in valid_types:
-                tuncated = node.observation
-                if len(node.observation) > 1024:
-                    tuncated = node.observation[:1024] + f"...(len={len(node.observation)})"
-                now_node_des_list.append(f"Observation: {tuncated}\n")
-            output_str_list = now_node_des_list + output_str_list
+            path_fragments.append(node.get_trace_fragments(valid_types))
             node = node.father
-        
-        now_str = ""
-        for k, cont in enumerate(output_str_list):
-            now_str += f"step_{k+1}: {cont}\n"
+
+        # rank2_subfix asks for the same traces over and over, reuse the string while no node on the path changed
+        cached = self.trace_cache
+        if (
+            cached is not None
+            and cached[0] == valid_types
+            and cached[1] is end_node
+            and len(cached[2]) == len(path_fragments)
+            and all(a is b for a, b in zip(cached[2], path_fragments))
+        ):
+            return cached[3]
+
+        output_str_list = [cont for fragments in reversed(path_fragments) for cont in fragments]
+        now_str = "".join(f"step_{k+1}: {cont}\n" for k, cont in enumerate(output_str_list))
 
         if now_str == "":
             now_str = "None"
+        self.trace_cache = (list(valid_types), end_node, path_fragments, now_str)
         return now_str
 
+    def get_trace_fragments(self, valid_types):
+        '''
+        This node's lines of get_former_trice_from_this_node, cached until its content changes
+        '''
+        key = (tuple(valid_types), self.node_type, self.description, self.observation)
+        cached = self.trace_fragments
+        if cached is not None and cached[0][0] == key[0] and all(a is b for a, b in zip(cached[0][1:], key[1:])):
+            return cached[1]
+        now_node_des_list = []
+        if self.node_type in valid_types:
+            now_node_des_list.append(f"{self.node_type}: {self.description}\n")
+        if self.observation != "" and "Observation" in valid_types:
+            tuncated = self.observation
+            if len(self.observation) > 1024:
+                tuncated = self.observation[:1024] + f"...(len={len(self.observation)})"
+            now_node_des_list.append(f"Observation: {tuncated}\n")
+        self.trace_fragments = (key, now_node_des_list)
+        return now_node_des_list
+
     def to_json(self, use_messages=False):
         
         json_obj = {}
@@ -221,7 +334,7 @@ class tree_node:
         json_obj["pruned"] = self.pruned
         json_obj["finished"] = self.finished
 
-        json_obj["depth"] = self.get_depth()
+        json_obj["depth"] = self.depth
         json_obj["node_type"] = self.node_type
         json_obj["description"] = self.description
         json_obj["Elo"] = self.Elo
@@ -0,0 +1,114 @@
+'''
+Benchmark tree_node bookkeeping on synthetic 10k-node trees, against the naive walks it replaces.
+
+Usage (from toolbench/inference):
+python -m Tree.benchmark_tree --num_nodes 10000
+'''
+import argparse
+import random
+import time
+
+from Tree.Tree import tree_node
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--num_nodes', type=int, default=10000, required=False, help='Nodes per synthetic tree.')
+parser.add_argument('--num_queries', type=int, default=2000, required=False, help='Random node pairs per query benchmark.')
+parser.add_argument('--seed', type=int, default=0, required=False, help='Random seed.')
+
+
+def build_tree(num_nodes, branching):
+    '''
+    Random tree in DFS growth order: every new node hangs below one of the `branching` most recent nodes
+    '''
+    node_types = ["Thought", "Action", "Action Input"]
+    root = tree_node()
+    nodes = [root]
+    for i in range(1, num_nodes):
+        node = tree_node()
+        node.node_type = node_types[i % 3]
+        node.description = f"description of node {i}"
+        if node.node_type == "Action Input":
+            # real observations are often longer than the 1024 characters a trace keeps
+            node.observation = f"observation of node {i} " * 100
+        father = nodes[-random.randint(1, min(branching, len(nodes)))]
+        node.father = father
+        father.children.append(node)
+        nodes.append(node)
+    return nodes
+
+
+def naive_depth(node):
+    depth = 0
+    while node.father is not None:
+        node = node.father
+        depth += 1
+    return depth
+
+
+def naive_intersection(node1, node2):
+    # parent walks with both depths computed once; the previous recursion recomputed them
+    # at every level (O(d^2)) and overflowed the stack on deep trees
+    depth1 = naive_depth(node1)
+    depth2 = naive_depth(node2)
+    while node1 != node2:
+        if depth1 > depth2:
+            node1 = node1.father
+            depth1 -= 1
+        else:
+            node2 = node2.father
+            depth2 -= 1
+    return node1
+
+
+def naive_size_and_height(root):
+    sizes = {}
+    heights = {}
+    order = []
+    stack = [root]
+    while len(stack) > 0:
+        node = stack.pop()
+        order.append(node)
+        stack.extend(node.children)
+    for node in reversed(order):
+        sizes[node] = 1 + sum(sizes[child] for child in node.children)
+        heights[node] = 1 + max((heights[child] for child in node.children), default=0)
+    return sizes[root], heights[root]
+
+
+def cold_traces(nodes, leaves):
+    for node in nodes:
+        node.trace_fragments = None
+        node.trace_cache = None
+    return [leaf.get_former_trice_from_this_node() for leaf in leaves]
+
+
+def timed(name, baseline, optimized):
+    start = time.perf_counter()
+    expected = baseline()
+    baseline_time = time.perf_counter() - start
+    start = time.perf_counter()
+    result = optimized()
+    optimized_time = time.perf_counter() - start
+    assert result == expected, f"{name}: results differ"
+    print(f"  {name}: {baseline_time * 1000:.1f}ms -> {optimized_time * 1000:.1f}ms ({baseline_time / max(optimized_time, 1e-9):.1f}x)")
+
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    random.seed(args.seed)
+    for name, branching in [("bushy", 50), ("deep", 3)]:
+        start = time.perf_counter()
+        nodes = build_tree(args.num_nodes, branching)
+        build_time = time.perf_counter() - start
+        root = nodes[0]
+        print(f"{name} tree: {len(nodes)} nodes, built in {build_time * 1000:.1f}ms")
+        pairs = [(random.choice(nodes), random.choice(nodes)) for _ in range(args.num_queries)]
+        leaves = [node for node in nodes if len(node.children) == 0][:200]
+
+        timed("depth of every node", lambda: [naive_depth(node) for node in nodes], lambda: [node.get_depth() for node in nodes])
+        timed("ancestor intersection", lambda: [naive_intersection(a, b) for a, b in pairs], lambda: [tree_node.find_ancestor_intersection(a, b) for a, b in pairs])
+        # the first query after building pays for the stale part of the tree, later ones are free
+        timed("size and height, first query", lambda: naive_size_and_height(root), lambda: (root.get_size(), root.get_max_depth()))
+        timed("size and height, again", lambda: naive_size_and_height(root), lambda: (root.get_size(), root.get_max_depth()))
+        # repeated rank2_subfix calls rebuild traces of the same nodes, which the trace caches serve
+        timed("leaf traces (cold vs cached)", lambda: cold_traces(nodes, leaves), lambda: [leaf.get_former_trice_from_this_node() for leaf in leaves])
@@ -0,0 +1,72 @@
+"""
+Microbenchmark of generate_stream decoding speed on a tiny, randomly initialized Llama.
+
+Usage:
+python -m toolbench.inference.benchmark_generate_stream --tokenizer_path huggyllama/llama-7b --device cpu
+"""
+import argparse
+import time
+
+import torch
+from transformers import AutoTokenizer, LlamaConfig, LlamaForCausalLM
+
+from toolbench.inference.utils import generate_stream
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--tokenizer_path', type=str, default="huggyllama/llama-7b", required=False, help='Tokenizer used to encode the prompt, its vocabulary sizes the model.')
+parser.add_argument('--device', type=str, default="cpu", required=False, help='Device to run the model on.')
+parser.add_argument('--hidden_size', type=int, default=64, required=False, help='Hidden size of the tiny model.')
+parser.add_argument('--num_hidden_layers', type=int, default=2, required=False, help='Number of layers of the tiny model.')
+parser.add_argument('--num_attention_heads', type=int, default=4, required=False, help='Number of attention heads of the tiny model.')
+parser.add_argument('--prompt_tokens', type=int, default=128, required=False, help='Approximate prompt length in tokens.')
+parser.add_argument('--max_new_tokens', type=int, default=256, required=False, help='Tokens generated per run.')
+parser.add_argument('--stream_interval', type=int, default=2, required=False, help='Host sync interval of generate_stream.')
+parser.add_argument('--runs', type=int, default=5, required=False, help='Timed runs per setting, after one warmup run.')
+
+
+def benchmark(model, tokenizer, gen_params, device, stream_interval, runs):
+    def run():
+        for outputs in generate_stream(model, tokenizer, dict(gen_params), device, stream_interval=stream_interval, force_generate=True):
+            pass
+        return outputs["usage"]["completion_tokens"] + 1
+
+    run()
+    num_tokens = 0
+    start = time.perf_counter()
+    for _ in range(runs):
+        num_tokens += run()
+    return num_tokens / (time.perf_counter() - start)
+
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    torch.manual_seed(0)
+    tokenizer = AutoTokenizer.from_pretrained(args.tokenizer_path, use_fast=False)
+    config = LlamaConfig(
+        vocab_size=len(tokenizer),
+        hidden_size=args.hidden_size,
+        intermediate_size=args.hidden_size * 8 // 3,
+        num_hidden_layers=args.num_hidden_layers,
+        num_attention_heads=args.num_attention_heads,
+    )
+    model = LlamaForCausalLM(config).to(args.device).eval()
+    # never emit eos, so every run decodes exactly max_new_tokens tokens
+    eos = torch.tensor([tokenizer.eos_token_id], device=args.device)
+    model.lm_head.register_forward_hook(lambda module, inputs, logits: logits.index_fill_(-1, eos, -float("inf")))
+
+    prompt = " ".join(["hello world"] * (args.prompt_tokens // 2))
+    settings = {
+        "greedy": {"temperature": 0.0},
+        "sample": {"temperature": 0.5},
+        "sample + repetition penalty + top-p/k": {"temperature": 0.5, "repetition_penalty": 1.2, "top_p": 0.9, "top_k": 50},
+    }
+    for name, sampling in settings.items():
+        gen_params = {
+            "prompt": prompt,
+            "max_new_tokens": args.max_new_tokens,
+            "stop": "</s>",
+            "echo": False,
+            **sampling,
+        }
+        tokens_per_second = benchmark(model, tokenizer, gen_params, args.device, args.stream_interval, args.runs)
+        print(f"{name}: {tokens_per_second:.1f} tokens/s")
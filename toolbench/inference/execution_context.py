@@ -0,0 +1,141 @@
+'''
+Per-query execution context: a deadline, a token budget and a cancel flag.
+
+The searches check it before every LLM and tool request and stop the way they stop on max_query_count,
+the LLM backends stop decoding or retrying once it says so, and the environment bounds its api calls by
+the time left. A query whose context stopped still finishes normally and writes out what it found so far.
+'''
+import threading
+import time
+import weakref
+
+
+class ExecutionContext:
+    """Budget of one query, shared by everything working on it, including deepcopies of its environment"""
+
+    def __init__(self, timeout=None, max_tokens=None):
+        """timeout: wall-clock seconds from now, max_tokens: total tokens of all the query's LLM calls. None for no limit"""
+        self.deadline = time.monotonic() + timeout if timeout else None
+        self.max_tokens = max_tokens if max_tokens else None
+        self.total_tokens = 0
+        self.cancel_event = threading.Event()
+        self.stop_reason = None
+        self.parent = None
+        self.children = weakref.WeakSet()
+
+    def __deepcopy__(self, memo):
+        return self
+
+    def __copy__(self):
+        return self
+
+    def child(self):
+        '''
+        Context of a part of the query that can be cancelled on its own, e.g. one try of CoT@n: it has the same
+        deadline, spends the same token budget and stops when this one does, but cancelling it leaves this one running
+        '''
+        child = ExecutionContext()
+        child.parent = self
+        child.deadline = self.deadline
+        self.children.add(child)
+        if self.cancel_event.is_set():
+            child.cancel(self.stop_reason)
+        return child
+
+    def cancel(self, reason="cancelled"):
+        if self.stop_reason is None:
+            self.stop_reason = reason
+        self.cancel_event.set()
+        for child in list(self.children):
+            child.cancel(reason)
+
+    def add_tokens(self, total_tokens):
+        self.total_tokens += total_tokens
+        if self.parent is not None:
+            self.parent.add_tokens(total_tokens)
+
+    def should_stop(self):
+        if self.cancel_event.is_set():
+            return True
+        if self.parent is not None and self.parent.should_stop():
+            self.cancel(self.parent.stop_reason)
+            return True
+        if self.deadline is not None and time.monotonic() >= self.deadline:
+            self.cancel("timeout")
+            return True
+        if self.max_tokens is not None and self.total_tokens >= self.max_tokens:
+            self.cancel("token budget")
+            return True
+        return False
+
+    def remaining_time(self):
+        '''
+        Seconds left before the deadline, None if there is none
+        '''
+        if self.deadline is None:
+            return None
+        return max(self.deadline - time.monotonic(), 0.0)
+
+    def timeout(self, default=None):
+        '''
+        Timeout for a blocking call: default, shortened to the time left
+        '''
+        remaining = self.remaining_time()
+        if remaining is None:
+            return default
+        if default is None:
+            return remaining
+        return min(default, remaining)
+
+    def sleep(self, seconds):
+        '''
+        time.sleep that wakes up early on cancel or at the deadline, returns should_stop()
+        '''
+        self.cancel_event.wait(self.timeout(seconds))
+        return self.should_stop()
+
+
+def context_sleep(context, seconds):
+    '''
+    Sleep, bounded by context if there is one. Returns whether the query should stop
+    '''
+    if context is None:
+        time.sleep(seconds)
+        return False
+    return context.sleep(seconds)
+
+
+def call_with_timeout(func, args=(), timeout=None):
+    '''
+    func(*args), raises TimeoutError if it has not returned within timeout seconds.
+
+    Python threads cannot be killed, so a call that timed out keeps running in a daemon thread
+    and its result is thrown away; what matters is that the caller is free again.
+    '''
+    if timeout is None:
+        return func(*args)
+    outcome = {}
+
+    def target():
+        try:
+            outcome["result"] = func(*args)
+        except BaseException as e:
+            outcome["error"] = e
+
+    thread = threading.Thread(target=target, daemon=True)
+    thread.start()
+    thread.join(timeout)
+    if thread.is_alive():
+        raise TimeoutError(f"no response within {timeout:.1f}s")
+    if "error" in outcome:
+        raise outcome["error"]
+    return outcome["result"]
+
+
+def openai_timeout_args(context):
+    '''
+    request_timeout argument of an openai create call, limited to the time the query has left
+    '''
+    if context is None or context.remaining_time() is None:
+        return {}
+    return {"request_timeout": max(context.remaining_time(), 1.0)}
@@ -0,0 +1,183 @@
+'''
+Pooled HTTP sessions, shared by every thread of the process.
+
+requests.post opens a fresh connection for every call; at a few hundred calls per second the TCP and TLS
+handshakes and the sockets left in TIME_WAIT cost more than the calls themselves. A PooledSession keeps up to
+pool_size connections per host alive, and counts per host how many requests it made over how many connections.
+
+get_session() is the session rapidapi_wrapper sends its service requests with. tool_session() is the one the
+toolenv api.py modules are bound to: they call the bare requests.get, without a timeout, and there are thousands
+of them, so instead of regenerating them bind_session replaces the `requests` of a tool module, as it is loaded,
+with a stand-in whose calls go through the session, with its default timeout and retries.
+'''
+import threading
+from http.cookiejar import DefaultCookiePolicy
+from urllib.parse import urlparse
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+
+class CountingAdapter(HTTPAdapter):
+    """HTTPAdapter counting the requests it sends and the connections its pools opened, per host"""
+
+    def __init__(self, *args, **kwargs):
+        self.lock = threading.Lock()
+        self.local = threading.local() # the pool of the request being sent by this thread
+        self.host_stats = {} # host -> {"requests": n, "pools": {id(pool): connections opened}}
+        super().__init__(*args, **kwargs)
+
+    def get_connection(self, url, proxies=None):
+        # requests < 2.32
+        self.local.pool = super().get_connection(url, proxies)
+        return self.local.pool
+
+    def get_connection_with_tls_context(self, request, verify, proxies=None, cert=None):
+        self.local.pool = super().get_connection_with_tls_context(request, verify, proxies=proxies, cert=cert)
+        return self.local.pool
+
+    def send(self, request, **kwargs):
+        self.local.pool = None
+        try:
+            return super().send(request, **kwargs)
+        finally:
+            pool = self.local.pool
+            with self.lock:
+                stats = self.host_stats.setdefault(urlparse(request.url).netloc, {"requests": 0, "pools": {}})
+                stats["requests"] += 1
+                if pool is not None:
+                    # a pool evicted and created again for the same host starts counting anew
+                    stats["pools"][id(pool)] = pool.num_connections
+
+    def connection_counts(self):
+        '''
+        host -> (requests, connections opened)
+        '''
+        with self.lock:
+            return {host: (stats["requests"], sum(stats["pools"].values())) for host, stats in self.host_stats.items()}
+
+
+class PooledSession(requests.Session):
+    """requests.Session with pool_size keep-alive connections per host, a default timeout and retries of failed connections.
+
+    It keeps no cookies: the session is shared by every query and api key of the process, a cookie one api sets
+    must not be sent along with the calls of the others. Cookies passed to a request are still sent with it.
+    """
+
+    def __init__(self, pool_size=64, timeout=None, retries=0):
+        '''
+        timeout: seconds of requests made without one, or (connect, read) seconds as in requests, None for no limit
+        retries: attempts after a connection error or a 502/503/504 answer to an idempotent request
+        '''
+        super().__init__()
+        self.cookies.set_policy(DefaultCookiePolicy(allowed_domains=[]))
+        self.timeout = timeout
+        max_retries = Retry(total=retries, backoff_factor=0.5, status_forcelist=(502, 503, 504), raise_on_status=False) if retries > 0 else 0
+        self.adapter = CountingAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=max_retries)
+        self.mount("http://", self.adapter)
+        self.mount("https://", self.adapter)
+
+    def request(self, method, url, **kwargs):
+        if kwargs.get("timeout") is None:
+            kwargs["timeout"] = self.timeout
+        return super().request(method, url, **kwargs)
+
+    def report(self, name="http session"):
+        counts = self.adapter.connection_counts()
+        lines = [f"{name}: requests / connections opened / reused"]
+        for host, (request_count, connection_count) in sorted(counts.items(), key=lambda item: -item[1][0]):
+            reuse = 1 - connection_count / request_count if request_count > 0 else 0
+            lines.append(f"  {host}: {request_count} / {connection_count} / {reuse:.0%}")
+        return "\n".join(lines)
+
+
+class SessionRequests:
+    """Stands in for the requests module inside a tool module: its calls go through session, any other name is the real requests"""
+
+    def __init__(self, session):
+        self.session = session
+
+    def request(self, method, url, **kwargs):
+        return self.session.request(method, url, **kwargs)
+
+    def get(self, url, params=None, **kwargs):
+        return self.session.get(url, params=params, **kwargs)
+
+    def post(self, url, data=None, json=None, **kwargs):
+        return self.session.post(url, data=data, json=json, **kwargs)
+
+    def put(self, url, data=None, **kwargs):
+        return self.session.put(url, data=data, **kwargs)
+
+    def patch(self, url, data=None, **kwargs):
+        return self.session.patch(url, data=data, **kwargs)
+
+    def delete(self, url, **kwargs):
+        return self.session.delete(url, **kwargs)
+
+    def head(self, url, **kwargs):
+        return self.session.head(url, **kwargs)
+
+    def options(self, url, **kwargs):
+        return self.session.options(url, **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(requests, name)
+
+
+def bind_session(module, session):
+    '''
+    Make the requests calls of module go through session. Modules that do not use requests are left alone
+    '''
+    if getattr(module, "requests", None) is requests:
+        module.requests = SessionRequests(session)
+    return module
+
+
+_session = None
+_tool_session = None
+_tool_session_args = {"pool_size": 64, "timeout": 30, "retries": 2}
+_lock = threading.Lock()
+
+
+def get_session(pool_size=64):
+    '''
+    The session of this process, created on first use with pool_size connections per host
+    '''
+    global _session
+    if _session is None:
+        with _lock:
+            if _session is None:
+                _session = PooledSession(pool_size=pool_size)
+    return _session
+
+
+def configure_tool_session(pool_size=64, timeout=30, retries=2):
+    '''
+    Settings of tool_session(), to call before the first tool module is loaded
+    '''
+    global _tool_session
+    with _lock:
+        _tool_session_args.update(pool_size=pool_size, timeout=timeout, retries=retries)
+        _tool_session = None
+
+
+def tool_session():
+    '''
+    The session the tool modules of this process are bound to
+    '''
+    global _tool_session
+    if _tool_session is None:
+        with _lock:
+            if _tool_session is None:
+                _tool_session = PooledSession(**_tool_session_args)
+    return _tool_session
+
+
+def report():
+    '''
+    Connection reuse of the sessions this process used, one line per host
+    '''
+    sessions = [("service requests", _session), ("tool requests", _tool_session)]
+    return "\n".join(session.report(name) for name, session in sessions if session is not None and len(session.adapter.connection_counts()) > 0)
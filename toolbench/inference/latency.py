@@ -0,0 +1,160 @@
+'''
+Latency histograms of tool and LLM calls, and hedged calls driven by them.
+
+Every call made through hedged_call records its latency in the histogram of its key, e.g. "tool/<tool name>"
+or "llm/<model>". With hedging on, a call still running after the p95 latency of its key gets a duplicate,
+and the first of the two to succeed is returned. Tails of remote APIs are mostly one slow server or a lost
+connection, which a second request rarely hits again.
+'''
+import bisect
+import math
+import queue
+import threading
+import time
+
+# seconds between two checks of should_stop while waiting for a call
+STOP_POLL_INTERVAL = 0.1
+
+# bucket upper bounds from 1ms to ~17min, four per doubling
+BUCKET_BOUNDS = [0.001 * 2 ** (i / 4) for i in range(81)]
+
+
+class LatencyHistogram:
+    """Counts of call latencies in log-spaced buckets, safe to record from several threads"""
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKET_BOUNDS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.lock = threading.Lock()
+
+    def record(self, seconds):
+        with self.lock:
+            self.counts[bisect.bisect_left(BUCKET_BOUNDS, seconds)] += 1
+            self.count += 1
+            self.total += seconds
+
+    def quantile(self, q):
+        '''
+        Upper bound of the bucket holding the q-quantile, None without samples
+        '''
+        with self.lock:
+            if self.count == 0:
+                return None
+            rank = max(math.ceil(q * self.count), 1)
+            seen = 0
+            for bucket, count in enumerate(self.counts):
+                seen += count
+                if seen >= rank:
+                    return BUCKET_BOUNDS[bucket] if bucket < len(BUCKET_BOUNDS) else math.inf
+
+    def to_json(self):
+        return {
+            "count": self.count,
+            "mean": self.total / self.count if self.count > 0 else None,
+            "p50": self.quantile(0.5),
+            "p95": self.quantile(0.95),
+            "p99": self.quantile(0.99),
+        }
+
+
+class LatencyHistograms:
+    """One LatencyHistogram per key, created on first use"""
+
+    def __init__(self):
+        self.histograms = {}
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            if key not in self.histograms:
+                self.histograms[key] = LatencyHistogram()
+            return self.histograms[key]
+
+    def to_json(self):
+        with self.lock:
+            histograms = dict(self.histograms)
+        return {key: histogram.to_json() for key, histogram in sorted(histograms.items())}
+
+    def report(self):
+        lines = ["call latency (s): count / p50 / p95 / p99"]
+        for key, stats in self.to_json().items():
+            if stats["count"] == 0:
+                continue
+            lines.append(f"  {key}: {stats['count']} / {stats['p50']:.3f} / {stats['p95']:.3f} / {stats['p99']:.3f}")
+        return "\n".join(lines)
+
+
+# shared by every call in this process
+latency_histograms = LatencyHistograms()
+
+
+def hedged_call(func, args=(), kwargs=None, key=None, timeout=None, hedge=False, hedge_quantile=0.95, min_samples=20, histograms=None, should_stop=None):
+    '''
+    func(*args, **kwargs), with its latency recorded in the histogram of key.
+
+    timeout: raise TimeoutError if no call succeeded within it, None to wait as long as it takes.
+    hedge: once the key has min_samples latencies, start a duplicate call if the first one is still running after
+    the hedge_quantile latency, and return whichever succeeds first. If the calls fail, the last error is raised.
+    should_stop: checked every STOP_POLL_INTERVAL seconds while waiting, once it returns True TimeoutError is raised.
+    Calls still running when the result is returned, or given up on, keep running in daemon threads and are thrown away.
+    '''
+    kwargs = kwargs if kwargs is not None else {}
+    histograms = histograms if histograms is not None else latency_histograms
+    histogram = histograms.get(key) if key is not None else None
+    hedge_delay = None
+    if hedge and histogram is not None and histogram.count >= min_samples:
+        hedge_delay = histogram.quantile(hedge_quantile)
+
+    def attempt():
+        start = time.monotonic()
+        result = func(*args, **kwargs)
+        if histogram is not None:
+            # failures are left out, they are mostly fast and would pull the hedge threshold down
+            histogram.record(time.monotonic() - start)
+        return result
+
+    if timeout is None and hedge_delay is None and should_stop is None:
+        return attempt()
+
+    results = queue.Queue()
+
+    def launch():
+        def target():
+            try:
+                results.put((attempt(), None))
+            except BaseException as e:
+                results.put((None, e))
+        threading.Thread(target=target, daemon=True).start()
+
+    start = time.monotonic()
+    deadline = start + timeout if timeout is not None else None
+    hedge_at = start + hedge_delay if hedge_delay is not None else None
+    launch()
+    launched = 1
+    finished = 0
+    while True:
+        wake_up = [t for t in (deadline, hedge_at) if t is not None]
+        wait = max(min(wake_up) - time.monotonic(), 0.0) if len(wake_up) > 0 else None
+        if should_stop is not None:
+            wait = STOP_POLL_INTERVAL if wait is None else min(wait, STOP_POLL_INTERVAL)
+        try:
+            result, error = results.get(timeout=wait)
+        except queue.Empty:
+            if should_stop is not None and should_stop():
+                raise TimeoutError("stopped while waiting for the response")
+            if hedge_at is not None and time.monotonic() >= hedge_at:
+                launch()
+                launched += 1
+                hedge_at = None
+                continue
+            if deadline is None or time.monotonic() < deadline:
+                # woken up to check should_stop
+                continue
+            raise TimeoutError(f"no response within {timeout:.1f}s")
+        finished += 1
+        if error is None:
+            return result
+        if finished == launched:
+            # no call left running, a failure is not hedged
+            raise error
@@ -0,0 +1,217 @@
+'''
+Local mock of the RapidAPI service behind rapidapi_wrapper.service_url, for load testing without a toolbench key.
+
+It takes the same POST /rapidapi requests and answers {"error": ..., "response": ...} like the real service. The
+response is synthesized from the api's schema in data/toolenv/response_examples/<category>/<tool>.json, the same
+for the same call. Latency follows a configurable distribution, and a configurable fraction of calls fails with the
+upstream messages server.process_error classifies, or hangs past the client's timeout.
+
+Usage:
+python toolbench/inference/mock_server.py --schema_root data/toolenv/response_examples --port 8080 \
+    --latency_distribution lognormal --latency_mean 0.5 --error_rates '{"api_not_working": 0.05}'
+then point the pipeline at it with --service_url http://localhost:8080/rapidapi --service_call_interval 0
+'''
+import argparse
+import asyncio
+import functools
+import hashlib
+import json
+import math
+import os
+import random
+from collections import Counter
+
+import uvicorn
+from fastapi import FastAPI
+
+from toolbench.inference.server import Info, prepare_tool_name_and_url, process_error
+from toolbench.utils import standardize, change_name
+
+# upstream answers that process_error turns into each of its error categories
+ERROR_MESSAGES = {
+    "api_not_working": "Your Client (working) ---> Gateway (working) ---> API (not working)",
+    "unauthorized": "401 Unauthorized",
+    "unsubscribed": "You are not subscribed to this API.",
+    "too_many_requests": "Too many requests",
+    "rate_limit": "You have exceeded the MONTHLY quota for Requests on your current plan",
+    "access_restricted": "Access restricted. Check credits balance or enter the correct API key.",
+    "gateway": "Oops, an error in the gateway has occurred.",
+    "blocked": "Blocked User. Please contact your API provider.",
+    "message": {"error": "Invalid parameter value"},
+}
+# errors of the service itself rather than of the api
+SERVICE_ERRORS = {
+    "rate_limit_per_minute": "Rate limit per minute error...",
+}
+DEFAULT_ERROR_RATES = {
+    "api_not_working": 0.02,
+    "unauthorized": 0.01,
+    "unsubscribed": 0.01,
+    "too_many_requests": 0.01,
+    "message": 0.03,
+}
+JSON_SCHEMA_TYPES = ["object", "array", "string", "integer", "number", "boolean", "null"]
+LEAF_TYPE_NAMES = {"str": "string", "string": "string", "int": "integer", "integer": "integer", "float": "number",
+                   "number": "number", "bool": "boolean", "boolean": "boolean"}
+MAX_DEPTH = 8
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--schema_root', type=str, default="data/toolenv/response_examples", required=False, help='Response schemas, <category>/<tool>.json.')
+parser.add_argument('--tools_root', type=str, default="data.toolenv.tools", required=False, help='Module path of the tools, only used to resolve names as the real service does.')
+parser.add_argument('--host', type=str, default="0.0.0.0", required=False, help='Host to listen on.')
+parser.add_argument('--port', type=int, default=8080, required=False, help='Port to listen on.')
+parser.add_argument('--latency_distribution', type=str, default="lognormal", choices=["none", "constant", "uniform", "lognormal"], required=False, help='Distribution of the latency of a call.')
+parser.add_argument('--latency_mean', type=float, default=0.5, required=False, help='Mean latency in seconds.')
+parser.add_argument('--latency_sigma', type=float, default=1.0, required=False, help='Shape of the lognormal latency, larger means a longer tail.')
+parser.add_argument('--timeout_rate', type=float, default=0.0, required=False, help='Fraction of calls that hang for --timeout_latency seconds.')
+parser.add_argument('--timeout_latency', type=float, default=30.0, required=False, help='Latency of a hanging call, above the client timeout.')
+parser.add_argument('--error_rates', type=str, default=json.dumps(DEFAULT_ERROR_RATES), required=False, help=f'JSON object of error kind -> fraction of calls, kinds: {", ".join(list(ERROR_MESSAGES) + list(SERVICE_ERRORS))}.')
+parser.add_argument('--seed', type=int, default=None, required=False, help='Seed of latencies and errors, responses are always the same for the same call.')
+
+
+@functools.lru_cache(maxsize=4096)
+def load_api_schemas(schema_root, category, tool_name):
+    path = os.path.join(schema_root, category, tool_name + ".json")
+    if not os.path.exists(path):
+        return {}
+    with open(path, "r") as f:
+        tool_dict = json.load(f)
+    schemas = {}
+    for api_dict in tool_dict.get("api_list", []):
+        schemas[change_name(standardize(api_dict["name"]))] = api_dict
+    return schemas
+
+
+def synthesize_leaf(type_name, schema, name, rng):
+    if isinstance(schema, dict) and "enum" in schema and len(schema["enum"]) > 0:
+        return rng.choice(schema["enum"])
+    if type_name == "string":
+        return f"{name} {rng.randint(0, 9999)}"
+    if type_name == "integer":
+        return rng.randint(0, 1000)
+    if type_name == "number":
+        return round(rng.uniform(0, 1000), 3)
+    if type_name == "boolean":
+        return rng.random() < 0.5
+    return None
+
+
+def synthesize(schema, rng, name="value", depth=0):
+    '''
+    A value conforming to schema, either a JSON schema ({"type": "object", "properties": ...}) or a skeleton of the
+    response itself, dicts of keys, lists holding one example element and type names or example values as leaves
+    '''
+    if depth > MAX_DEPTH:
+        return None
+    if isinstance(schema, dict):
+        type_name = schema.get("type")
+        if isinstance(type_name, list):
+            type_name = next((t for t in type_name if t != "null"), "null")
+        if type_name in JSON_SCHEMA_TYPES:
+            if type_name == "object":
+                return {key: synthesize(value, rng, key, depth + 1) for key, value in schema.get("properties", {}).items()}
+            if type_name == "array":
+                return [synthesize(schema.get("items", {}), rng, name, depth + 1) for _ in range(rng.randint(1, 3))]
+            return synthesize_leaf(type_name, schema, name, rng)
+        return {key: synthesize(value, rng, key, depth + 1) for key, value in schema.items()}
+    if isinstance(schema, list):
+        if len(schema) == 0:
+            return []
+        return [synthesize(schema[0], rng, name, depth + 1) for _ in range(rng.randint(1, 3))]
+    if isinstance(schema, str) and schema.lower() in LEAF_TYPE_NAMES:
+        return synthesize_leaf(LEAF_TYPE_NAMES[schema.lower()], None, name, rng)
+    # an example value
+    return schema
+
+
+class MockService:
+    """Synthesized responses, latencies and failures of the mock service, with counters of what it served"""
+
+    def __init__(self, args):
+        self.args = args
+        self.error_rates = json.loads(args.error_rates)
+        for kind in self.error_rates:
+            assert kind in ERROR_MESSAGES or kind in SERVICE_ERRORS, f"unknown error kind {kind}"
+        self.rng = random.Random(args.seed)
+        self.stats = Counter()
+
+    def sample_latency(self):
+        args = self.args
+        if self.rng.random() < args.timeout_rate:
+            return args.timeout_latency
+        if args.latency_distribution == "constant":
+            return args.latency_mean
+        if args.latency_distribution == "uniform":
+            return self.rng.uniform(0, 2 * args.latency_mean)
+        if args.latency_distribution == "lognormal":
+            # mean latency_mean whatever the sigma
+            sigma = args.latency_sigma
+            return args.latency_mean * math.exp(self.rng.gauss(0, sigma) - sigma ** 2 / 2)
+        return 0.0
+
+    def sample_error(self):
+        r = self.rng.random()
+        for kind, rate in self.error_rates.items():
+            if r < rate:
+                return kind
+            r -= rate
+        return None
+
+    def respond(self, info):
+        tool_name, standard_category, api_name, _ = prepare_tool_name_and_url(self.args.tools_root, info)
+        tool_input = info.tool_input
+        if isinstance(tool_input, str):
+            try:
+                tool_input = json.loads(tool_input) if tool_input != "" else {}
+            except Exception:
+                self.stats["input_error"] += 1
+                return {"error": "Tool input parse error...\n", "response": ""}
+
+        error = self.sample_error()
+        if error in SERVICE_ERRORS:
+            self.stats[error] += 1
+            return {"error": SERVICE_ERRORS[error], "response": ""}
+        if error is not None:
+            raw_response = ERROR_MESSAGES[error]
+        else:
+            # the same call always gets the same response
+            seed = json.dumps([standard_category, tool_name, api_name, tool_input], sort_keys=True)
+            rng = random.Random(hashlib.md5(seed.encode("utf-8")).hexdigest())
+            schemas = load_api_schemas(self.args.schema_root, standard_category, tool_name.replace(f"_for_{standard_category}", ""))
+            api_dict = schemas.get(api_name)
+            if api_dict is None:
+                raw_response = {"message": f"{api_name} {rng.randint(0, 9999)}"}
+                self.stats["no_schema"] += 1
+            elif len(api_dict.get("schema") or {}) > 0:
+                raw_response = synthesize(api_dict["schema"], rng)
+            elif api_dict.get("test_endpoint"):
+                raw_response = api_dict["test_endpoint"]
+            else:
+                raw_response = {"message": f"{api_name} {rng.randint(0, 9999)}"}
+                self.stats["no_schema"] += 1
+        response_dict, _, _ = process_error(raw_response)
+        self.stats[error if error is not None else "ok"] += 1
+        # synthesized responses only hold keys of the schema, so they are already what strip="filter" would keep
+        return {"error": response_dict["error"], "response": str(response_dict["response"])[:2048]}
+
+
+def create_app(args):
+    app = FastAPI()
+    service = MockService(args)
+
+    @app.post("/rapidapi")
+    async def rapidapi(info: Info):
+        service.stats["requests"] += 1
+        await asyncio.sleep(service.sample_latency())
+        return service.respond(info)
+
+    @app.get("/stats")
+    async def stats():
+        return dict(service.stats)
+
+    return app
+
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    uvicorn.run(create_app(args), host=args.host, port=args.port)
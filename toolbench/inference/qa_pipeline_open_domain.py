@@ -17,17 +17,47 @@ if __name__ == "__main__":
     parser.add_argument('--tool_root_dir', type=str, default="your_tools_path/", required=True, help='')
     parser.add_argument("--lora", action="store_true", help="Load lora model or not.")
     parser.add_argument('--lora_path', type=str, default="your_lora_path if lora", required=False, help='')
+    parser.add_argument('--device', type=str, default="cuda", choices=["cuda", "cpu"], required=False, help='device to run toolllama on')
+    parser.add_argument("--load_8bit", action="store_true", help="Load toolllama with int8 weight-only quantization.")
+    parser.add_argument("--load_4bit", action="store_true", help="Load toolllama with int4 weight-only quantization.")
+    parser.add_argument("--kv_cache_int8", action="store_true", help="Keep toolllama's kv cache in int8 with per-head, per-token scales.")
+    parser.add_argument('--draft_model_path', type=str, default=None, required=False, help='speculative decoding for toolllama: a small draft model path, or "prompt_lookup" to draft from the prompt')
+    parser.add_argument('--num_concurrent_queries', type=int, default=1, required=False, help='queries searched at once in this process, their toolllama calls are decoded as batches and their api calls overlap')
+    parser.add_argument('--max_batch_size', type=int, default=16, required=False, help='maximum number of toolllama calls decoded as one batch')
+    parser.add_argument("--prune_duplicate_actions", action="store_true", help="DFS: prune a branch that repeats the action and arguments of a sibling branch. Repeated calls always reuse the former observation.")
+    parser.add_argument('--query_timeout', type=float, default=None, required=False, help='wall-clock seconds per query, the search stops and keeps what it found once they are spent')
+    parser.add_argument('--max_query_tokens', type=int, default=None, required=False, help='total LLM tokens per query, the search stops and keeps what it found once they are spent')
+    parser.add_argument('--tool_call_timeout', type=float, default=15, required=False, help='seconds one api call may take before it counts as timed out (status 5)')
+    parser.add_argument("--hedge_tool_calls", action="store_true", help="Send a duplicate api call once one is slower than the tool's p95 latency so far, and take the first response.")
+    parser.add_argument('--llm_call_timeout', type=float, default=None, required=False, help='seconds one openai request may take before it is retried, no limit by default')
+    parser.add_argument("--hedge_llm_calls", action="store_true", help="Send a duplicate openai request once one is slower than the model's p95 latency so far, and take the first response.")
+    parser.add_argument('--api_record_mode', type=str, default="off", choices=["off", "record", "replay"], required=False, help='record every api call and its observation into --api_record_path, or replay them from it without calling the apis')
+    parser.add_argument('--api_record_path', type=str, default="api_records.sqlite", required=False, help='sqlite file of recorded api calls')
+    parser.add_argument('--replay_miss', type=str, default="error", choices=["error", "live", "record"], required=False, help='replay of a call that was not recorded: an error observation, the live call, or the live call recorded')
+    parser.add_argument('--tool_health_path', type=str, default=None, required=False, help='sqlite file of the health of every api, kept across runs; apis that keep failing get their calls refused for a while (circuit breaking). Off if not set')
+    parser.add_argument('--circuit_error_rate', type=float, default=0.8, required=False, help='fraction of failed recent calls that opens the circuit of an api')
+    parser.add_argument('--circuit_min_calls', type=int, default=3, required=False, help='recent calls needed before the circuit of an api can open')
+    parser.add_argument('--circuit_window', type=int, default=10, required=False, help='number of recent calls the error rate of an api is computed on')
+    parser.add_argument('--circuit_cooldown', type=float, default=3600, required=False, help='seconds an open circuit refuses calls before letting one through to probe the api')
+    parser.add_argument('--exclude_dead_apis', action="store_true", help="Leave the apis with an open circuit out of the tasks and of the retrieved apis.")
     parser.add_argument('--max_observation_length', type=int, default=1024, required=False, help='maximum observation length')
     parser.add_argument('--max_source_sequence_length', type=int, default=4096, required=False, help='original maximum model sequence length')
     parser.add_argument('--max_sequence_length', type=int, default=8192, required=False, help='maximum model sequence length')
+    parser.add_argument('--rope_scaling', type=str, default="linear", choices=["linear", "dynamic"], required=False, help='how toolllama reaches max_sequence_length: linear condenses positions, dynamic rescales the rope base (NTK) once a sequence outgrows max_source_sequence_length')
     parser.add_argument('--observ_compress_method', type=str, default="truncate", choices=["truncate", "filter", "random"], required=False, help='maximum observation length')
     parser.add_argument('--method', type=str, default="CoT@1", required=False, help='method for answer generation: CoT@n,Reflexion@n,BFS,DFS,UCT_vote')
     parser.add_argument('--input_query_file', type=str, default="", required=False, help='input path')
     parser.add_argument('--output_answer_file', type=str, default="",required=False, help='output path')
     parser.add_argument('--toolbench_key', type=str, default="",required=False, help='your toolbench key to request rapidapi service')
     parser.add_argument('--rapidapi_key', type=str, default="",required=False, help='your rapidapi key to request rapidapi service')
+    parser.add_argument('--service_url', type=str, default="http://8.218.239.54:8080/rapidapi", required=False, help='rapidapi service to request, e.g. a local mock_server.py for load testing')
+    parser.add_argument('--service_call_interval', type=float, default=2, required=False, help='seconds to wait before each service request, the toolbench service allows 30 per minute; 0 for a local mock')
     parser.add_argument('--use_rapidapi_key', action="store_true", help="To use customized rapidapi service or not.")
     parser.add_argument('--api_customization', action="store_true", help="To use customized api or not. NOT SUPPORTED currently under open domain setting.")
+    parser.add_argument('--local_service_url', type=str, default=None, required=False, help='server.py serving the apis for --use_rapidapi_key / --api_customization, e.g. http://localhost:8081/rapidapi; they run in this process if not set')
+    parser.add_argument('--tool_http_pool_size', type=int, default=64, required=False, help='keep-alive connections per api host, for the apis run in this process')
+    parser.add_argument('--tool_http_timeout', type=float, default=30, required=False, help='seconds an api request may take, for the apis run in this process that set no timeout')
+    parser.add_argument('--tool_http_retries', type=int, default=2, required=False, help='retries of an api request after a connection error or a 502/503/504, for the apis run in this process')
     
     args = parser.parse_args()
 
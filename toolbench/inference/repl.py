@@ -1,11 +1,37 @@
 from typing import Mapping
+import atexit
+import pickle
+import queue
 import re
 import signal
+import socket
+import subprocess
+import sys
+import threading
+import time
+from multiprocessing.connection import Connection
 from contextlib import contextmanager
 from IPython.core.interactiveshell import InteractiveShell
+from traitlets.config import Config
 from IPython.utils import io
 from typing import Any
 
+def format_output(output):
+    if output == "":
+        output = "[Executed Successfully with No Output]"
+
+    # replace potentially sensitive filepath
+    # e.g., File /mint/mint/tools/python_tool.py:30, in PythonREPL.time_limit.<locals>.signal_handler(signum, frame)
+    # with File <filepath>:30, in PythonREPL.time_limit.<locals>.signal_handler(signum, frame)
+    # use re
+    return re.sub(
+        # r"File (/mint/)mint/tools/python_tool.py:(\d+)",
+        r"File (.*).py:(\d+)",
+        r"File <hidden_filepath>:\2",
+        output,
+    )
+
+
 class PythonREPL:
     """A tool for running python code in a REPL."""
 
@@ -54,21 +80,7 @@ class PythonREPL:
             # Capture all output
             with io.capture_output() as captured:
                 _ = self.shell.run_cell(query, store_history=True)
-            output = captured.stdout
-
-            if output == "":
-                output = "[Executed Successfully with No Output]"
-
-            # replace potentially sensitive filepath
-            # e.g., File /mint/mint/tools/python_tool.py:30, in PythonREPL.time_limit.<locals>.signal_handler(signum, frame)
-            # with File <filepath>:30, in PythonREPL.time_limit.<locals>.signal_handler(signum, frame)
-            # use re
-            output = re.sub(
-                # r"File (/mint/)mint/tools/python_tool.py:(\d+)",
-                r"File (.*).py:(\d+)",
-                r"File <hidden_filepath>:\2",
-                output,
-            )
+            output = format_output(captured.stdout)
 
             # if len(output) > self.max_observation_length:
             #     # make sure the beginning and the end of the output are not truncated
@@ -86,3 +98,176 @@ class PythonREPL:
         self.shell.reset()
         self.shell.cleanup()
         self.shell = None
+
+
+# Pre-started REPL worker processes.
+#
+# A PythonREPL builds a new InteractiveShell for every code action, which takes longer than most actions, and its
+# timeout uses SIGALRM, which only works in the main thread. REPLWorkerPool keeps `size` worker processes, each with
+# an InteractiveShell built once, and runs every action in an idle one after resetting its namespace. The tool
+# functions of the action stay in the calling process: the worker gets stubs that send the call back over its
+# connection and wait for the result. A worker still running at the timeout is killed and replaced, so actions run
+# from any thread, in parallel up to the size of the pool.
+
+TIMEOUT_MESSAGE = "TimeoutError: Timed out after {timeout} seconds. Consider change your code to reduce the running time."
+
+
+class REPLWorker:
+    """One worker process and the connection to it, see worker_main"""
+
+    def __init__(self):
+        parent_socket, child_socket = socket.socketpair()
+        # a script rather than multiprocessing: the worker must not import the pipeline's __main__ and its models again
+        self.process = subprocess.Popen(
+            [sys.executable, __file__, str(child_socket.fileno())],
+            pass_fds=(child_socket.fileno(),),
+        )
+        child_socket.close()
+        self.connection = Connection(parent_socket.detach())
+        self.ready = False
+
+    def wait_ready(self, timeout):
+        if not self.ready:
+            if not self.connection.poll(timeout):
+                raise TimeoutError("the REPL worker did not start")
+            assert self.connection.recv() == ("ready",)
+            self.ready = True
+
+    def kill(self):
+        try:
+            self.process.kill()
+            self.process.wait()
+        except Exception:
+            pass
+        self.connection.close()
+
+
+class REPLWorkerPool:
+    """size pre-started REPL worker processes, shared by the threads of the process"""
+
+    def __init__(self, size=4, timeout=30, start_timeout=60):
+        self.size = size
+        self.timeout = timeout
+        self.start_timeout = start_timeout
+        self.idle = queue.Queue()
+        self.closed = False
+        for _ in range(size):
+            self.idle.put(REPLWorker())
+        atexit.register(self.close)
+
+    def release(self, worker, healthy=True):
+        if healthy and not self.closed:
+            self.idle.put(worker)
+            return
+        # a worker that timed out or broke is replaced right away, the new one starts while the actions go on
+        worker.kill()
+        if not self.closed:
+            self.idle.put(REPLWorker())
+
+    def run(self, code, functions, timeout=None):
+        '''
+        Output of code run in a fresh namespace holding functions ({name: callable}), which are called in this process.
+        Code still running after timeout seconds (the pool's by default), tool calls included, is killed
+        '''
+        timeout = timeout if timeout is not None else self.timeout
+        worker = self.idle.get()
+        try:
+            worker.wait_ready(self.start_timeout)
+            deadline = time.monotonic() + timeout
+            worker.connection.send(("run", code, list(functions)))
+            while True:
+                if not worker.connection.poll(max(deadline - time.monotonic(), 0)):
+                    self.release(worker, healthy=False)
+                    return TIMEOUT_MESSAGE.format(timeout=timeout)
+                message = worker.connection.recv()
+                if message[0] == "output":
+                    self.release(worker)
+                    return message[1]
+                # ("call", name, args, kwargs): a tool function called by the code
+                _, name, args, kwargs = message
+                try:
+                    reply = ("result", functions[name](*args, **kwargs))
+                except Exception as e:
+                    reply = ("error", e)
+                try:
+                    worker.connection.send(reply)
+                except (pickle.PicklingError, TypeError, AttributeError):
+                    worker.connection.send(("error", RuntimeError(str(reply[1]))))
+        except (EOFError, OSError, TimeoutError) as e:
+            self.release(worker, healthy=False)
+            return f"REPL worker error: {e!r}"
+        except BaseException:
+            self.release(worker, healthy=False)
+            raise
+
+    def close(self):
+        self.closed = True
+        while True:
+            try:
+                self.idle.get_nowait().kill()
+            except queue.Empty:
+                break
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_repl_pool():
+    '''
+    A REPL worker pool with the default settings, shared by the code actions not given one, started on first use
+    '''
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = REPLWorkerPool()
+    return _pool
+
+
+def reset_shell(shell, baseline_ns):
+    # what a new InteractiveShell would start from, shell.reset() takes as long as building one
+    history = shell.history_manager
+    history.input_hist_parsed[:] = [""]
+    history.input_hist_raw[:] = [""]
+    history.output_hist.clear()
+    history.output_hist_reprs.clear()
+    shell.user_ns.clear()
+    shell.user_ns.update(baseline_ns)
+    shell.execution_count = 1
+
+
+def worker_main(fd):
+    connection = Connection(fd)
+    # no history database: the workers would all write the same file, and the cell numbers start over every action
+    config = Config()
+    config.HistoryManager.enabled = False
+    shell = InteractiveShell(colors="NoColor", config=config)
+    baseline_ns = dict(shell.user_ns)
+    connection.send(("ready",))
+
+    def proxy(name):
+        def call(*args, **kwargs):
+            connection.send(("call", name, args, kwargs))
+            kind, value = connection.recv()
+            if kind == "error":
+                raise value
+            return value
+        return call
+
+    while True:
+        try:
+            message = connection.recv()
+        except EOFError:
+            # the pipeline is gone
+            break
+        _, code, function_names = message
+        reset_shell(shell, baseline_ns)
+        shell.user_ns.update({name: proxy(name) for name in function_names})
+        with io.capture_output() as captured:
+            _ = shell.run_cell(code, store_history=True)
+        connection.send(("output", format_output(captured.stdout)))
+
+
+if __name__ == "__main__":
+    worker_main(int(sys.argv[1]))
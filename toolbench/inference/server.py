@@ -1,8 +1,26 @@
+'''
+Local execution of the toolenv apis, in process or as a service.
+
+get_rapidapi_response runs one api of data/toolenv/tools, it is what rapidapi_wrapper calls with --use_rapidapi_key
+or --api_customization. It is safe to call from many threads at once. Run this file to serve it on
+POST /rapidapi, with the same requests and answers as the toolbench service, so that many pipeline processes
+share one pool of api workers:
+python toolbench/inference/server.py --port 8081 --max_workers 64 --workers 4
+then run the pipeline with --use_rapidapi_key --local_service_url http://localhost:8081/rapidapi
+'''
 from pydantic import BaseModel
+import argparse
+import asyncio
+import functools
+import importlib
 import json
 import os
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
 from typing import Union
 from toolbench.utils import standardize, change_name
+from toolbench.inference.execution_context import call_with_timeout
+from toolbench.inference.http_session import bind_session, configure_tool_session, tool_session
 import random
 
 
@@ -13,6 +31,11 @@ class Info(BaseModel):
     tool_input: Union[str, dict]
     strip: str
 
+
+class RapidAPIRequest(Info):
+    rapidapi_key: str = ""
+    api_customization: bool = False
+
 def prepare_tool_name_and_url(tools_root, info):
     category = info.category
     standard_category = category.replace(" ", "_").replace(",", "_").replace("/", "_")
@@ -24,12 +47,12 @@ def prepare_tool_name_and_url(tools_root, info):
     api_name = change_name(standardize(info.api_name))
     if not tool_name.endswith(f"_for_{standard_category}"):
         tool_name = standardize(info.tool_name)
-        code_string = f"""from {tools_root}.{standard_category}.{tool_name}.api import {api_name}"""
+        module_name = f"{tools_root}.{standard_category}.{tool_name}.api"
         tool_name += f"_for_{standard_category}"
     else:
         tmp_tool_name = standardize(tool_name.replace(f"_for_{standard_category}", ""))
-        code_string = f"""from {tools_root}.{standard_category}.{tmp_tool_name}.api import {api_name}"""
-    return tool_name, standard_category, api_name, code_string
+        module_name = f"{tools_root}.{standard_category}.{tmp_tool_name}.api"
+    return tool_name, standard_category, api_name, module_name
 
 def process_error(response):
     save_cache_flag = False
@@ -76,19 +99,24 @@ def process_error(response):
         return_dict = {"error": "", "response": response}
     return return_dict, save_cache_flag, switch_flag
 
-def run(toolbench_code_string, toolbench_api_name, toolbench_input_params_str):
+@functools.lru_cache(maxsize=None)
+def load_api_function(module_name, api_name):
+    # imports are serialized by the import lock, a module is only executed once whatever the number of threads.
+    # Its requests calls are bound to the pooled session of the tool modules
+    module = bind_session(importlib.import_module(module_name), tool_session())
+    return getattr(module, api_name)
+
+def run(module_name, api_name, kwargs):
     # get observation
     success_flag = False
     switch_flag = False
     save_cache = False
-    exec(toolbench_code_string)
     try:
-        eval_func_str = f"{toolbench_api_name}({toolbench_input_params_str})"
-        new_func = eval(eval_func_str)
-        response, save_cache, switch_flag = process_error(new_func)
+        api_function = load_api_function(module_name, api_name)
+        response, save_cache, switch_flag = process_error(api_function(**kwargs))
         success_flag = True
     except Exception as e:
-        response = {"error": f"Function executing {toolbench_code_string} error...\n{e}", "response": ""}
+        response = {"error": f"Function executing from {module_name} import {api_name} error...\n{e}", "response": ""}
         save_cache = False
     return success_flag, switch_flag, response, save_cache
 
@@ -107,71 +135,154 @@ def dict_shorten(origin: dict, schema: dict):
                             dict_shorten(item, schema[key][0]) # schema[key] should be a list with only one dict element
     return origin
 
+@functools.lru_cache(maxsize=4096)
+def load_response_schema(schema_root, category, tool_name, api_name):
+    path = os.path.join(schema_root, category, tool_name+".json")
+    if not os.path.exists(path):
+        return None
+    with open(path, "r") as f:
+        api_list = json.load(f)["api_list"]
+    for schema_dict in api_list:
+        schema_api_name = change_name(standardize(schema_dict["name"]))
+        if schema_api_name == api_name and len(schema_dict["schema"]) > 0:
+            return schema_dict["schema"]
+    return None
+
 def observation_shorten(schema_root, response_dict, category, tool_name, api_name, strip_method):
-    print(random.random())
     if strip_method == "filter" or (strip_method == "random" and random.random() > 0.5):
         if isinstance(response_dict["response"], dict):
-            if os.path.exists(os.path.join(schema_root, category)):
-                if os.path.exists(os.path.join(schema_root, category, tool_name+".json")):
-                    schema_dicts = json.load(open(os.path.join(schema_root, category, tool_name+".json"), "r"))
-                    api_list = schema_dicts["api_list"]
-                    schema = None
-                    for schema_dict in api_list:
-                        schema_api_name = change_name(standardize(schema_dict["name"]))
-                        if schema_api_name == api_name and len(schema_dict["schema"]) > 0:
-                            schema = schema_dict["schema"]
-                            break
-                    if schema is not None:
-                        response_dict["response"] = dict_shorten(response_dict["response"], schema)
+            schema = load_response_schema(schema_root, category, tool_name, api_name)
+            if schema is not None:
+                response_dict["response"] = dict_shorten(response_dict["response"], schema)
     return str(response_dict["response"])
 
 
-def get_rapidapi_response(input_dict: dict, api_customization: bool=False, tools_root: str="data.toolenv.tools", schema_root: str="data/toolenv/response_examples"):
-    info = Info
-    info.category = input_dict['category']
-    info.tool_name = input_dict['tool_name']
-    info.api_name = input_dict['api_name']
-    info.tool_input = input_dict['tool_input']
-    info.strip = input_dict['strip']
+def get_rapidapi_response(input_dict: dict, api_customization: bool=False, tools_root: str="data.toolenv.tools", schema_root: str="data/toolenv/response_examples", timeout: float=None):
+    """timeout: seconds to wait for the api.py call, which may have none of its own, None to wait for it as long as it takes"""
+    info = Info(
+        category=input_dict['category'],
+        tool_name=input_dict['tool_name'],
+        api_name=input_dict['api_name'],
+        tool_input=input_dict['tool_input'],
+        strip=input_dict['strip'],
+    )
     rapidapi_key = input_dict['rapidapi_key']
 
-    tool_name, standard_category, api_name, code_string = prepare_tool_name_and_url(tools_root, info)
+    tool_name, standard_category, api_name, module_name = prepare_tool_name_and_url(tools_root, info)
     tool_input = info.tool_input
     
     strip_method = info.strip
     
-    try:
-        tool_input = json.loads(tool_input)
-    except Exception as e:
-        if tool_input == "":
-            tool_input = {}
-        else:
-            print(f"Can not parse tool input into json: {tool_input}")
-            response_dict = {"error": f"Tool input parse error...\n", "response": ""}
-            return response_dict
-    
-    input_params_str = ""
-    if len(tool_input) > 0:
-        for key, value in tool_input.items():
-            if isinstance(value, str):
-                input_params_str += f'{key}="{value}", '
+    if isinstance(tool_input, str):
+        try:
+            tool_input = json.loads(tool_input)
+        except Exception as e:
+            if tool_input == "":
+                tool_input = {}
             else:
-                input_params_str += f'{key}={value}, '
+                print(f"Can not parse tool input into json: {tool_input}")
+                response_dict = {"error": f"Tool input parse error...\n", "response": ""}
+                return response_dict
+    if not isinstance(tool_input, dict):
+        return {"error": "Tool input parse error...\n", "response": ""}
+    
+    kwargs = dict(tool_input)
     if not api_customization:
-        input_params_str += f"toolbench_rapidapi_key='{rapidapi_key}'"
-    success_flag, switch_flag, response_dict, save_cache = run(code_string, api_name, input_params_str)
+        kwargs["toolbench_rapidapi_key"] = rapidapi_key
+    try:
+        success_flag, switch_flag, response_dict, save_cache = call_with_timeout(run, (module_name, api_name, kwargs), timeout)
+    except TimeoutError as e:
+        return {"error": f"Timeout error...{e}", "response": ""}
     observation = observation_shorten(schema_root, response_dict, standard_category, tool_name.replace(f"_for_{standard_category}", ""), api_name, strip_method)
     result = str(observation)[:2048]
     return {"error": response_dict['error'], "response": result}
 
 
+def create_app(tools_root="data.toolenv.tools", schema_root="data/toolenv/response_examples", max_workers=64, max_queue=256, call_timeout=15,
+               http_pool_size=64, http_timeout=30, http_retries=2):
+    '''
+    ASGI app serving get_rapidapi_response on POST /rapidapi.
+
+    The api calls run in a pool of max_workers threads, at most max_queue more wait for a worker and further requests
+    are answered right away with a too many requests error. A call that has not answered after call_timeout seconds
+    gets a timeout error. The api call runs in its worker itself, it keeps the worker until it returns and counts
+    against max_workers + max_queue until then. It is bounded by the timeout of the pooled session the apis send their
+    requests over (see http_session.py), at most call_timeout to connect and http_timeout between two reads.
+    '''
+    from fastapi import FastAPI
+
+    # (connect, read) timeouts of the api requests, the only bound of a call once its worker started it
+    configure_tool_session(pool_size=http_pool_size, timeout=(min(call_timeout, http_timeout), http_timeout), retries=http_retries)
+
+    app = FastAPI()
+    executor = ThreadPoolExecutor(max_workers=max_workers)
+    stats = Counter()
+
+    def release():
+        stats["pending"] -= 1
+
+    @app.post("/rapidapi")
+    async def rapidapi(request: RapidAPIRequest):
+        loop = asyncio.get_running_loop()
+        stats["requests"] += 1
+        if stats["pending"] >= max_workers + max_queue:
+            stats["rejected"] += 1
+            return {"error": "Too many requests error...", "response": "local execution service is at capacity"}
+        stats["pending"] += 1
+        # request.dict() is this request's own copy, the worker shares nothing with the other calls
+        future = executor.submit(get_rapidapi_response, request.dict(), request.api_customization, tools_root, schema_root)
+        # a call stays pending until its worker is done with it, not only until it is answered
+        future.add_done_callback(lambda future: loop.call_soon_threadsafe(release))
+        try:
+            # on timeout a call still waiting for a worker is cancelled and never runs
+            return await asyncio.wait_for(asyncio.wrap_future(future), call_timeout)
+        except asyncio.TimeoutError:
+            stats["timeouts"] += 1
+            return {"error": f"Timeout error...no response within {call_timeout:.1f}s", "response": ""}
+        except Exception as e:
+            stats["errors"] += 1
+            return {"error": f"Function executing error...\n{e}", "response": ""}
+
+    @app.get("/stats")
+    async def get_stats():
+        connections = {host: {"requests": request_count, "connections": connection_count} for host, (request_count, connection_count) in tool_session().adapter.connection_counts().items()}
+        return {**stats, "connections": connections}
+
+    @app.on_event("shutdown")
+    def shutdown():
+        executor.shutdown(wait=False)
+
+    return app
+
+
+def app_from_env():
+    # app factory of the uvicorn worker processes, which get the arguments through the environment
+    args = json.loads(os.environ["TOOLBENCH_SERVER_ARGS"])
+    return create_app(args["tools_root"], args["schema_root"], args["max_workers"], args["max_queue"], args["call_timeout"],
+                      args["http_pool_size"], args["http_timeout"], args["http_retries"])
+
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--tools_root', type=str, default="data.toolenv.tools", required=False, help='Module path of the tools, <tools_root>.<category>.<tool>.api.')
+parser.add_argument('--schema_root', type=str, default="data/toolenv/response_examples", required=False, help='Response schemas used to filter the responses, <category>/<tool>.json.')
+parser.add_argument('--host', type=str, default="0.0.0.0", required=False, help='Host to listen on.')
+parser.add_argument('--port', type=int, default=8081, required=False, help='Port to listen on.')
+parser.add_argument('--workers', type=int, default=1, required=False, help='Server processes, each with its own pool of api workers.')
+parser.add_argument('--max_workers', type=int, default=64, required=False, help='Api calls running at once in each process.')
+parser.add_argument('--max_queue', type=int, default=256, required=False, help='Api calls waiting for a worker in each process before requests are turned away.')
+parser.add_argument('--call_timeout', type=float, default=15, required=False, help='Seconds before a call is answered with a timeout error.')
+parser.add_argument('--http_pool_size', type=int, default=64, required=False, help='Keep-alive connections per api host.')
+parser.add_argument('--http_timeout', type=float, default=30, required=False, help='Seconds an api request may wait for data, for the apis that set no timeout.')
+parser.add_argument('--http_retries', type=int, default=2, required=False, help='Retries of an api request after a connection error or a 502/503/504.')
+
+
 if __name__ == "__main__":
-    result = get_rapidapi_response({
-        "category": "Social",
-        "tool_name": "olato_quotes",
-        "api_name": "love_quote",
-        "tool_input": '{}',
-        "strip": "filter",
-        "rapidapi_key": ""
-    })
-    print(result)
\ No newline at end of file
+    import uvicorn
+
+    args = parser.parse_args()
+    if args.workers > 1:
+        os.environ["TOOLBENCH_SERVER_ARGS"] = json.dumps(vars(args))
+        uvicorn.run("toolbench.inference.server:app_from_env", factory=True, host=args.host, port=args.port, workers=args.workers)
+    else:
+        uvicorn.run(create_app(args.tools_root, args.schema_root, args.max_workers, args.max_queue, args.call_timeout,
+                               args.http_pool_size, args.http_timeout, args.http_retries), host=args.host, port=args.port)
@@ -79,6 +79,11 @@ class Model:
         parser.add_argument('--tool_root_dir', type=str, default="your_tools_path/", required=True, help='')
         parser.add_argument("--lora", action="store_true", help="Load lora model or not.")
         parser.add_argument('--lora_path', type=str, default="your_lora_path if lora", required=False, help='')
+        parser.add_argument('--device', type=str, default="cuda", choices=["cuda", "cpu"], required=False, help='device to run toolllama on')
+        parser.add_argument("--load_8bit", action="store_true", help="Load toolllama with int8 weight-only quantization.")
+        parser.add_argument("--load_4bit", action="store_true", help="Load toolllama with int4 weight-only quantization.")
+        parser.add_argument("--kv_cache_int8", action="store_true", help="Keep toolllama's kv cache in int8 with per-head, per-token scales.")
+        parser.add_argument('--draft_model_path', type=str, default=None, required=False, help='speculative decoding for toolllama: a small draft model path, or "prompt_lookup" to draft from the prompt')
         parser.add_argument('--max_observation_length', type=int, default=1024, required=False,
                             help='maximum observation length')
         parser.add_argument('--observ_compress_method', type=str, default="truncate", choices=["truncate", "filter", "random"], 
@@ -4,6 +4,8 @@ import numpy as np
 import math
 from typing import Iterable
 import torch
+import torch.nn.functional as F
+from toolbench.train.llama_flash_attn_monkey_patch import crop_kv_cache
 from transformers.generation.logits_process import (
     LogitsProcessorList,
     RepetitionPenaltyLogitsProcessor,
@@ -38,25 +40,64 @@ def react_parser(string):
     return thought[0], action[0], action_input[0]
 
 # For toolllama's predictions 
+# The warpers below write into the scores they are given instead of allocating new ones
+class InplaceTemperatureLogitsWarper(TemperatureLogitsWarper):
+    def __call__(self, input_ids, scores):
+        return scores.div_(self.temperature)
+
+
+class InplaceRepetitionPenaltyLogitsProcessor(RepetitionPenaltyLogitsProcessor):
+    def __call__(self, input_ids, scores):
+        score = torch.gather(scores, 1, input_ids)
+        # if score < 0 then repetition penalty has to be multiplied to reduce the previous token probability
+        score = torch.where(score < 0, score * self.penalty, score / self.penalty)
+        return scores.scatter_(1, input_ids, score)
+
+
+class InplaceTopPLogitsWarper(TopPLogitsWarper):
+    def __call__(self, input_ids, scores):
+        sorted_logits, sorted_indices = torch.sort(scores, descending=False)
+        cumulative_probs = sorted_logits.softmax(dim=-1).cumsum(dim=-1)
+        # Remove tokens with cumulative top_p above the threshold (token with 0 are kept)
+        sorted_indices_to_remove = cumulative_probs <= (1 - self.top_p)
+        if self.min_tokens_to_keep > 1:
+            sorted_indices_to_remove[..., -self.min_tokens_to_keep :] = 0
+        indices_to_remove = sorted_indices_to_remove.scatter(1, sorted_indices, sorted_indices_to_remove)
+        return scores.masked_fill_(indices_to_remove, self.filter_value)
+
+
+class InplaceTopKLogitsWarper(TopKLogitsWarper):
+    def __call__(self, input_ids, scores):
+        top_k = min(self.top_k, scores.size(-1))
+        indices_to_remove = scores < torch.topk(scores, top_k)[0][..., -1, None]
+        return scores.masked_fill_(indices_to_remove, self.filter_value)
+
+
 def prepare_logits_processor(
     temperature: float, repetition_penalty: float, top_p: float, top_k: int
 ) -> LogitsProcessorList:
     processor_list = LogitsProcessorList()
     # TemperatureLogitsWarper doesn't accept 0.0, 1.0 makes it a no-op so we skip two cases.
     if temperature >= 1e-5 and temperature != 1.0:
-        processor_list.append(TemperatureLogitsWarper(temperature))
+        processor_list.append(InplaceTemperatureLogitsWarper(temperature))
     if repetition_penalty > 1.0:
-        processor_list.append(RepetitionPenaltyLogitsProcessor(repetition_penalty))
+        processor_list.append(InplaceRepetitionPenaltyLogitsProcessor(repetition_penalty))
     if 1e-8 <= top_p < 1.0:
-        processor_list.append(TopPLogitsWarper(top_p))
+        processor_list.append(InplaceTopPLogitsWarper(top_p))
     if top_k > 0:
-        processor_list.append(TopKLogitsWarper(top_k))
+        processor_list.append(InplaceTopKLogitsWarper(top_k))
     return processor_list
 
 @torch.inference_mode()
 def generate_stream(
-    model, tokenizer, params, device, context_len=8192, stream_interval=2, force_generate=False
+    model, tokenizer, params, device, context_len=8192, stream_interval=2, force_generate=False, should_stop=None
 ):
+    """Decode on device: sampled ids are written into a preallocated tensor and fed back
+    without leaving the device, stop tokens are flagged with tensor ops, and the host
+    only syncs every `stream_interval` tokens to see whether generation has stopped.
+    Tokens decoded after a stop token within the same interval are dropped.
+    `should_stop()`, if given, is also asked at every sync; once it returns True the
+    text decoded so far is returned, with no finish reason."""
     prompt = params["prompt"]
     len_prompt = len(prompt)
     temperature = float(params.get("temperature", 1.0))
@@ -66,16 +107,21 @@ def generate_stream(
     max_new_tokens = int(params.get("max_new_tokens", 256))
     stop_str = params.get("stop", None)
     echo = bool(params.get("echo", True))
-    stop_token_ids = params.get("stop_token_ids", None) or []
+    stop_token_ids = list(params.get("stop_token_ids", None) or [])
     stop_token_ids.append(tokenizer.eos_token_id)
 
     logits_processor = prepare_logits_processor(
         temperature, repetition_penalty, top_p, top_k
     )
+    greedy = temperature < 1e-5 or top_p < 1e-8
 
     input_ids = tokenizer(prompt).input_ids
     input_echo_len = len(input_ids)
-    output_ids = list(input_ids)
+    # prompt followed by every generated id, filled in place as decoding goes
+    output_ids = torch.empty((1, input_echo_len + max_new_tokens), dtype=torch.long, device=device)
+    output_ids[0, :input_echo_len] = torch.as_tensor(input_ids, device=device)
+    stop_ids = torch.as_tensor(stop_token_ids, device=device)
+    stop_flags = torch.zeros(max_new_tokens, dtype=torch.bool, device=device)
 
     if model.config.is_encoder_decoder:
         max_src_len = context_len
@@ -95,7 +141,10 @@ def generate_stream(
         )
 
     past_key_values = out = None
+    stopped = False
+    checked = 0  # steps whose stop flags were already read back
     for i in range(max_new_tokens):
+        cur_len = input_echo_len + i
         if i == 0:
             if model.config.is_encoder_decoder:
                 out = model.decoder(
@@ -109,9 +158,10 @@ def generate_stream(
                 logits = out.logits
             past_key_values = out.past_key_values
         else:
+            token_ids = output_ids[:, cur_len - 1 : cur_len]
             if model.config.is_encoder_decoder:
                 out = model.decoder(
-                    input_ids=torch.as_tensor([[token]], device=device),
+                    input_ids=token_ids,
                     encoder_hidden_states=encoder_output,
                     use_cache=True,
                     past_key_values=past_key_values,
@@ -120,81 +170,94 @@ def generate_stream(
                 logits = model.lm_head(out[0])
             else:
                 out = model(
-                    input_ids=torch.as_tensor([[token]], device=device),
+                    input_ids=token_ids,
                     use_cache=True,
                     past_key_values=past_key_values,
                 )
                 logits = out.logits
             past_key_values = out.past_key_values
 
+        last_token_logits = logits[:, -1, :]
+        if device == "mps":
+            # Switch to CPU by avoiding some bugs in mps backend.
+            last_token_logits = last_token_logits.float().to("cpu")
+
         if logits_processor:
             if repetition_penalty > 1.0:
-                tmp_output_ids = torch.as_tensor([output_ids], device=logits.device)
+                tmp_output_ids = output_ids[:, :cur_len].to(last_token_logits.device)
             else:
                 tmp_output_ids = None
-            last_token_logits = logits_processor(tmp_output_ids, logits[:, -1, :])[0]
-        else:
-            last_token_logits = logits[0, -1, :]
-
-        if device == "mps":
-            # Switch to CPU by avoiding some bugs in mps backend.
-            last_token_logits = last_token_logits.float().to("cpu")
+            last_token_logits = logits_processor(tmp_output_ids, last_token_logits)
 
-        if temperature < 1e-5 or top_p < 1e-8:  # greedy
-            token = int(torch.argmax(last_token_logits))
+        if greedy:
+            token = torch.argmax(last_token_logits, dim=-1)
         else:
             probs = torch.softmax(last_token_logits, dim=-1)
-            token = int(torch.multinomial(probs, num_samples=1))
+            token = torch.multinomial(probs, num_samples=1)[:, 0]
+        output_ids[:, cur_len].copy_(token)
 
-        output_ids.append(token)
+        if i > 0 or not force_generate:
+            stop_flags[i : i + 1] = torch.isin(output_ids[:, cur_len], stop_ids)
+        if (i + 1) % stream_interval == 0 or i == max_new_tokens - 1:
+            hits = torch.nonzero(stop_flags[checked : i + 1]).flatten().tolist()
+            if len(hits) > 0:
+                i = checked + hits[0]
+                stopped = True
+            checked = i + 1
+            if not stopped and should_stop is not None and should_stop():
+                break
+        if stopped or i == max_new_tokens - 1:
+            break
+
+    yield from stream_outputs(
+        tokenizer, output_ids, input_echo_len, len_prompt, i, max_new_tokens, stopped, echo, stop_str
+    )
+
+    # clean
+    del past_key_values, out
+    gc.collect()
+    torch.cuda.empty_cache()
 
-        if token in stop_token_ids:
-            stopped = True
+
+def stream_outputs(tokenizer, output_ids, input_echo_len, len_prompt, i, max_new_tokens, stopped, echo, stop_str):
+    """Last text event and finish event of a generation whose final token is the i-th one."""
+    if echo:
+        tmp_output_ids = output_ids[0, : input_echo_len + i + 1].tolist()
+        rfind_start = len_prompt
+    else:
+        tmp_output_ids = output_ids[0, input_echo_len : input_echo_len + i + 1].tolist()
+        rfind_start = 0
+
+    output = tokenizer.decode(
+        tmp_output_ids,
+        skip_special_tokens=True,
+        spaces_between_special_tokens=False,
+    )
+    if stop_str:
+        if isinstance(stop_str, str):
+            pos = output.rfind(stop_str, rfind_start)
+            if pos != -1:
+                output = output[:pos]
+                stopped = True
+        elif isinstance(stop_str, Iterable):
+            for each_stop in stop_str:
+                pos = output.rfind(each_stop, rfind_start)
+                if pos != -1:
+                    output = output[:pos]
+                    stopped = True
+                    break
         else:
-            stopped = False
-        if i == 0 and force_generate:
-            stopped = False
-        if i == max_new_tokens - 1 or stopped:
-            if echo:
-                tmp_output_ids = output_ids
-                rfind_start = len_prompt
-            else:
-                tmp_output_ids = output_ids[input_echo_len:]
-                rfind_start = 0
+            raise ValueError("Invalid stop field type.")
 
-            output = tokenizer.decode(
-                tmp_output_ids,
-                skip_special_tokens=True,
-                spaces_between_special_tokens=False,
-            )
-            if stop_str:
-                if isinstance(stop_str, str):
-                    pos = output.rfind(stop_str, rfind_start)
-                    if pos != -1:
-                        output = output[:pos]
-                        stopped = True
-                elif isinstance(stop_str, Iterable):
-                    for each_stop in stop_str:
-                        pos = output.rfind(each_stop, rfind_start)
-                        if pos != -1:
-                            output = output[:pos]
-                            stopped = True
-                            break
-                else:
-                    raise ValueError("Invalid stop field type.")
-
-            yield {
-                "text": output,
-                "usage": {
-                    "prompt_tokens": input_echo_len,
-                    "completion_tokens": i,
-                    "total_tokens": input_echo_len + i,
-                },
-                "finish_reason": None,
-            }
-
-        if stopped:
-            break
+    yield {
+        "text": output,
+        "usage": {
+            "prompt_tokens": input_echo_len,
+            "completion_tokens": i,
+            "total_tokens": input_echo_len + i,
+        },
+        "finish_reason": None,
+    }
 
     # finish stream event, which contains finish reason
     if i == max_new_tokens - 1:
@@ -214,10 +277,316 @@ def generate_stream(
         "finish_reason": finish_reason,
     }
 
+
+# For batched decoding
+@torch.inference_mode()
+def generate_batch(
+    model, tokenizer, params, prompts, device, context_len=8192, stream_interval=2, force_generate=False, should_stop=None
+):
+    """Decode several prompts with the same params together, one forward pass per step for the whole batch.
+    Prompts are left padded, finished rows keep decoding padding until every row stopped.
+    Returns the final text of each prompt, as the last event of generate_stream with echo=False would,
+    and the number of tokens generated for it.
+    `should_stop()`, if given, returns one bool per prompt at every sync; rows it marks end there."""
+    assert not model.config.is_encoder_decoder, "generate_batch only supports decoder-only models"
+    temperature = float(params.get("temperature", 1.0))
+    repetition_penalty = float(params.get("repetition_penalty", 1.0))
+    top_p = float(params.get("top_p", 1.0))
+    top_k = int(params.get("top_k", -1))  # -1 means disable
+    max_new_tokens = int(params.get("max_new_tokens", 256))
+    stop_str = params.get("stop", None)
+    stop_token_ids = list(params.get("stop_token_ids", None) or [])
+    stop_token_ids.append(tokenizer.eos_token_id)
+
+    logits_processor = prepare_logits_processor(
+        temperature, repetition_penalty, top_p, top_k
+    )
+    greedy = temperature < 1e-5 or top_p < 1e-8
+
+    max_src_len = context_len - max_new_tokens - 8
+    input_ids = [tokenizer(prompt).input_ids[-max_src_len:] for prompt in prompts]
+    batch_size = len(input_ids)
+    input_len = max(len(ids) for ids in input_ids)
+    pad_token_id = tokenizer.pad_token_id if tokenizer.pad_token_id is not None else tokenizer.eos_token_id
+    output_ids = torch.full((batch_size, input_len + max_new_tokens), pad_token_id, dtype=torch.long, device=device)
+    attention_mask = torch.zeros((batch_size, input_len + max_new_tokens), dtype=torch.long, device=device)
+    for row, ids in enumerate(input_ids):
+        output_ids[row, input_len - len(ids) : input_len] = torch.as_tensor(ids, device=device)
+        attention_mask[row, input_len - len(ids) :] = 1
+    position_ids = (attention_mask[:, :input_len].cumsum(-1) - 1).clamp(min=0)
+    stop_ids = torch.as_tensor(stop_token_ids, device=device)
+    finished = torch.zeros(batch_size, dtype=torch.bool, device=device)
+    # index of the last generated token of each row, the stop token included
+    last_index = torch.full((batch_size,), max_new_tokens - 1, dtype=torch.long, device=device)
+
+    past_key_values = out = None
+    for i in range(max_new_tokens):
+        cur_len = input_len + i
+        if i == 0:
+            out = model(
+                input_ids=output_ids[:, :input_len],
+                attention_mask=attention_mask[:, :input_len],
+                position_ids=position_ids,
+                use_cache=True,
+            )
+        else:
+            out = model(
+                input_ids=output_ids[:, cur_len - 1 : cur_len],
+                attention_mask=attention_mask[:, :cur_len],
+                position_ids=position_ids,
+                use_cache=True,
+                past_key_values=past_key_values,
+            )
+        past_key_values = out.past_key_values
+        position_ids = position_ids[:, -1:] + 1
+
+        last_token_logits = out.logits[:, -1, :]
+        if device == "mps":
+            # Switch to CPU by avoiding some bugs in mps backend.
+            last_token_logits = last_token_logits.float().to("cpu")
+
+        if logits_processor:
+            if repetition_penalty > 1.0:
+                tmp_output_ids = output_ids[:, :cur_len].to(last_token_logits.device)
+            else:
+                tmp_output_ids = None
+            last_token_logits = logits_processor(tmp_output_ids, last_token_logits)
+
+        if greedy:
+            token = torch.argmax(last_token_logits, dim=-1)
+        else:
+            probs = torch.softmax(last_token_logits, dim=-1)
+            token = torch.multinomial(probs, num_samples=1)[:, 0]
+        token = token.to(device).masked_fill_(finished, pad_token_id)
+        output_ids[:, cur_len].copy_(token)
+
+        if i > 0 or not force_generate:
+            stopped = torch.isin(token, stop_ids) & ~finished
+            last_index.masked_fill_(stopped, i)
+            finished |= stopped
+        if (i + 1) % stream_interval == 0 or i == max_new_tokens - 1:
+            if should_stop is not None:
+                interrupted = torch.as_tensor(should_stop(), dtype=torch.bool, device=device) & ~finished
+                last_index.masked_fill_(interrupted, i)
+                finished |= interrupted
+            if bool(finished.all()):
+                break
+
+    outputs = []
+    for row, i in enumerate(last_index.tolist()):
+        output = tokenizer.decode(
+            output_ids[row, input_len : input_len + i + 1].tolist(),
+            skip_special_tokens=True,
+            spaces_between_special_tokens=False,
+        )
+        if stop_str:
+            for each_stop in ([stop_str] if isinstance(stop_str, str) else stop_str):
+                pos = output.rfind(each_stop)
+                if pos != -1:
+                    output = output[:pos]
+                    break
+        outputs.append((output, i))
+
     # clean
     del past_key_values, out
     gc.collect()
     torch.cuda.empty_cache()
+    return outputs
+
+
+# For speculative decoding
+class SpeculativeStats:
+    """Draft acceptance counters, accumulated over generations."""
+
+    def __init__(self):
+        self.drafted = 0
+        self.accepted = 0
+        self.generated = 0
+        self.target_forwards = 0
+
+    @property
+    def acceptance_rate(self):
+        return self.accepted / max(self.drafted, 1)
+
+    @property
+    def tokens_per_forward(self):
+        return self.generated / max(self.target_forwards, 1)
+
+    def __repr__(self):
+        return (
+            f"accepted {self.accepted}/{self.drafted} drafted tokens ({self.acceptance_rate:.1%}), "
+            f"{self.tokens_per_forward:.2f} tokens per target forward"
+        )
+
+
+def prompt_lookup_draft(ids, num_draft_tokens, max_ngram=3):
+    """Propose the tokens that followed the latest earlier occurrence of the current suffix.
+
+    Tool calls mostly copy names and argument values from the prompt and observations,
+    so the longest suffix (up to `max_ngram` tokens) found earlier in `ids` is a cheap guess.
+    """
+    cur_len = ids.shape[0]
+    for n in range(min(max_ngram, cur_len - 1), 0, -1):
+        windows = ids[: cur_len - 1].unfold(0, n, 1)
+        matches = torch.nonzero((windows == ids[cur_len - n :]).all(dim=1)).flatten()
+        if len(matches) > 0:
+            start = int(matches[-1]) + n
+            return ids[start : start + num_draft_tokens]
+    return ids[:0]
+
+
+def crop_past_key_values(past_key_values, length):
+    # every cache tensor, plain or int8 with scales, is laid out [bsz, heads, seq, ...]. The int8 cache keeps being
+    # appended to in place after the crop, past_key_values must not be used anymore
+    return tuple(tuple(crop_kv_cache(states, length) for states in layer) for layer in past_key_values)
+
+
+def process_scores(logits_processor, output_ids, end, scores, vocab_size):
+    """Run the logits processors on one row of scores, with output_ids[:, :end] as history."""
+    if scores.shape[-1] < vocab_size:
+        scores = F.pad(scores, (0, vocab_size - scores.shape[-1]), value=-float("inf"))
+    scores = scores[:, :vocab_size]
+    if logits_processor:
+        scores = logits_processor(output_ids[:, :end], scores)
+    return scores
+
+
+@torch.inference_mode()
+def generate_stream_speculative(
+    model, tokenizer, params, device, context_len=8192, draft_model=None, num_draft_tokens=5, stats=None, force_generate=False, should_stop=None
+):
+    """generate_stream with speculative decoding.
+
+    Each step drafts up to `num_draft_tokens` tokens, with `draft_model` or by prompt lookup
+    when it is None, and verifies all of them with a single forward of `model`. Accepted
+    drafts are kept and one more token comes from the target's own distribution, so greedy
+    outputs are the same as plain decoding and sampled outputs follow the same distribution.
+    `should_stop()` is asked after every step, as in generate_stream.
+    """
+    prompt = params["prompt"]
+    len_prompt = len(prompt)
+    temperature = float(params.get("temperature", 1.0))
+    repetition_penalty = float(params.get("repetition_penalty", 1.0))
+    top_p = float(params.get("top_p", 1.0))
+    top_k = int(params.get("top_k", -1))  # -1 means disable
+    max_new_tokens = int(params.get("max_new_tokens", 256))
+    stop_str = params.get("stop", None)
+    echo = bool(params.get("echo", True))
+    stop_token_ids = set(params.get("stop_token_ids", None) or [])
+    stop_token_ids.add(tokenizer.eos_token_id)
+    assert not model.config.is_encoder_decoder, "speculative decoding needs a decoder-only model"
+    stats = stats if stats is not None else SpeculativeStats()
+
+    logits_processor = prepare_logits_processor(
+        temperature, repetition_penalty, top_p, top_k
+    )
+    greedy = temperature < 1e-5 or top_p < 1e-8
+    vocab_size = model.get_output_embeddings().out_features
+    if draft_model is not None:
+        draft_vocab_size = draft_model.get_input_embeddings().num_embeddings
+        unk_token_id = tokenizer.unk_token_id if tokenizer.unk_token_id is not None else 0
+
+    input_ids = tokenizer(prompt).input_ids
+    input_echo_len = len(input_ids)
+    output_ids = torch.empty((1, input_echo_len + max_new_tokens + num_draft_tokens), dtype=torch.long, device=device)
+    output_ids[0, :input_echo_len] = torch.as_tensor(input_ids, device=device)
+    # the models only see the last max_src_len prompt tokens, positions below are relative to it
+    max_src_len = context_len - max_new_tokens - num_draft_tokens - 8
+    src_start = max(input_echo_len - max_src_len, 0)
+    context = output_ids[:, src_start:]
+    cur_len = input_echo_len - src_start
+
+    # both caches hold everything but the last token, which is fed with the drafts
+    target_past = draft_past = None
+    if cur_len > 1:
+        target_past = model(context[:, : cur_len - 1], use_cache=True).past_key_values
+    draft_len = 0
+
+    generated = 0
+    stopped = False
+    while generated < max_new_tokens and not stopped:
+        num_draft = min(num_draft_tokens, max_new_tokens - generated - 1)
+        draft_probs = []
+        if draft_model is None:
+            drafts = prompt_lookup_draft(context[0, :cur_len], num_draft)
+            num_draft = len(drafts)
+            context[0, cur_len : cur_len + num_draft] = drafts
+        else:
+            for j in range(num_draft):
+                draft_input = context[:, draft_len : cur_len + j]
+                # tokens the draft vocabulary lacks (e.g. an added pad token) are shown to it as unk
+                draft_input = torch.where(draft_input < draft_vocab_size, draft_input, unk_token_id)
+                out = draft_model(draft_input, past_key_values=draft_past, use_cache=True)
+                draft_past, draft_len = out.past_key_values, cur_len + j
+                scores = process_scores(logits_processor, output_ids, src_start + cur_len + j, out.logits[:, -1, :], vocab_size)
+                if greedy:
+                    context[0, cur_len + j] = torch.argmax(scores, dim=-1)[0]
+                else:
+                    probs = torch.softmax(scores, dim=-1)
+                    draft_probs.append(probs[0])
+                    context[0, cur_len + j] = torch.multinomial(probs, num_samples=1)[0, 0]
+            drafts = context[0, cur_len : cur_len + num_draft]
+
+        # verify the last token and all drafts in one forward
+        out = model(context[:, cur_len - 1 : cur_len + num_draft], past_key_values=target_past, use_cache=True)
+        target_past = out.past_key_values
+        stats.target_forwards += 1
+        stats.drafted += num_draft
+
+        draft_list = drafts.tolist()
+        num_accepted = 0
+        for j in range(num_draft + 1):
+            scores = process_scores(logits_processor, output_ids, src_start + cur_len + j, out.logits[:, j, :], vocab_size)
+            if greedy:
+                token = int(torch.argmax(scores, dim=-1))
+                if j < num_draft and token == draft_list[j]:
+                    num_accepted += 1
+                    continue
+                break
+            probs = torch.softmax(scores, dim=-1)[0]
+            if j == num_draft:
+                token = int(torch.multinomial(probs, num_samples=1))
+                break
+            draft = draft_list[j]
+            draft_prob = draft_probs[j][draft] if draft_model is not None else 1.0
+            if torch.rand(()) * draft_prob < probs[draft]:
+                num_accepted += 1
+                continue
+            # rejected, resample from what the target wants beyond the draft
+            residual = probs - (draft_probs[j] if draft_model is not None else F.one_hot(drafts[j], probs.shape[-1]).to(probs.dtype))
+            residual = residual.clamp_(min=0)
+            if residual.sum() <= 0:
+                residual = probs
+            token = int(torch.multinomial(residual, num_samples=1))
+            break
+        context[0, cur_len + num_accepted] = token
+        stats.accepted += num_accepted
+
+        new_tokens = draft_list[:num_accepted] + [token]
+        for j, new_token in enumerate(new_tokens):
+            if new_token in stop_token_ids and not (force_generate and generated + j == 0):
+                new_tokens = new_tokens[: j + 1]
+                stopped = True
+                break
+        generated += len(new_tokens)
+        cur_len += len(new_tokens)
+        stats.generated += len(new_tokens)
+
+        # drop cache entries of rejected drafts
+        target_past = crop_past_key_values(target_past, cur_len - 1)
+        if draft_past is not None and draft_len > cur_len - 1:
+            draft_past, draft_len = crop_past_key_values(draft_past, cur_len - 1), cur_len - 1
+        if not stopped and should_stop is not None and should_stop():
+            break
+
+    yield from stream_outputs(
+        tokenizer, output_ids, input_echo_len, len_prompt, generated - 1, max_new_tokens, stopped, echo, stop_str
+    )
+
+    # clean
+    del target_past, draft_past, out
+    gc.collect()
+    torch.cuda.empty_cache()
 
 # For IO presentation
 class ChatIO(abc.ABC):
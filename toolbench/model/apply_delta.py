@@ -5,69 +5,191 @@ Usage:
 python3 -m fastchat.model.apply_delta --base ~/model_weights/llama-7b --target ~/model_weights/vicuna-7b --delta lmsys/vicuna-7b-delta-v1.1
 """
 import argparse
-import gc
 import glob
 import json
 import os
 import shutil
-import tempfile
+from collections import OrderedDict
+from multiprocessing import Pool
 
 from huggingface_hub import snapshot_download
+from safetensors import safe_open
+from safetensors.torch import save_file
 import torch
-from torch import nn
 from tqdm import tqdm
 from transformers import AutoTokenizer, AutoModelForCausalLM, AutoConfig
 
 
 GB = 1 << 30
+SAFE_WEIGHTS_INDEX_NAME = "model.safetensors.index.json"
+WEIGHTS_INDEX_NAME = "pytorch_model.bin.index.json"
 
 
-def split_files(model_path, tmp_path, split_size):
+def resolve_model_path(model_path):
     if not os.path.exists(model_path):
         model_path = snapshot_download(repo_id=model_path)
-    if not os.path.exists(tmp_path):
-        os.makedirs(tmp_path)
-
-    file_pattern = os.path.join(model_path, "pytorch_model-*.bin")
-    files = glob.glob(file_pattern)
-
-    part = 0
-    try:
-        for file_path in tqdm(files):
-            state_dict = torch.load(file_path)
-            new_state_dict = {}
-
-            current_size = 0
-            for name, param in state_dict.items():
-                param_size = param.numel() * param.element_size()
-
-                if current_size + param_size > split_size:
-                    new_file_name = f"pytorch_model-{part}.bin"
-                    new_file_path = os.path.join(tmp_path, new_file_name)
-                    torch.save(new_state_dict, new_file_path)
-                    current_size = 0
-                    new_state_dict = None
-                    gc.collect()
-                    new_state_dict = {}
-                    part += 1
-
-                new_state_dict[name] = param
-                current_size += param_size
-
-            new_file_name = f"pytorch_model-{part}.bin"
-            new_file_path = os.path.join(tmp_path, new_file_name)
-            torch.save(new_state_dict, new_file_path)
-            new_state_dict = None
-            gc.collect()
-            new_state_dict = {}
-            part += 1
-    except Exception as e:
-        print(f"An error occurred during split_files: {e}")
-        shutil.rmtree(tmp_path)
-        raise
-
-
-def apply_delta_low_cpu_mem(base_model_path, target_model_path, delta_path):
+    return model_path
+
+
+def load_weight_map(model_path):
+    """Map every tensor name of a checkpoint to the file holding it, without reading any weights."""
+    for index_name in (SAFE_WEIGHTS_INDEX_NAME, WEIGHTS_INDEX_NAME):
+        index_path = os.path.join(model_path, index_name)
+        if os.path.exists(index_path):
+            with open(index_path, "r") as f:
+                weight_map = json.load(f)["weight_map"]
+            return {name: os.path.join(model_path, file_name) for name, file_name in weight_map.items()}
+
+    files = sorted(glob.glob(os.path.join(model_path, "*.safetensors")))
+    if len(files) == 0:
+        files = sorted(glob.glob(os.path.join(model_path, "pytorch_model*.bin")))
+    if len(files) == 0:
+        raise FileNotFoundError(f"No weight files found in {model_path}")
+    weight_map = {}
+    for file_path in files:
+        with ShardReader(file_path) as reader:
+            for name in reader.keys():
+                weight_map[name] = file_path
+    return weight_map
+
+
+class ShardReader:
+    """Tensor-at-a-time access to one weight file.
+
+    safetensors files are memory-mapped through `safe_open`; `.bin` files are loaded with
+    `mmap=True`, so in both cases only the tensors actually read are paged in. Files that cannot
+    be memory-mapped are loaded whole, close() the reader to free them.
+    """
+
+    def __init__(self, file_path):
+        self.file_path = file_path
+        if file_path.endswith(".safetensors"):
+            self.handle = safe_open(file_path, framework="pt", device="cpu")
+            self.state_dict = None
+        else:
+            self.handle = None
+            try:
+                self.state_dict = torch.load(file_path, map_location="cpu", mmap=True)
+            except (RuntimeError, TypeError):
+                # legacy (non-zip) checkpoints cannot be memory-mapped, and torch < 2.1 has no mmap argument
+                print(f"Cannot memory-map {file_path}, loading it fully")
+                self.state_dict = torch.load(file_path, map_location="cpu")
+
+    def close(self):
+        self.handle = None
+        self.state_dict = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def keys(self):
+        if self.handle is not None:
+            return list(self.handle.keys())
+        return list(self.state_dict.keys())
+
+    def get_tensor(self, name):
+        if self.handle is not None:
+            return self.handle.get_tensor(name)
+        return self.state_dict[name]
+
+    def get_nbytes(self, name, dtype):
+        if self.handle is not None:
+            shape = self.handle.get_slice(name).get_shape()
+        else:
+            shape = self.state_dict[name].shape
+        numel = 1
+        for dim in shape:
+            numel *= dim
+        return numel * torch.tensor([], dtype=dtype).element_size()
+
+
+class CheckpointReader:
+    """Look up tensors by name across the files of a checkpoint, keeping the `max_open` files last read open."""
+
+    def __init__(self, weight_map, max_open=2):
+        self.weight_map = weight_map
+        self.max_open = max_open
+        self.readers = OrderedDict()
+
+    def reader(self, name):
+        file_path = self.weight_map[name]
+        if file_path in self.readers:
+            self.readers.move_to_end(file_path)
+        else:
+            while len(self.readers) >= self.max_open:
+                self.readers.popitem(last=False)[1].close()
+            self.readers[file_path] = ShardReader(file_path)
+        return self.readers[file_path]
+
+    def close(self):
+        for reader in self.readers.values():
+            reader.close()
+        self.readers.clear()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def get_tensor(self, name):
+        return self.reader(name).get_tensor(name)
+
+    def get_nbytes(self, name, dtype):
+        return self.reader(name).get_nbytes(name, dtype)
+
+
+def plan_shards(base_map, dtype, max_shard_size):
+    """Group tensor names into output shards of at most `max_shard_size` bytes, in base file order."""
+    names = sorted(base_map, key=lambda name: base_map[name])
+    shards = [[]]
+    shard_size = 0
+    total_size = 0
+    # one base file open at a time, names are grouped by file
+    with CheckpointReader(base_map, max_open=1) as base:
+        sizes = [base.get_nbytes(name, dtype) for name in names]
+    for name, nbytes in zip(names, sizes):
+        if shard_size + nbytes > max_shard_size and len(shards[-1]) > 0:
+            shards.append([])
+            shard_size = 0
+        shards[-1].append(name)
+        shard_size += nbytes
+        total_size += nbytes
+    return shards, total_size
+
+
+# Per-process weight maps, set up once by the pool initializer
+worker_base_map = None
+worker_delta_map = None
+
+
+def init_worker(base_map, delta_map):
+    global worker_base_map, worker_delta_map
+    torch.set_num_threads(1)
+    worker_base_map = base_map
+    worker_delta_map = delta_map
+
+
+def apply_delta_shard(job):
+    """Add the delta to one output shard worth of tensors and write it as a safetensors file."""
+    names, dtype, output_path = job
+    state_dict = {}
+    # the input files are only open while this shard is written, a file loaded whole does not stay in memory
+    with CheckpointReader(worker_base_map) as base, CheckpointReader(worker_delta_map) as delta:
+        for name in names:
+            param = base.get_tensor(name).to(dtype)
+            state_dict[name] = param + delta.get_tensor(name).to(dtype)
+    save_file(state_dict, output_path + ".tmp", metadata={"format": "pt"})
+    os.replace(output_path + ".tmp", output_path)
+    return os.path.basename(output_path), names
+
+
+def apply_delta_low_cpu_mem(base_model_path, target_model_path, delta_path, num_workers=4, max_shard_size=2 * GB, dtype=torch.float16):
+    delta_path = resolve_model_path(delta_path)
+    base_model_path = resolve_model_path(base_model_path)
     delta_tokenizer = AutoTokenizer.from_pretrained(delta_path, use_fast=False)
     delta_config = AutoConfig.from_pretrained(delta_path)
 
@@ -75,49 +197,32 @@ def apply_delta_low_cpu_mem(base_model_path, target_model_path, delta_path):
         shutil.rmtree(target_model_path)
     os.makedirs(target_model_path)
 
-    split_size = 4 * GB
-
-    with tempfile.TemporaryDirectory() as tmp_base_path, tempfile.TemporaryDirectory() as tmp_delta_path:
-        print(f"Split files for the base model to {tmp_base_path}")
-        split_files(base_model_path, tmp_base_path, split_size)
-        print(f"Split files for the delta weights to {tmp_delta_path}")
-        split_files(delta_path, tmp_delta_path, split_size)
-
-        base_pattern = os.path.join(tmp_base_path, "pytorch_model-*.bin")
-        base_files = glob.glob(base_pattern)
-        delta_pattern = os.path.join(tmp_delta_path, "pytorch_model-*.bin")
-        delta_files = glob.glob(delta_pattern)
-        delta_state_dict = torch.load(delta_files[0])
-
-        print("Applying the delta")
-        weight_map = {}
-        total_size = 0
-
-        for i, base_file in tqdm(enumerate(base_files)):
-            state_dict = torch.load(base_file)
-            file_name = f"pytorch_model-{i}.bin"
-            for name, param in state_dict.items():
-                if name not in delta_state_dict:
-                    for delta_file in delta_files:
-                        delta_state_dict = torch.load(delta_file)
-                        gc.collect()
-                        if name in delta_state_dict:
-                            break
-
-                state_dict[name] += delta_state_dict[name]
+    base_map = load_weight_map(base_model_path)
+    delta_map = load_weight_map(delta_path)
+    missing = [name for name in base_map if name not in delta_map]
+    assert len(missing) == 0, f"{len(missing)} tensors of the base model are missing in the delta, e.g. {missing[:3]}"
+
+    shards, total_size = plan_shards(base_map, dtype, max_shard_size)
+    jobs = [
+        (names, dtype, os.path.join(target_model_path, f"model-{i + 1:05d}-of-{len(shards):05d}.safetensors"))
+        for i, names in enumerate(shards)
+    ]
+
+    # Each worker holds at most one output shard in memory; inputs are memory-mapped
+    print(f"Applying the delta into {len(jobs)} shards with {num_workers} workers")
+    weight_map = {}
+    with Pool(min(num_workers, len(jobs)), initializer=init_worker, initargs=(base_map, delta_map)) as pool:
+        for file_name, names in tqdm(pool.imap_unordered(apply_delta_shard, jobs), total=len(jobs)):
+            for name in names:
                 weight_map[name] = file_name
-                total_size += param.numel() * param.element_size()
-                gc.collect()
-            torch.save(state_dict, os.path.join(target_model_path, file_name))
 
-        with open(
-            os.path.join(target_model_path, "pytorch_model.bin.index.json"), "w"
-        ) as f:
-            json.dump(
-                {"weight_map": weight_map, "metadata": {"total_size": total_size}}, f
-            )
+    with open(os.path.join(target_model_path, SAFE_WEIGHTS_INDEX_NAME), "w") as f:
+        json.dump(
+            {"metadata": {"total_size": total_size}, "weight_map": dict(sorted(weight_map.items()))}, f, indent=2
+        )
 
     print(f"Saving the target model to {target_model_path}")
+    delta_config.torch_dtype = dtype
     delta_tokenizer.save_pretrained(target_model_path)
     delta_config.save_pretrained(target_model_path)
 
@@ -152,14 +257,31 @@ if __name__ == "__main__":
     parser.add_argument(
         "--low-cpu-mem",
         action="store_true",
-        help="Lower the cpu memory usage. This will split large files and use "
-        "disk as swap to reduce the memory usage below 10GB.",
+        help="Lower the cpu memory usage. Base and delta weights are memory-mapped and "
+        "the target is written one safetensors shard at a time, so each worker only "
+        "needs about --max-shard-size of memory.",
+    )
+    parser.add_argument(
+        "--num-workers",
+        type=int,
+        default=4,
+        help="Number of output shards written in parallel with --low-cpu-mem.",
+    )
+    parser.add_argument(
+        "--max-shard-size",
+        type=float,
+        default=2,
+        help="Maximum size of an output shard in GB with --low-cpu-mem.",
     )
     args = parser.parse_args()
 
     if args.low_cpu_mem:
         apply_delta_low_cpu_mem(
-            args.base_model_path, args.target_model_path, args.delta_path
+            args.base_model_path,
+            args.target_model_path,
+            args.delta_path,
+            num_workers=args.num_workers,
+            max_shard_size=int(args.max_shard_size * GB),
         )
     else:
         apply_delta(args.base_model_path, args.target_model_path, args.delta_path)
@@ -1,9 +1,15 @@
 import dataclasses
+import glob
 import os
 
+from accelerate import init_empty_weights
+from accelerate.utils import set_module_tensor_to_device
+from huggingface_hub import snapshot_download
+from safetensors import safe_open
 import torch
 import torch.nn as nn
 from torch.nn import functional as F
+from tqdm import tqdm
 from transformers import AutoTokenizer, AutoModelForCausalLM, AutoConfig
 
 
@@ -22,88 +28,178 @@ default_compression_config = CompressionConfig(
     num_bits=8, group_size=256, group_dim=1, symmetric=True, enabled=True
 )
 
+int4_compression_config = CompressionConfig(
+    num_bits=4, group_size=128, group_dim=1, symmetric=True, enabled=True
+)
+
+# Output rows dequantized at a time by CLinear on CPU, bounds the float workspace
+CLINEAR_BLOCK_ROWS = 512
+
+
+def pack_int4(data):
+    """Pack pairs of int4 values in [-7, 7] along the last dim into single bytes."""
+    data = (data + 8).to(torch.uint8)
+    return data[..., 0::2] | (data[..., 1::2] << 4)
+
+
+def unpack_int4(packed):
+    low = (packed & 0x0F).to(torch.int8) - 8
+    high = (packed >> 4).to(torch.int8) - 8
+    return torch.stack([low, high], dim=-1).flatten(-2)
+
 
 class CLinear(nn.Module):
-    """Compressed Linear Layer."""
+    """Compressed Linear Layer.
+
+    The weight is kept group-wise quantized along the input dim (int8, or two int4 values
+    packed per byte) with one scale per group, and only dequantized inside the matmul.
+    On CPU this happens CLINEAR_BLOCK_ROWS output rows at a time, so the full float weight
+    is never materialized.
+    """
 
-    def __init__(self, weight=None, bias=None, device=None):
+    def __init__(self, weight=None, bias=None, device=None, config=default_compression_config):
         super().__init__()
-        self.weight = weight
+        assert config.symmetric and config.group_dim == 1, "CLinear only supports symmetric groups along the input dim"
+        if isinstance(weight, torch.Tensor):
+            weight = compress(weight.data.to(device), config)
+        data, scale, original_shape = weight
+        self.config = config
+        self.out_features, self.in_features = original_shape
+        if config.num_bits == 4:
+            data = pack_int4(data)
+        self.register_buffer("weight", data.to(device))
+        # inverse scale, so dequantizing is a multiply
+        self.register_buffer("scale", (1 / scale).to(device))
+        if bias is not None:
+            bias = nn.Parameter(bias.data.to(device), requires_grad=False)
         self.bias = bias
 
+    def dequantize(self, start=0, end=None, dtype=torch.float16):
+        """Float weight of output rows [start, end)."""
+        data = self.weight[start:end]
+        if self.config.num_bits == 4:
+            data = unpack_int4(data)
+        weight = data.to(dtype) * self.scale[start:end].to(dtype)
+        return weight.reshape(weight.shape[0], -1)[:, : self.in_features]
+
     def forward(self, input):
-        return F.linear(input.to(self.weight.dtype), self.weight, self.bias)
+        bias = None if self.bias is None else self.bias.to(input.dtype)
+        if input.device.type != "cpu":
+            return F.linear(input, self.dequantize(dtype=input.dtype), bias)
+
+        x = input.reshape(-1, self.in_features)
+        output = torch.empty(x.shape[0], self.out_features, dtype=input.dtype, device=input.device)
+        for start in range(0, self.out_features, CLINEAR_BLOCK_ROWS):
+            end = min(start + CLINEAR_BLOCK_ROWS, self.out_features)
+            output[:, start:end] = torch.matmul(x, self.dequantize(start, end, input.dtype).t())
+        if bias is not None:
+            output += bias
+        return output.reshape(*input.shape[:-1], self.out_features)
 
+    def extra_repr(self):
+        return f"in_features={self.in_features}, out_features={self.out_features}, num_bits={self.config.num_bits}, group_size={self.config.group_size}"
 
-def compress_module(module, target_device):
+
+def compress_module(module, target_device, config=default_compression_config, skip_modules=("lm_head",)):
     for name, child in module.named_children():
         if isinstance(child, nn.Linear):
-            setattr(
-                module,
-                name,
-                CLinear(child.weight, child.bias, target_device),
-            )
-            compress_module(child, target_device)
+            if name not in skip_modules:
+                setattr(
+                    module,
+                    name,
+                    CLinear(child.weight, child.bias, target_device, config),
+                )
+        else:
+            compress_module(child, target_device, config, skip_modules)
 
 
-def get_compressed_list(module, prefix=""):
+def get_compressed_list(module, prefix="", skip_modules=("lm_head",)):
     compressed_list = []
     for name, child in module.named_children():
+        full_name = f"{prefix}.{name}" if prefix else name
         if isinstance(child, nn.Linear):
-            full_name = f"{prefix}.{name}.weight" if prefix else f"{name}.weight"
-            compressed_list.append(full_name)
+            if name not in skip_modules:
+                compressed_list.append(f"{full_name}.weight")
+        else:
             compressed_list.extend(
-                get_compressed_list(child, full_name)
+                get_compressed_list(child, full_name, skip_modules)
             )
     return compressed_list
 
 
-def apply_compressed_weight(module, compressed_state_dict, target_device, prefix=""):
+def apply_compressed_weight(module, compressed_state_dict, target_device, config=default_compression_config, prefix=""):
     for name, child in module.named_children():
+        full_name = f"{prefix}.{name}" if prefix else name
         if isinstance(child, nn.Linear):
-            full_name = f"{prefix}.{name}.weight" if prefix else f"{name}.weight"
-            setattr(
-                module,
-                name,
-                CLinear(
-                    compressed_state_dict[full_name], child.bias, target_device
-                ),
-            )
-            apply_compressed_weight(child, compressed_state_dict, target_device, full_name)
+            if f"{full_name}.weight" in compressed_state_dict:
+                setattr(
+                    module,
+                    name,
+                    CLinear(
+                        compressed_state_dict[f"{full_name}.weight"], child.bias, target_device, config
+                    ),
+                )
+        else:
+            apply_compressed_weight(child, compressed_state_dict, target_device, config, full_name)
 
 
-def load_compress_model(model_path, device, torch_dtype):
-    # partially load model
+def iter_checkpoint(model_path):
+    """Yield (name, tensor) over all weight files of a checkpoint, one tensor at a time."""
+    files = sorted(glob.glob(os.path.join(model_path, "*.safetensors")))
+    if len(files) == 0:
+        files = sorted(glob.glob(os.path.join(model_path, "pytorch_model*.bin")))
+    if len(files) == 0:
+        raise FileNotFoundError(f"No weight files found in {model_path}")
+    for filename in files:
+        if filename.endswith(".safetensors"):
+            with safe_open(filename, framework="pt", device="cpu") as f:
+                for name in f.keys():
+                    yield name, f.get_tensor(name)
+        else:
+            try:
+                state_dict = torch.load(filename, map_location="cpu", mmap=True)
+            except (RuntimeError, TypeError):
+                # legacy (non-zip) checkpoints cannot be memory-mapped, and torch < 2.1 has no mmap argument
+                state_dict = torch.load(filename, map_location="cpu")
+            for name in list(state_dict.keys()):
+                yield name, state_dict.pop(name)
+            del state_dict
+
+
+def load_compress_model(model_path, device, torch_dtype, compression_config=default_compression_config):
+    """Quantize a checkpoint while loading it, shard by shard.
+
+    The model skeleton is created without allocating weights, every linear weight is
+    quantized as soon as it is read, and the remaining tensors are loaded as they are,
+    so the float model is never held in memory as a whole.
+    """
+    if not os.path.exists(model_path):
+        model_path = snapshot_download(repo_id=model_path)
     tokenizer = AutoTokenizer.from_pretrained(model_path, use_fast=False)
-    base_pattern = os.path.join(model_path, "pytorch_model-*.bin")
-    files = glob.glob(base_pattern)
-
     config = AutoConfig.from_pretrained(
         model_path, low_cpu_mem_usage=True, torch_dtype=torch_dtype
     )
-    model = AutoModelForCausalLM.from_config(config)
-    linear_weights = get_compressed_list(model)
+    with init_empty_weights():
+        model = AutoModelForCausalLM.from_config(config)
+    linear_weights = set(get_compressed_list(model))
+    state_names = set(model.state_dict().keys())
 
     compressed_state_dict = {}
-
-    for filename in files:
-        tmp_state_dict = torch.load(filename)
-        for name in tmp_state_dict:
-            if name in linear_weights:
-                tensor = tmp_state_dict[name].to(device).data.to(torch_dtype)
-                compressed_state_dict[name] = compress(
-                    tensor, default_compression_config
-                )
-            else:
-                compressed_state_dict[name] = tmp_state_dict[name].to(device)
-            tmp_state_dict[name] = None
-            tensor = None
+    for name, tensor in tqdm(iter_checkpoint(model_path), desc="Quantizing"):
+        if name in linear_weights:
+            tensor = tensor.to(device=device, dtype=torch_dtype)
+            compressed_state_dict[name] = compress(tensor, compression_config)
+        elif name in state_names:
+            dtype = torch_dtype if tensor.is_floating_point() else None
+            set_module_tensor_to_device(model, name, device, value=tensor, dtype=dtype)
+        tensor = None
+        if device == "cuda":
             torch.cuda.empty_cache()
 
-    for name, param in model.named_parameters():
-        if name not in linear_weights:
-            param.data = compressed_state_dict[name]
-    apply_compressed_weight(model, compressed_state_dict, device)
+    apply_compressed_weight(model, compressed_state_dict, device, compression_config)
+    missing = [name for name, param in model.named_parameters() if param.is_meta]
+    if len(missing) > 0:
+        raise ValueError(f"{len(missing)} weights are missing in {model_path}, e.g. {missing[:3]}")
 
     model.to(device)
 
@@ -132,7 +228,7 @@ def compress(tensor, config):
     )
 
     # Pad
-    pad_len = group_size - original_shape[group_dim] % group_size
+    pad_len = (group_size - original_shape[group_dim] % group_size) % group_size
     if pad_len != 0:
         pad_shape = (
             original_shape[:group_dim] + (pad_len,) + original_shape[group_dim + 1 :]
@@ -146,7 +242,7 @@ def compress(tensor, config):
     # Quantize
     if symmetric:
         B = 2 ** (num_bits - 1) - 1
-        scale = B / torch.max(data.abs(), dim=group_dim + 1, keepdim=True)[0]
+        scale = B / torch.max(data.abs(), dim=group_dim + 1, keepdim=True)[0].clamp(min=1e-5)
         data = data * scale
         data = data.clamp_(-B, B).round_().to(torch.int8)
         return data, scale, original_shape
@@ -185,7 +281,7 @@ def decompress(packed_data, config):
         data += mn
 
     # Unpad
-    pad_len = group_size - original_shape[group_dim] % group_size
+    pad_len = (group_size - original_shape[group_dim] % group_size) % group_size
     if pad_len:
         padded_original_shape = (
             original_shape[:group_dim]
@@ -194,6 +290,6 @@ def decompress(packed_data, config):
         )
         data = data.reshape(padded_original_shape)
         indices = [slice(0, x) for x in original_shape]
-        return data[indices].contiguous()
+        return data[tuple(indices)].contiguous()
     else:
         return data.view(original_shape)
@@ -5,40 +5,94 @@ import transformers.models.llama.modeling_llama
 
 from functools import partial
 
+# Rotary tables shared by every layer with the same settings, keyed by
+# (dim, base, ratio, scaling, max_position_embeddings, device, dtype, seq_len tag) -> (cos, sin)
+# The seq_len tag is None, except for dynamic scaling beyond max_position_embeddings where the base depends on the
+# sequence length: there it is the sequence length the tables were built for, and only the last one is kept.
+_rotary_tables = {}
+
+
+def dynamic_seq_len_tag(scaling, max_position_embeddings, seq_len):
+    return seq_len if scaling == "dynamic" and seq_len > max_position_embeddings else None
+
+
+def build_rotary_tables(dim, base, ratio, scaling, max_position_embeddings, length, device, scaled_seq_len=None):
+    if scaled_seq_len is not None:
+        # dynamic NTK: stretch the base for this sequence length instead of condensing the positions
+        base = base * ((ratio * scaled_seq_len / max_position_embeddings) - (ratio - 1)) ** (dim / (dim - 2))
+    inv_freq = 1.0 / (base ** (torch.arange(0, dim, 2, device=device).float() / dim))
+    t = torch.arange(length, device=device, dtype=torch.float32)
+    if scaling == "linear":
+        t = t / ratio
+    freqs = torch.outer(t, inv_freq)
+    # Different from paper, but it uses a different permutation in order to obtain the same calculation
+    emb = torch.cat((freqs, freqs), dim=-1)
+    return emb.cos()[None, None, :, :], emb.sin()[None, None, :, :]
+
+
 class CondenseRotaryEmbedding(torch.nn.Module):
-    def __init__(self, dim, ratio, max_position_embeddings=2048, base=10000, device=None):
+    """Rotary embedding for sequences longer than the model was pretrained on.
+
+    "linear" condenses positions by `ratio`; "dynamic" keeps positions and rescales the
+    base (NTK) to the sequence length once it outgrows `max_position_embeddings`, shorter
+    sequences always get the unscaled base. The cos/sin tables are cast once per (device,
+    dtype), shared by all layers and grown geometrically, so a decode step only slices them;
+    a scaled dynamic table is rebuilt for each new sequence length.
+    """
+
+    def __init__(self, dim, ratio, max_position_embeddings=2048, base=10000, device=None, scaling="linear"):
         super().__init__()
+        assert scaling in ("linear", "dynamic"), f"unknown rotary scaling {scaling}"
         inv_freq = 1.0 / (base ** (torch.arange(0, dim, 2).float().to(device) / dim))
         self.register_buffer("inv_freq", inv_freq)
-        
-        # Build here to make `torch.jit.trace` work.
+
         self.ratio = ratio
-        max_position_embeddings *= ratio
-        print(f"Condensing Positional embeddings from {max_position_embeddings} to {max_position_embeddings // ratio}")
-        self.max_seq_len_cached = max_position_embeddings
-        t = torch.arange(self.max_seq_len_cached, device=self.inv_freq.device, dtype=self.inv_freq.dtype) / ratio
-        freqs = torch.einsum("i,j->ij", t, self.inv_freq)
-        # Different from paper, but it uses a different permutation in order to obtain the same calculation
-        emb = torch.cat((freqs, freqs), dim=-1)
-        dtype = torch.get_default_dtype()
-        self.register_buffer("cos_cached", emb.cos()[None, None, :, :].to(dtype), persistent=False)
-        self.register_buffer("sin_cached", emb.sin()[None, None, :, :].to(dtype), persistent=False)
+        self.scaling = scaling
+        if scaling == "linear":
+            print(f"Condensing Positional embeddings from {max_position_embeddings * ratio} to {max_position_embeddings}")
+            self.max_seq_len_cached = max_position_embeddings * ratio
+        else:
+            print(f"Dynamic NTK scaling of positional embeddings beyond {max_position_embeddings}")
+            self.max_seq_len_cached = max_position_embeddings
+        self.table_key = (dim, base, ratio, scaling, max_position_embeddings)
+        # tables of the last device/dtype seen, so the hot path skips the shared dict
+        self.tables = None
+
+    def get_tables(self, device, dtype, seq_len):
+        tag = dynamic_seq_len_tag(self.scaling, self.table_key[4], seq_len)
+        if tag is not None:
+            # the base of a dynamic table beyond max_position_embeddings is only right for this very length
+            key = self.table_key + (device, dtype, "scaled")
+            tables = _rotary_tables.get(key)
+            if tables is None or tables[2] != tag:
+                with torch.inference_mode(False), torch.no_grad():
+                    cos, sin = build_rotary_tables(*self.table_key, seq_len, device, scaled_seq_len=seq_len)
+                    tables = (cos.to(dtype), sin.to(dtype), tag)
+                _rotary_tables[key] = tables
+            return tables
+        key = self.table_key + (device, dtype, None)
+        tables = _rotary_tables.get(key)
+        if tables is None or tables[0].shape[2] < seq_len:
+            length = max(seq_len, self.max_seq_len_cached)
+            if tables is not None:
+                length = max(length, 2 * tables[0].shape[2])
+            # plain tensors even when first built under torch.inference_mode()
+            with torch.inference_mode(False), torch.no_grad():
+                cos, sin = build_rotary_tables(*self.table_key, length, device)
+                tables = (cos.to(dtype), sin.to(dtype), None)
+            _rotary_tables[key] = tables
+        return tables
 
     def forward(self, x, seq_len=None):
         # x: [bs, num_attention_heads, seq_len, head_size]
-        # This `if` block is unlikely to be run after we build sin/cos in `__init__`. Keep the logic here just in case.
-        if seq_len > self.max_seq_len_cached:
-            self.max_seq_len_cached = seq_len
-            t = torch.arange(self.max_seq_len_cached, device=x.device, dtype=self.inv_freq.dtype) / self.ratio
-            freqs = torch.einsum("i,j->ij", t, self.inv_freq)
-            # Different from paper, but it uses a different permutation in order to obtain the same calculation
-            emb = torch.cat((freqs, freqs), dim=-1).to(x.device)
-            self.register_buffer("cos_cached", emb.cos()[None, None, :, :].to(x.dtype), persistent=False)
-            self.register_buffer("sin_cached", emb.sin()[None, None, :, :].to(x.dtype), persistent=False)
+        tables = self.tables
+        if (tables is None or tables[0].device != x.device or tables[0].dtype != x.dtype or tables[0].shape[2] < seq_len
+                or tables[2] != dynamic_seq_len_tag(self.scaling, self.table_key[4], seq_len)):
+            tables = self.tables = self.get_tables(x.device, x.dtype, seq_len)
         return (
-            self.cos_cached[:, :, :seq_len, ...].to(dtype=x.dtype),
-            self.sin_cached[:, :, :seq_len, ...].to(dtype=x.dtype),
+            tables[0][:, :, :seq_len, ...],
+            tables[1][:, :, :seq_len, ...],
         )
 
-def replace_llama_with_condense(ratio):
-    transformers.models.llama.modeling_llama.LlamaRotaryEmbedding = partial(CondenseRotaryEmbedding, ratio=ratio)
+def replace_llama_with_condense(ratio, scaling="linear"):
+    transformers.models.llama.modeling_llama.LlamaRotaryEmbedding = partial(CondenseRotaryEmbedding, ratio=ratio, scaling=scaling)
@@ -11,8 +11,133 @@ import torch.nn.functional as F
 import math
 import transformers
 from transformers.models.llama.modeling_llama import apply_rotary_pos_emb
+
+try:
+    from flash_attn.flash_attn_interface import flash_attn_varlen_func
+except ImportError:
+    try:
+        # flash-attn 1.x
+        from flash_attn.flash_attn_interface import flash_attn_unpadded_func as flash_attn_varlen_func
+    except ImportError:
+        flash_attn_varlen_func = None
+
+
+def is_packed(position_ids, q_len):
+    """Several conversations are packed into one row when its position ids restart at 0."""
+    return position_ids is not None and q_len > 1 and bool((position_ids[:, 1:] == 0).any())
+
+
+def packed_attention(query_states, key_states, value_states, position_ids):
+    """Causal attention that keeps each conversation packed into a row from attending to the others."""
+    bsz, num_heads, q_len, head_dim = query_states.shape
+    if (
+        flash_attn_varlen_func is not None
+        and query_states.is_cuda
+        and query_states.dtype in (torch.float16, torch.bfloat16)
+    ):
+        flat_position_ids = position_ids.flatten()
+        starts = torch.nonzero(flat_position_ids == 0).flatten().to(torch.int32)
+        cu_seqlens = torch.cat([starts, starts.new_tensor([flat_position_ids.numel()])])
+        max_seqlen = int((cu_seqlens[1:] - cu_seqlens[:-1]).max())
+        query_states, key_states, value_states = [
+            states.transpose(1, 2).reshape(bsz * q_len, num_heads, head_dim)
+            for states in (query_states, key_states, value_states)
+        ]
+        attn_output = flash_attn_varlen_func(
+            query_states, key_states, value_states,
+            cu_seqlens, cu_seqlens, max_seqlen, max_seqlen,
+            dropout_p=0.0, causal=True,
+        )
+        return attn_output.view(bsz, q_len, num_heads, head_dim).transpose(1, 2)
+
+    # Fall back to SDPA with a block-diagonal causal mask
+    segment_ids = (position_ids == 0).cumsum(-1)
+    causal_mask = torch.ones(q_len, q_len, dtype=torch.bool, device=query_states.device).tril()
+    attn_mask = (segment_ids[:, :, None] == segment_ids[:, None, :]) & causal_mask
+    return F.scaled_dot_product_attention(
+        query_states, key_states, value_states, attn_mask=attn_mask[:, None], dropout_p=0.0
+    )
     
 
+def quantize_kv(states):
+    """[bsz, heads, seq, head_dim] -> int8 values and one scale per head and token."""
+    scale = states.abs().amax(dim=-1, keepdim=True).clamp(min=1e-5) / 127
+    return (states / scale).round_().clamp_(-127, 127).to(torch.int8), scale
+
+
+def dequantize_kv(states, scale, dtype):
+    return states.to(dtype) * scale.to(dtype)
+
+
+def append_kv_cache(past, new):
+    """Write new [bsz, heads, q, dim] after past, in the buffer past is a prefix of; returns the filled prefix.
+
+    The buffer is only reallocated, with room for more tokens, when it is full, so a decode step copies one token
+    instead of the whole cache.
+
+    Rule: new tokens are written in place only when past owns its buffer, i.e. past is the view this function (or
+    crop_kv_cache) returned last for the buffer; the buffer keeps the token of that view in `kv_cache_owner`. An older
+    past_key_values kept by the caller, a slice of one, or a prompt prefix reused for another continuation shares its
+    storage with views that may still be in use: it is copied into a new buffer instead of being overwritten.
+    """
+    bsz, heads, used, dim = past.shape
+    needed = used + new.shape[2]
+    owner, token = getattr(past, "kv_cache_owner", (None, None))
+    if owner is not None and owner[0] is token and past.stride(1) // dim >= needed:
+        buffer = past.as_strided((bsz, heads, past.stride(1) // dim, dim), past.stride())
+    else:
+        buffer = past.new_empty(bsz, heads, needed + max(needed // 4, 256), dim)
+        buffer[:, :, :used] = past
+        owner = [None]
+    buffer[:, :, used:needed] = new
+    return _take_kv_cache_buffer(buffer[:, :, :needed], owner)
+
+
+def crop_kv_cache(states, length):
+    """states[:, :, :length] for a rollback: the crop takes over the buffer from states, which must not be used anymore."""
+    cropped = states[:, :, :length]
+    owner, token = getattr(states, "kv_cache_owner", (None, None))
+    if owner is not None and owner[0] is token:
+        _take_kv_cache_buffer(cropped, owner)
+    return cropped
+
+
+def _take_kv_cache_buffer(states, owner):
+    token = object()
+    owner[0] = token
+    states.kv_cache_owner = (owner, token)
+    return states
+
+
+def int8_cache_attention(query_states, key_cache, value_cache, attn_mask=None, chunk_size=1024):
+    """Attention over the int8 cache, dequantizing chunk_size keys/values at a time with an online softmax."""
+    (keys, key_scale), (values, value_scale) = key_cache, value_cache
+    dtype = query_states.dtype
+    softmax_scale = 1 / math.sqrt(query_states.shape[-1])
+    attn_output = row_max = row_sum = None
+    for start in range(0, keys.shape[2], chunk_size):
+        end = start + chunk_size
+        key_chunk = dequantize_kv(keys[:, :, start:end], key_scale[:, :, start:end], dtype)
+        value_chunk = dequantize_kv(values[:, :, start:end], value_scale[:, :, start:end], dtype)
+        scores = torch.matmul(query_states, key_chunk.transpose(-1, -2)).float() * softmax_scale
+        if attn_mask is not None:
+            scores.masked_fill_(~attn_mask[..., start:end], float("-inf"))
+        chunk_max = scores.amax(dim=-1, keepdim=True)
+        new_max = chunk_max if row_max is None else torch.maximum(row_max, chunk_max)
+        # rows with every key masked so far have a max of -inf, subtracting 0 instead keeps them at 0 rather than NaN
+        shift = new_max.masked_fill(new_max == float("-inf"), 0)
+        probs = torch.exp(scores - shift)
+        chunk_output = torch.matmul(probs.to(dtype), value_chunk).float()
+        if attn_output is None:
+            attn_output, row_sum = chunk_output, probs.sum(dim=-1, keepdim=True)
+        else:
+            correction = torch.exp(row_max - shift)
+            attn_output = attn_output * correction + chunk_output
+            row_sum = row_sum * correction + probs.sum(dim=-1, keepdim=True)
+        row_max = new_max
+    return (attn_output / row_sum).to(dtype)
+
+
 def forward_2(
         self,
         hidden_states: torch.Tensor,
@@ -35,17 +160,47 @@ def forward_2(
     query_states, key_states = apply_rotary_pos_emb(query_states, key_states, cos, sin, position_ids)
 
     assert not output_attentions, "output_attentions is not supported"
-    assert not use_cache, "use_cache is not supported"
-    assert past_key_value is None, "past_key_value is not supported"
-
-
-    if past_key_value is not None:
-        # reuse k, v, self_attention
-        key_states = torch.cat([past_key_value[0], key_states], dim=2)
-        value_states = torch.cat([past_key_value[1], value_states], dim=2)
 
-    past_key_value = (key_states, value_states) if use_cache else None
-    attn_output= F.scaled_dot_product_attention(query_states,key_states,value_states,dropout_p=0.0, is_causal=True)
+    attn_output = None
+    if use_cache and self.kv_cache_int8:
+        # the cache keeps int8 keys/values with per-head, per-token scales: (k, k_scale, v, v_scale).
+        # Without a past the new keys/values are the whole cache and attention uses them as they are
+        key_cache = quantize_kv(key_states)
+        value_cache = quantize_kv(value_states)
+        if past_key_value is not None:
+            key_cache = [append_kv_cache(past, new) for past, new in zip(past_key_value[:2], key_cache)]
+            value_cache = [append_kv_cache(past, new) for past, new in zip(past_key_value[2:], value_cache)]
+            mask = attention_mask
+            if mask is None and q_len > 1:
+                mask = causal_mask(q_len, kv_seq_len, query_states.device)
+            attn_output = int8_cache_attention(query_states, key_cache, value_cache, mask)
+        past_key_value = (*key_cache, *value_cache)
+    else:
+        if past_key_value is not None:
+            # reuse k, v, self_attention
+            key_states = torch.cat([past_key_value[0], key_states], dim=2)
+            value_states = torch.cat([past_key_value[1], value_states], dim=2)
+
+        past_key_value = (key_states, value_states) if use_cache else None
+    if attn_output is not None:
+        pass
+    elif attention_mask is not None:
+        # padded batch, mask built once per forward by _prepare_decoder_attention_mask
+        attn_output = F.scaled_dot_product_attention(
+            query_states, key_states, value_states, attn_mask=attention_mask, dropout_p=0.0
+        )
+    elif is_packed(position_ids, q_len):
+        attn_output = packed_attention(query_states, key_states, value_states, position_ids)
+    elif q_len == kv_seq_len:
+        attn_output = F.scaled_dot_product_attention(query_states, key_states, value_states, dropout_p=0.0, is_causal=True)
+    elif q_len == 1:
+        # a single new token attends to the whole cache
+        attn_output = F.scaled_dot_product_attention(query_states, key_states, value_states, dropout_p=0.0)
+    else:
+        attn_output = F.scaled_dot_product_attention(
+            query_states, key_states, value_states,
+            attn_mask=causal_mask(q_len, kv_seq_len, query_states.device), dropout_p=0.0
+        )
     attn_weights = None
     
     if attn_output.size() != (bsz, self.num_heads, q_len, self.head_dim):
@@ -65,12 +220,30 @@ def forward_2(
     return attn_output, attn_weights, past_key_value
 
 
+def causal_mask(q_len, kv_len, device):
+    """Boolean [q_len, kv_len] mask of the last q_len positions attending to all earlier ones."""
+    return torch.ones(q_len, kv_len, dtype=torch.bool, device=device).tril(diagonal=kv_len - q_len)
+
+
 def _prepare_decoder_attention_mask(self, attention_mask, input_shape,
                                     inputs_embeds, past_key_values_length):
-    # [bsz, seq_len]
-    return attention_mask
-
-def replace_llama_attn_with_flash_attn():
+    # [bsz, kv_len] -> None when causal attention alone is exact, else a boolean
+    # [bsz, 1, q_len, kv_len] mask shared by all layers.
+    if attention_mask is None or bool(attention_mask.all()):
+        return None
+    if past_key_values_length == 0 and bool((attention_mask[:, 1:] <= attention_mask[:, :-1]).all()):
+        # right padding only (training batches): pads come after every real token
+        return None
+    bsz, q_len = input_shape
+    kv_len = q_len + past_key_values_length
+    mask = attention_mask[:, None, None, -kv_len:].bool() & causal_mask(q_len, kv_len, attention_mask.device)
+    # left-padding queries see no key at all, let them attend everywhere instead of producing NaNs
+    return mask | ~mask.any(dim=-1, keepdim=True)
+
+
+def replace_llama_attn_with_flash_attn(kv_cache_int8=False):
+    """Patch llama attention with SDPA; `kv_cache_int8` stores the kv cache in int8, dequantized chunk by chunk as attention reads it."""
     transformers.models.llama.modeling_llama.LlamaModel._prepare_decoder_attention_mask = _prepare_decoder_attention_mask
     transformers.models.llama.modeling_llama.LlamaAttention.forward = forward_2
+    transformers.models.llama.modeling_llama.LlamaAttention.kv_cache_int8 = kv_cache_int8
     
\ No newline at end of file
@@ -0,0 +1,155 @@
+"""
+Memory-mapped storage for pre-tokenized supervised data.
+
+A tokenized dataset is a directory of shards. A shard named `<name>` is made of
+`<name>.input_ids.bin` and `<name>.labels.bin`, holding the token ids of all its
+examples back to back without any padding, and `<name>.offsets.npy`, holding the
+n + 1 start offsets of its n examples. `meta.json` records how the shards were built.
+
+The offsets file is renamed into place last, so only finished shards are visible to
+readers and an interrupted writer never leaves a half-written shard behind. When
+`meta.json` lists `shards`, only those are read: a writer that keeps track of the shards
+it finished, like preprocess_toolllama_data.py, may leave others behind when interrupted.
+"""
+import glob
+import json
+import os
+from typing import List, Tuple
+
+import numpy as np
+
+
+TOKEN_DTYPE = np.int32
+META_FILE = "meta.json"
+INPUT_IDS_SUFFIX = ".input_ids.bin"
+LABELS_SUFFIX = ".labels.bin"
+OFFSETS_SUFFIX = ".offsets.npy"
+TMP_SUFFIX = ".tmp"
+
+
+class TokenizedShardWriter:
+    """Append examples to a single shard, streaming tokens to disk as they come."""
+
+    def __init__(self, output_dir: str, shard_name: str="shard-00000"):
+        os.makedirs(output_dir, exist_ok=True)
+        self.prefix = os.path.join(output_dir, shard_name)
+        self.input_ids_file = open(self.prefix + INPUT_IDS_SUFFIX + TMP_SUFFIX, "wb")
+        self.labels_file = open(self.prefix + LABELS_SUFFIX + TMP_SUFFIX, "wb")
+        self.offsets = [0]
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def add(self, input_ids, labels):
+        assert len(input_ids) == len(labels), "input_ids and labels must have the same length"
+        self.input_ids_file.write(np.asarray(input_ids, dtype=TOKEN_DTYPE).tobytes())
+        self.labels_file.write(np.asarray(labels, dtype=TOKEN_DTYPE).tobytes())
+        self.offsets.append(self.offsets[-1] + len(input_ids))
+
+    def close(self):
+        self.input_ids_file.close()
+        self.labels_file.close()
+        with open(self.prefix + OFFSETS_SUFFIX + TMP_SUFFIX, "wb") as f:
+            np.save(f, np.asarray(self.offsets, dtype=np.int64))
+        for suffix in (INPUT_IDS_SUFFIX, LABELS_SUFFIX, OFFSETS_SUFFIX):
+            os.replace(self.prefix + suffix + TMP_SUFFIX, self.prefix + suffix)
+
+    def discard(self):
+        self.input_ids_file.close()
+        self.labels_file.close()
+        for suffix in (INPUT_IDS_SUFFIX, LABELS_SUFFIX, OFFSETS_SUFFIX):
+            if os.path.exists(self.prefix + suffix + TMP_SUFFIX):
+                os.remove(self.prefix + suffix + TMP_SUFFIX)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.discard()
+
+
+def write_meta(output_dir: str, **meta):
+    meta_path = os.path.join(output_dir, META_FILE)
+    with open(meta_path + TMP_SUFFIX, "w") as f:
+        json.dump(meta, f, indent=2)
+    os.replace(meta_path + TMP_SUFFIX, meta_path)
+
+
+def read_meta(data_dir: str) -> dict:
+    meta_path = os.path.join(data_dir, META_FILE)
+    if not os.path.exists(meta_path):
+        return {}
+    with open(meta_path, "r") as f:
+        return json.load(f)
+
+
+def list_shards(data_dir: str) -> List[str]:
+    """Return the prefixes of all finished shards in `data_dir`, in name order, only those of meta.json if it lists them."""
+    meta = read_meta(data_dir)
+    if "shards" in meta:
+        return sorted(os.path.join(data_dir, shard_name) for shard_name in meta["shards"])
+    return sorted(
+        path[:-len(OFFSETS_SUFFIX)]
+        for path in glob.glob(os.path.join(data_dir, "*" + OFFSETS_SUFFIX))
+    )
+
+
+class TokenizedCorpus:
+    """Read-only view over all shards of a tokenized dataset.
+
+    Only the offsets are loaded into memory; token arrays are memory-mapped on first
+    access, so every rank and dataloader worker shares the same page cache.
+    """
+
+    def __init__(self, data_dir: str):
+        self.data_dir = data_dir
+        self.shard_prefixes = [
+            prefix for prefix in list_shards(data_dir)
+            if len(np.load(prefix + OFFSETS_SUFFIX, mmap_mode="r")) > 1
+        ]
+        if len(self.shard_prefixes) == 0:
+            raise FileNotFoundError(f"No tokenized shards found in {data_dir}")
+        self.offsets = [np.load(prefix + OFFSETS_SUFFIX) for prefix in self.shard_prefixes]
+        self.cumulative_sizes = np.cumsum([0] + [len(offsets) - 1 for offsets in self.offsets])
+        self.meta = read_meta(data_dir)
+        self._input_ids = None
+        self._labels = None
+
+    def __len__(self):
+        return int(self.cumulative_sizes[-1])
+
+    def __getstate__(self):
+        # memmaps are re-opened lazily in each process instead of being pickled
+        state = self.__dict__.copy()
+        state["_input_ids"] = None
+        state["_labels"] = None
+        return state
+
+    def _open(self):
+        self._input_ids = [
+            np.memmap(prefix + INPUT_IDS_SUFFIX, dtype=TOKEN_DTYPE, mode="r")
+            for prefix in self.shard_prefixes
+        ]
+        self._labels = [
+            np.memmap(prefix + LABELS_SUFFIX, dtype=TOKEN_DTYPE, mode="r")
+            for prefix in self.shard_prefixes
+        ]
+
+    def lengths(self) -> np.ndarray:
+        """Token count of every example, computed from the offsets only."""
+        return np.concatenate([np.diff(offsets) for offsets in self.offsets])
+
+    def __getitem__(self, i) -> Tuple[np.ndarray, np.ndarray]:
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError(f"index {i} is out of range for {len(self)} examples")
+        if self._input_ids is None:
+            self._open()
+        shard = int(np.searchsorted(self.cumulative_sizes, i, side="right")) - 1
+        local = i - self.cumulative_sizes[shard]
+        start, end = self.offsets[shard][local], self.offsets[shard][local + 1]
+        return self._input_ids[shard][start:end], self._labels[shard][start:end]
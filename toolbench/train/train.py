@@ -14,20 +14,27 @@
 #    limitations under the License.
 
 from dataclasses import dataclass, field
+import bisect
 import json
 import pathlib
-from typing import Dict, Optional
+from typing import Dict, List, Optional, Sequence, Tuple
 import os
 import numpy as np
 import torch
 from torch.utils.data import Dataset
 import transformers
 from transformers import Trainer
-from transformers.trainer_pt_utils import LabelSmoother
+from transformers.trainer_pt_utils import (
+    DistributedLengthGroupedSampler,
+    LabelSmoother,
+    LengthGroupedSampler,
+)
 
 from toolbench.tool_conversation import SeparatorStyle
 from toolbench.model.model_adapter import get_conversation_template
 from toolbench.train.llama_condense_monkey_patch import replace_llama_with_condense
+from toolbench.train.llama_flash_attn_monkey_patch import replace_llama_attn_with_flash_attn
+from toolbench.train.tokenized_data import TokenizedCorpus
 
 
 IGNORE_TOKEN_ID = LabelSmoother.ignore_index
@@ -50,6 +57,15 @@ class DataArguments:
         default=None, metadata={"help": "Template used to format the training data."}
     )
     lazy_preprocess: bool = False
+    tokenized_data_path: str = field(
+        default=None, metadata={"help": "Path to the pre-tokenized training data built by preprocess/pretokenize_toolllama_data.py."}
+    )
+    tokenized_eval_data_path: str = field(
+        default=None, metadata={"help": "Path to the pre-tokenized evaluation data."}
+    )
+    packing: bool = field(
+        default=False, metadata={"help": "Pack several pre-tokenized conversations into each model_max_length sequence."}
+    )
     
 
 @dataclass
@@ -68,6 +84,14 @@ class TrainingArguments(transformers.TrainingArguments):
             "help": "Expanded maximum sequence length. Sequences will be right padded (and possibly truncated)."
         },
     )
+    rope_scaling: str = field(
+        default="linear",
+        metadata={
+            "help": "How positions reach model_max_length: linear condenses them, dynamic rescales the rope base (NTK) "
+            "once a sequence outgrows source_model_max_length.",
+            "choices": ["linear", "dynamic"],
+        },
+    )
 
 
 local_rank = None
@@ -87,11 +111,7 @@ def safe_save_model_for_hf_trainer(trainer: transformers.Trainer, output_dir: st
         trainer._save(output_dir, state_dict=cpu_state_dict)
 
 
-def preprocess(
-    sources,
-    tokenizer: transformers.PreTrainedTokenizer,
-    template: str="tool-llama"
-) -> Dict:
+def apply_prompt_template(sources, template: str="tool-llama"):
     conv = get_conversation_template(template)
     if template == "tool-llama":
         roles = {"human": conv.roles[0], "gpt": conv.roles[1]}
@@ -106,6 +126,58 @@ def preprocess(
             role = roles[sentence["from"]]
             conv.append_message(role, sentence["value"])
         conversations.append(conv.get_prompt())
+    return conversations, conv
+
+
+def mask_targets(conversation, target, tokenizer: transformers.PreTrainedTokenizer, conv, total_len: int):
+    """Mask the non-assistant part of `target` in place. Only compute loss on the assistant outputs."""
+    sep = conv.sep + conv.roles[-1] + ": "
+    turns = conversation.split(conv.sep2)
+    cur_len = 1
+    target[:cur_len] = IGNORE_TOKEN_ID
+    for i, turn in enumerate(turns):
+        if turn == "":
+            continue
+        turn_len = len(tokenizer(turn).input_ids)
+
+        parts = turn.split(sep)
+        
+        # only train on the last assistant reply, treat the history chat as instruction
+        prefix = parts[:-1]
+        instruction = ""
+        for part in prefix:
+            instruction += part
+            instruction += sep
+
+        # "-2" is hardcoded for the LLaMA tokenizer to make the offset correct.
+        instruction_len = len(tokenizer(instruction).input_ids) - 2
+
+        # Ignore the user instructions
+        target[cur_len : cur_len + instruction_len] = IGNORE_TOKEN_ID
+        cur_len += turn_len
+
+    target[cur_len:] = IGNORE_TOKEN_ID
+
+    if False:  # Inspect and check the correctness of masking
+        z = target.clone()
+        z = torch.where(z == IGNORE_TOKEN_ID, tokenizer.unk_token_id, z)
+        rank0_print(tokenizer.decode(z))
+
+    if cur_len < tokenizer.model_max_length:
+        if cur_len != total_len:
+            target[:] = IGNORE_TOKEN_ID
+            rank0_print(
+                f"WARNING: tokenization mismatch: {cur_len} vs. {total_len}."
+                f" (ignored)"
+            )
+
+
+def preprocess(
+    sources,
+    tokenizer: transformers.PreTrainedTokenizer,
+    template: str="tool-llama"
+) -> Dict:
+    conversations, conv = apply_prompt_template(sources, template)
 
     # Tokenize conversations
     input_ids = tokenizer(
@@ -118,47 +190,9 @@ def preprocess(
     targets = input_ids.clone()
     
     # Mask targets. Only compute loss on the assistant outputs.
-    sep = conv.sep + conv.roles[-1] + ": "
     for conversation, target in zip(conversations, targets):
         total_len = int(target.ne(tokenizer.pad_token_id).sum())
-        turns = conversation.split(conv.sep2)
-        cur_len = 1
-        target[:cur_len] = IGNORE_TOKEN_ID
-        for i, turn in enumerate(turns):
-            if turn == "":
-                continue
-            turn_len = len(tokenizer(turn).input_ids)
-
-            parts = turn.split(sep)
-            
-            # only train on the last assistant reply, treat the history chat as instruction
-            prefix = parts[:-1]
-            instruction = ""
-            for part in prefix:
-                instruction += part
-                instruction += sep
-
-            # "-2" is hardcoded for the LLaMA tokenizer to make the offset correct.
-            instruction_len = len(tokenizer(instruction).input_ids) - 2
-
-            # Ignore the user instructions
-            target[cur_len : cur_len + instruction_len] = IGNORE_TOKEN_ID
-            cur_len += turn_len
-
-        target[cur_len:] = IGNORE_TOKEN_ID
-
-        if False:  # Inspect and check the correctness of masking
-            z = target.clone()
-            z = torch.where(z == IGNORE_TOKEN_ID, tokenizer.unk_token_id, z)
-            rank0_print(tokenizer.decode(z))
-
-        if cur_len < tokenizer.model_max_length:
-            if cur_len != total_len:
-                target[:] = IGNORE_TOKEN_ID
-                rank0_print(
-                    f"WARNING: tokenization mismatch: {cur_len} vs. {total_len}."
-                    f" (ignored)"
-                )
+        mask_targets(conversation, target, tokenizer, conv, total_len)
     return dict(
         input_ids=input_ids,
         labels=targets,
@@ -166,6 +200,29 @@ def preprocess(
     )
 
 
+def tokenize_sources(
+    sources,
+    tokenizer: transformers.PreTrainedTokenizer,
+    template: str="tool-llama"
+) -> List[Tuple[np.ndarray, np.ndarray]]:
+    """Tokenize and mask conversations without padding, as stored by the pre-tokenized format."""
+    conversations, conv = apply_prompt_template(sources, template)
+    input_ids = tokenizer(
+        conversations,
+        max_length=tokenizer.model_max_length,
+        truncation=True,
+    ).input_ids
+
+    examples = []
+    for conversation, ids in zip(conversations, input_ids):
+        ids = np.asarray(ids, dtype=np.int32)
+        target = ids.copy()
+        total_len = int((ids != tokenizer.pad_token_id).sum())
+        mask_targets(conversation, target, tokenizer, conv, total_len)
+        examples.append((ids, target))
+    return examples
+
+
 class SupervisedDataset(Dataset):
     """Dataset for supervised fine-tuning."""
 
@@ -222,10 +279,197 @@ class LazySupervisedDataset(Dataset):
         return ret
 
 
+class MemmapSupervisedDataset(Dataset):
+    """Dataset for supervised fine-tuning over pre-tokenized, memory-mapped shards."""
+
+    def __init__(self, corpus: TokenizedCorpus, tokenizer: transformers.PreTrainedTokenizer, indices=None):
+        super(MemmapSupervisedDataset, self).__init__()
+        self.corpus = corpus
+        self.max_length = tokenizer.model_max_length
+        self.indices = np.arange(len(corpus)) if indices is None else np.asarray(indices)
+        self.lengths = np.minimum(corpus.lengths()[self.indices], self.max_length)
+
+    def __len__(self):
+        return len(self.indices)
+
+    def __getitem__(self, i) -> Dict[str, torch.Tensor]:
+        input_ids, labels = self.corpus[int(self.indices[i])]
+        return dict(
+            input_ids=torch.from_numpy(input_ids[: self.max_length].astype(np.int64)),
+            labels=torch.from_numpy(labels[: self.max_length].astype(np.int64)),
+        )
+
+
+def pack_by_length(lengths, max_length: int) -> List[List[int]]:
+    """Best-fit-decreasing bin packing of `lengths` into bins of `max_length` tokens.
+
+    Returns the packs as lists of positions into `lengths`.
+    """
+    packs = []
+    free = {}  # remaining capacity -> ids of the packs with exactly that much room
+    capacities = []  # sorted keys of `free`
+    for i in np.argsort(-np.asarray(lengths), kind="stable"):
+        length = int(lengths[i])
+        pos = bisect.bisect_left(capacities, length)
+        if pos == len(capacities):
+            pack_id = len(packs)
+            packs.append([])
+            remaining = max_length
+        else:
+            remaining = capacities[pos]
+            pack_id = free[remaining].pop()
+            if not free[remaining]:
+                del free[remaining]
+                capacities.pop(pos)
+        packs[pack_id].append(int(i))
+        remaining -= length
+        if remaining > 0:
+            if remaining not in free:
+                free[remaining] = []
+                bisect.insort(capacities, remaining)
+            free[remaining].append(pack_id)
+    return packs
+
+
+class PackedSupervisedDataset(Dataset):
+    """Dataset for supervised fine-tuning that packs several pre-tokenized conversations into each sequence.
+
+    Position ids restart at 0 for every conversation; the patched attention uses them to
+    keep the conversations of a packed sequence from attending to each other.
+    """
+
+    def __init__(self, corpus: TokenizedCorpus, tokenizer: transformers.PreTrainedTokenizer, indices=None):
+        super(PackedSupervisedDataset, self).__init__()
+        self.corpus = corpus
+        self.max_length = tokenizer.model_max_length
+        indices = np.arange(len(corpus)) if indices is None else np.asarray(indices)
+        example_lengths = np.minimum(corpus.lengths()[indices], self.max_length)
+        packs = pack_by_length(example_lengths, self.max_length)
+        self.packs = [[int(indices[pos]) for pos in pack] for pack in packs]
+        self.lengths = np.array([int(example_lengths[pack].sum()) for pack in packs])
+        rank0_print(
+            f"Packed {len(indices)} conversations into {len(self.packs)} sequences, "
+            f"{self.lengths.sum() / max(len(self.packs) * self.max_length, 1):.1%} of tokens are not padding."
+        )
+
+    def __len__(self):
+        return len(self.packs)
+
+    def __getitem__(self, i) -> Dict[str, torch.Tensor]:
+        input_ids, labels, position_ids = [], [], []
+        for index in self.packs[i]:
+            example_input_ids, example_labels = self.corpus[index]
+            input_ids.append(example_input_ids[: self.max_length])
+            labels.append(example_labels[: self.max_length])
+            position_ids.append(np.arange(len(input_ids[-1])))
+        return dict(
+            input_ids=torch.from_numpy(np.concatenate(input_ids).astype(np.int64)),
+            labels=torch.from_numpy(np.concatenate(labels).astype(np.int64)),
+            position_ids=torch.from_numpy(np.concatenate(position_ids).astype(np.int64)),
+        )
+
+
+@dataclass
+class DataCollatorForSupervisedDataset:
+    """Pad unpadded examples to the longest one in the batch."""
+
+    tokenizer: transformers.PreTrainedTokenizer
+    pad_to_multiple_of: int = 8
+
+    def __call__(self, instances: Sequence[Dict]) -> Dict[str, torch.Tensor]:
+        lengths = [len(instance["input_ids"]) for instance in instances]
+        max_len = max(lengths)
+        if self.pad_to_multiple_of:
+            max_len = -(-max_len // self.pad_to_multiple_of) * self.pad_to_multiple_of
+        max_len = min(max_len, self.tokenizer.model_max_length)
+
+        input_ids = torch.full((len(instances), max_len), self.tokenizer.pad_token_id, dtype=torch.long)
+        labels = torch.full((len(instances), max_len), IGNORE_TOKEN_ID, dtype=torch.long)
+        attention_mask = torch.zeros((len(instances), max_len), dtype=torch.bool)
+        for i, (instance, length) in enumerate(zip(instances, lengths)):
+            input_ids[i, :length] = instance["input_ids"]
+            labels[i, :length] = instance["labels"]
+            attention_mask[i, :length] = True
+        batch = dict(
+            input_ids=input_ids,
+            labels=labels,
+            attention_mask=attention_mask,
+        )
+        if "position_ids" in instances[0]:
+            # the padding of a packed row forms one more sequence of its own
+            position_ids = torch.arange(max_len).repeat(len(instances), 1)
+            for i, (instance, length) in enumerate(zip(instances, lengths)):
+                position_ids[i, :length] = instance["position_ids"]
+                position_ids[i, length:] -= length
+            batch["position_ids"] = position_ids
+        return batch
+
+
+class SupervisedTrainer(Trainer):
+    """Trainer that groups batches by the precomputed lengths of the pre-tokenized datasets."""
+
+    def _get_train_sampler(self) -> Optional[torch.utils.data.Sampler]:
+        lengths = getattr(self.train_dataset, "lengths", None)
+        if not self.args.group_by_length or lengths is None:
+            return super()._get_train_sampler()
+
+        seed = self.args.data_seed if self.args.data_seed is not None else self.args.seed
+        if self.args.world_size <= 1:
+            generator = torch.Generator()
+            generator.manual_seed(seed)
+            return LengthGroupedSampler(
+                self.args.train_batch_size * self.args.gradient_accumulation_steps,
+                lengths=lengths.tolist(),
+                generator=generator,
+            )
+        return DistributedLengthGroupedSampler(
+            self.args.train_batch_size * self.args.gradient_accumulation_steps,
+            num_replicas=self.args.world_size,
+            rank=self.args.process_index,
+            lengths=lengths.tolist(),
+            seed=seed,
+        )
+
+
+def make_tokenized_data_module(
+    tokenizer: transformers.PreTrainedTokenizer, data_args
+) -> Dict:
+    """Make dataset and collator from pre-tokenized shards."""
+    rank0_print("Loading pre-tokenized data...")
+    corpus = TokenizedCorpus(data_args.tokenized_data_path)
+    meta_template = corpus.meta.get("conv_template")
+    if meta_template is not None and data_args.conv_template is not None and meta_template != data_args.conv_template:
+        rank0_print(
+            f"WARNING: data was tokenized with template {meta_template}, "
+            f"but --conv_template is {data_args.conv_template}."
+        )
+    dataset_cls = (
+        PackedSupervisedDataset if data_args.packing else MemmapSupervisedDataset
+    )
+    if data_args.tokenized_eval_data_path is not None:
+        train_dataset = dataset_cls(corpus, tokenizer)
+        eval_dataset = dataset_cls(TokenizedCorpus(data_args.tokenized_eval_data_path), tokenizer)
+    else:
+        # Split train/test
+        perm = np.random.permutation(len(corpus))
+        split = int(len(perm) * 0.98)
+        train_dataset = dataset_cls(corpus, tokenizer, indices=perm[:split])
+        eval_dataset = dataset_cls(corpus, tokenizer, indices=perm[split:])
+    rank0_print(f"#train {len(train_dataset)}, #eval {len(eval_dataset)}")
+    return dict(
+        train_dataset=train_dataset,
+        eval_dataset=eval_dataset,
+        data_collator=DataCollatorForSupervisedDataset(tokenizer),
+    )
+
+
 def make_supervised_data_module(
     tokenizer: transformers.PreTrainedTokenizer, data_args
 ) -> Dict:
     """Make dataset and collator for supervised fine-tuning."""
+    if data_args.tokenized_data_path is not None:
+        return make_tokenized_data_module(tokenizer, data_args)
+    assert not data_args.packing, "--packing requires --tokenized_data_path"
     dataset_cls = (
         LazySupervisedDataset if data_args.lazy_preprocess else SupervisedDataset
     )
@@ -258,7 +502,10 @@ def train():
     if training_args.source_model_max_length < training_args.model_max_length:
         condense_ratio = int(training_args.model_max_length/training_args.source_model_max_length)
         # ratio = N means the sequence length is expanded by N, remember to change the model_max_length to 8192 (2048 * ratio) for ratio = 4
-        replace_llama_with_condense(ratio=condense_ratio)
+        replace_llama_with_condense(ratio=condense_ratio, scaling=training_args.rope_scaling)
+    if data_args.packing:
+        # packed sequences rely on the patched attention to separate their conversations
+        replace_llama_attn_with_flash_attn()
     local_rank = training_args.local_rank
     tokenizer = transformers.AutoTokenizer.from_pretrained(
         model_args.model_name_or_path,
@@ -279,7 +526,7 @@ def train():
         device_map=device_map
     )
     model.config.use_cache = False
-    trainer = Trainer(
+    trainer = SupervisedTrainer(
         model=model, tokenizer=tokenizer, args=training_args, **data_module
     )
 
@@ -24,11 +24,11 @@ from deepspeed import zero
 from deepspeed.runtime.zero.partition_parameters import ZeroParamStatus
 from peft import LoraConfig, get_peft_model
 import transformers
-from transformers import Trainer
 
 from toolbench.train.train import (
     DataArguments,
     ModelArguments,
+    SupervisedTrainer,
     TrainingArguments,
     make_supervised_data_module,
 )
@@ -102,7 +102,7 @@ def train():
     if training_args.source_model_max_length < training_args.model_max_length:
         condense_ratio = int(training_args.model_max_length/training_args.source_model_max_length)
         # ratio = N means the sequence length is expanded by N, remember to change the model_max_length to 8192 (2048 * ratio) for ratio = 4
-        replace_llama_with_condense(ratio=condense_ratio)
+        replace_llama_with_condense(ratio=condense_ratio, scaling=training_args.rope_scaling)
 
     world_size = int(os.environ.get("WORLD_SIZE", 1))
     ddp = world_size != 1
@@ -143,7 +143,7 @@ def train():
     tokenizer.pad_token = tokenizer.unk_token
 
     data_module = make_supervised_data_module(tokenizer=tokenizer, data_args=data_args)
-    trainer = Trainer(
+    trainer = SupervisedTrainer(
         model=model, tokenizer=tokenizer, args=training_args, **data_module
     )
 